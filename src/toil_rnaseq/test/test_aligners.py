@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+from unittest import TestCase
+
+from toil_rnaseq.tools import aligners
+from toil_rnaseq.tools import profiling
+from toil_rnaseq.tools import quantifiers
+from toil_rnaseq.tools import rsem_version
+from toil_rnaseq.tools.aligners import _stream
+from toil_rnaseq.tools.aligners import post_alignment
+from toil_rnaseq.tools.execution import backends_variable
+from toil_rnaseq.tools.execution import set_backends
+from toil_rnaseq.tools.quantifiers import rsem
+from toil_rnaseq.tools.quantifiers import rsem_prefix
+from toil_rnaseq.utils.expando import Expando
+
+# Stand-in for a natively installed RSEM that reads the transcriptome BAM
+fake_rsem = """#!/bin/bash
+while [ "$1" != "--bam" ]; do shift; done
+cat "$2" > /dev/null
+"""
+
+
+class PostAlignmentTest(TestCase):
+
+    def setUp(self):
+        self.functions = aligners.bamqc, aligners.sort_and_save, aligners.save_wiggle_file
+        self.calls = []
+
+        def task(name, result=None):
+            def run(*args, **kwargs):
+                self.calls.append((name, args[1:], kwargs))
+                time.sleep(0.2)
+                return result
+            return run
+        aligners.bamqc = task('bamqc', 'bamqc.tar')
+        aligners.sort_and_save = task('sort_and_save')
+        aligners.save_wiggle_file = task('save_wiggle_file')
+
+    def tearDown(self):
+        aligners.bamqc, aligners.sort_and_save, aligners.save_wiggle_file = self.functions
+
+    def test_bamqc_and_wiggle(self):
+        config = Expando(bamqc=True, save_bam=True)
+        start = time.time()
+        self.assertEqual(post_alignment(None, config, 'aligned.bam', 'wiggle.bg'), 'bamqc.tar')
+        # The aligned BAM is saved by BamQC, and the wiggle is saved alongside it
+        self.assertEqual(sorted(x[0] for x in self.calls), ['bamqc', 'save_wiggle_file'])
+        self.assertIn(('bamqc', ('aligned.bam', config), {'save_bam': True}), self.calls)
+        # Both run at once in the pool
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_save_bam(self):
+        config = Expando(bamqc=False, save_bam=True)
+        self.assertIsNone(post_alignment(None, config, 'aligned.bam', sorted_bam=True))
+        self.assertEqual(self.calls, [('sort_and_save', (config, 'aligned.bam'), {'skip_sort': True})])
+
+    def test_nothing_to_do(self):
+        self.assertIsNone(post_alignment(None, Expando(bamqc=False, save_bam=False), 'aligned.bam'))
+        self.assertEqual(self.calls, [])
+
+
+class StreamTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.work_dir, 'rnaAligned.toTranscriptome.out.bam')
+        os.mkfifo(self.fifo)
+        self.read = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def writer(self):
+        with open(self.fifo, 'w') as f:
+            f.write('alignments' * 100000)
+
+    def reader(self):
+        with open(self.fifo) as f:
+            self.read.append(f.read())
+
+    def fail(self, message):
+        def run():
+            raise RuntimeError(message)
+        return run
+
+    def test_stream(self):
+        _stream(self.fifo, self.writer, self.reader)
+        self.assertEqual(self.read, ['alignments' * 100000])
+
+    def test_writer_fails(self):
+        # RSEM, waiting for STAR to open the pipe, sees it closed instead
+        with self.assertRaisesRegexp(RuntimeError, 'STAR failed'):
+            _stream(self.fifo, self.fail('STAR failed'), self.reader)
+        self.assertEqual(self.read, [''])
+
+    def test_reader_fails(self):
+        # STAR, waiting for RSEM to open the pipe, fails writing to it, but RSEM's error is the one raised
+        with self.assertRaisesRegexp(RuntimeError, 'RSEM failed'):
+            _stream(self.fifo, self.writer, self.fail('RSEM failed'))
+
+
+class FusedProfileTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bin_dir = tempfile.mkdtemp()
+        path = os.path.join(self.bin_dir, 'rsem-calculate-expression')
+        with open(path, 'w') as f:
+            f.write(fake_rsem)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.environ = os.environ['PATH'], os.environ.get(backends_variable)
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        set_backends({'rsem': 'native'})
+        self.functions = quantifiers.download_url, profiling.sample_interval
+        profiling.sample_interval = 0.05
+
+        # RSEM reference holding only the group file RSEM's prefix is found from
+        ref_path = os.path.join(self.bin_dir, 'rsem_ref.tar.gz')
+        with tarfile.open(ref_path, 'w:gz') as tar:
+            open(os.path.join(self.bin_dir, 'ref.grp'), 'w').close()
+            tar.add(os.path.join(self.bin_dir, 'ref.grp'), arcname='ref/ref.grp')
+        quantifiers.download_url = lambda url, name, work_dir: shutil.copy(ref_path, os.path.join(work_dir, name))
+
+    def tearDown(self):
+        os.environ['PATH'], backends = self.environ
+        if backends is None:
+            del os.environ[backends_variable]
+        else:
+            os.environ[backends_variable] = backends
+        quantifiers.download_url, profiling.sample_interval = self.functions
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.bin_dir)
+
+    def test_rsem_stage(self):
+        # Profiles are kept by id(job), so the job outlives the test for its records not to be another job's
+        self.job = job = Expando(log=lambda message: None, tempDir=self.work_dir, cores=2)
+        profiling.profile_stage(job, 'star', 1000)
+        fifo = os.path.join(self.work_dir, 'rnaAligned.toTranscriptome.out.bam')
+        os.mkfifo(fifo)
+
+        def writer():
+            with open(fifo, 'w') as f:
+                f.write('alignments')
+        _stream(fifo, writer, lambda: rsem(job, 'file:///rsem_ref.tar.gz', fifo, rsem_prefix, cores=1))
+        # RSEM run within the STAR job is recorded as RSEM, without the size of the BAM it streamed
+        record = profiling.records(job)[-1]
+        self.assertEqual((record['tool'], record['image'], record['input_bytes']), ('rsem', rsem_version, None))
+        with open(profiling.write_profile(job, self.work_dir, image=rsem_version)) as f:
+            self.assertEqual([x['tool'] for x in json.load(f)], ['rsem'])
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from unittest import TestCase
+
+from toil_rnaseq.tools.jobs import consolidate_output
+from toil_rnaseq.utils import UserError
+from toil_rnaseq.utils import archive
+from toil_rnaseq.utils.archive import index_name
+from toil_rnaseq.utils.archive import load_index
+from toil_rnaseq.utils.archive import read_member
+from toil_rnaseq.utils.expando import Expando
+
+
+class FakeFileStore(object):
+    """Stand-in for a Toil file store whose FileStoreIDs are local paths"""
+
+    def readGlobalFileStream(self, filestore_id):
+        return open(filestore_id, 'rb')
+
+
+class FakeJob(object):
+
+    def __init__(self):
+        self.fileStore = FakeFileStore()
+        self.cores = 2
+
+    def log(self, message):
+        pass
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves byte ranges of the tarball set on the server, recording each Range header"""
+
+    def do_GET(self):
+        data = self.server.data
+        byte_range = self.headers.get('Range')
+        self.server.ranges.append(byte_range)
+        if byte_range:
+            start, end = [int(x) for x in byte_range[len('bytes='):].split('-')]
+            data = data[start:end + 1]
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.block_size, archive.block_size = archive.block_size, 4096
+        self.contents = {'rsem_genes.results': 'gene_id\tTPM\n' + 'ENSG1\t1.5\n' * 2000,
+                         'profile.json': '{}',
+                         'rsem_isoforms.results': ''.join(chr(x % 251) for x in xrange(10000))}
+        self.output = {}
+        for tool, names in [('RSEM', ['rsem_genes.results', 'rsem_isoforms.results']), ('QC', ['profile.json'])]:
+            path = os.path.join(self.work_dir, tool + '.tar')
+            with tarfile.open(path, 'w') as tar:
+                for name in names:
+                    file_path = os.path.join(self.work_dir, name)
+                    with open(file_path, 'w') as f:
+                        f.write(self.contents[name])
+                    tar.add(file_path, arcname=name)
+            self.output[tool] = path
+        self.config = Expando(uuid='sample-1', output_dir=os.path.join(self.work_dir, 'output'), cohort_matrix=None,
+                              ssec=None)
+        os.mkdir(self.config.output_dir)
+
+    def tearDown(self):
+        archive.block_size = self.block_size
+        shutil.rmtree(self.work_dir)
+
+    def test_index(self):
+        consolidate_output(FakeJob(), self.config, self.output)
+        tarball = os.path.join(self.config.output_dir, 'sample-1.tar.gz')
+
+        # The tarball is still an ordinary gzipped tarball
+        with tarfile.open(tarball) as tar:
+            self.assertEqual(sorted(tar.getnames()), ['sample-1/QC/profile.json', 'sample-1/RSEM/rsem_genes.results',
+                                                      'sample-1/RSEM/rsem_isoforms.results'])
+
+        index = load_index(os.path.join(self.config.output_dir, index_name('sample-1.tar.gz')))
+        self.assertEqual(index['compressed_size'], os.path.getsize(tarball))
+        for member in index['members']:
+            name = os.path.basename(member['name'])
+            self.assertEqual(member['size'], len(self.contents[name]))
+            self.assertEqual(read_member(tarball, index, member['name']), self.contents[name])
+
+        # Members are read from their own byte range
+        genes = next(x for x in index['members'] if x['name'] == 'sample-1/RSEM/rsem_genes.results')
+        self.assertEqual(genes['tool'], 'RSEM')
+        self.assertLess(genes['compressed_size'], index['compressed_size'])
+
+    def test_byte_ranges(self):
+        consolidate_output(FakeJob(), self.config, self.output)
+        tarball = os.path.join(self.config.output_dir, 'sample-1.tar.gz')
+        index = load_index(os.path.join(self.config.output_dir, index_name('sample-1.tar.gz')))
+        with open(tarball, 'rb') as f:
+            data = f.read()
+        members = sorted(index['members'], key=lambda x: x['compressed_offset'])
+        # Members' ranges are disjoint and in tarball order, and each starts a gzip member of its own
+        for a, b in zip(members, members[1:]):
+            self.assertLessEqual(a['compressed_offset'] + a['compressed_size'], b['compressed_offset'])
+            self.assertLessEqual(a['offset'] + a['size'], b['header_offset'])
+        for member in members:
+            chunk = data[member['compressed_offset']:member['compressed_offset'] + member['compressed_size']]
+            contents = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(chunk)
+            self.assertEqual(contents[:len(member['name'])], member['name'])
+            self.assertEqual(member['offset'] - member['header_offset'], tarfile.BLOCKSIZE)
+        # Members larger than a block span several gzip members
+        genes = next(x for x in members if x['name'].endswith('rsem_genes.results'))
+        chunk = data[genes['compressed_offset']:genes['compressed_offset'] + genes['compressed_size']]
+        self.assertGreater(chunk.count('\x1f\x8b\x08'), 1)
+
+    def test_checksum(self):
+        consolidate_output(FakeJob(), self.config, self.output)
+        tarball = os.path.join(self.config.output_dir, 'sample-1.tar.gz')
+        index = load_index(os.path.join(self.config.output_dir, index_name('sample-1.tar.gz')))
+        index['members'][0]['sha256'] = '0' * 64
+        with self.assertRaises(UserError):
+            read_member(tarball, index, index['members'][0]['name'])
+        with self.assertRaises(UserError):
+            read_member(tarball, index, 'sample-1/RSEM/missing.results')
+
+    def test_http(self):
+        consolidate_output(FakeJob(), self.config, self.output)
+        tarball = os.path.join(self.config.output_dir, 'sample-1.tar.gz')
+        index = load_index(os.path.join(self.config.output_dir, index_name('sample-1.tar.gz')))
+        server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        with open(tarball, 'rb') as f:
+            server.data = f.read()
+        server.ranges = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/sample-1.tar.gz'.format(server.server_port)
+            name = 'sample-1/QC/profile.json'
+            self.assertEqual(read_member(url, index, name), self.contents['profile.json'])
+        finally:
+            server.shutdown()
+            server.server_close()
+        # Only the member's compressed bytes are requested
+        member = next(x for x in index['members'] if x['name'] == name)
+        start = member['compressed_offset']
+        self.assertEqual(server.ranges, ['bytes={}-{}'.format(start, start + member['compressed_size'] - 1)])
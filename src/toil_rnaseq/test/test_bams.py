@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil.fileStore import FileID
+
+from toil_rnaseq.tools import bams
+from toil_rnaseq.tools import preprocessing
+from toil_rnaseq.utils.expando import Expando
+
+header = '@HD\tVN:1.4\tSO:coordinate\n@RG\tID:lane1\tSM:s\n@RG\tID:lane2\tSM:s\n'
+
+
+class CramTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.work_dir, 'aligned.bam')
+        open(self.bam, 'w').close()
+        self.functions = bams.docker_call, bams.download_reference, bams.move_or_upload
+        self.calls, self.saved = [], []
+        bams.docker_call = lambda job, tool, parameters, workDir: self.calls.append(parameters)
+        bams.download_reference = lambda config, work_dir: os.path.join(work_dir, 'genome.fa')
+        bams.move_or_upload = lambda config, files, owned: self.saved.extend(files)
+        self.config = Expando(uuid='sample', save_bam_format='cram')
+        self.job = Expando(cores=4)
+
+    def tearDown(self):
+        bams.docker_call, bams.download_reference, bams.move_or_upload = self.functions
+        shutil.rmtree(self.work_dir)
+
+    def test_sort_to_cram(self):
+        bams.sort_and_save(self.job, self.config, self.bam, skip_sort=False)
+        # A single samtools pass sorts straight to CRAM, which is then indexed
+        self.assertEqual(self.calls, [['sort', '-O', 'cram', '-T', 'temp', '--reference', '/data/genome.fa',
+                                       '-@', '4', '-o', '/data/sample.sorted.cram', '/data/aligned.bam'],
+                                      ['index', '/data/sample.sorted.cram']])
+        cram = os.path.join(self.work_dir, 'sample.sorted.cram')
+        self.assertEqual(self.saved, [cram, cram + '.crai'])
+        self.assertFalse(os.path.exists(self.bam))
+
+    def test_sorted_to_cram(self):
+        bams.sort_and_save(self.job, self.config, self.bam, skip_sort=True)
+        self.assertEqual(self.calls[0], ['view', '-C', '-T', '/data/genome.fa',
+                                         '-@', '4', '-o', '/data/sample.sorted.cram', '/data/aligned.bam'])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_bam(self):
+        self.config.save_bam_format = 'bam'
+        bams.save_alignment(self.job, self.config, self.bam)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.saved, [self.bam])
+
+
+class ReadGroupTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.work_dir, 'input.bam')
+        self.function = bams.docker_check_output
+        self.calls = []
+        self.counts = {'all': 100, 'read_groups': 100}
+
+        def check_output(job, workDir, parameters, tool):
+            self.calls.append(parameters)
+            if '-H' in parameters:
+                return header
+            return '{}\n'.format(self.counts['read_groups' if '-R' in parameters else 'all'])
+        bams.docker_check_output = check_output
+        self.job = Expando(cores=2, log=lambda x: None)
+
+    def tearDown(self):
+        bams.docker_check_output = self.function
+        shutil.rmtree(self.work_dir)
+
+    def test_read_groups_cover_bam(self):
+        self.assertEqual(bams.shardable_read_groups(self.job, self.bam), ['lane1', 'lane2'])
+        self.assertIn(['view', '-c', '-@', '2', '-R', '/data/read_groups.txt', '/data/input.bam'], self.calls)
+        with open(os.path.join(self.work_dir, 'read_groups.txt')) as f:
+            self.assertEqual(f.read(), 'lane1\nlane2\n')
+
+    def test_untagged_reads(self):
+        self.counts['read_groups'] = 90
+        self.assertEqual(bams.shardable_read_groups(self.job, self.bam), [])
+
+
+class FakeFileStore(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.deleted = []
+
+    @contextmanager
+    def readGlobalFileStream(self, file_id):
+        yield StringIO(self.files[file_id])
+
+    @contextmanager
+    def writeGlobalFileStream(self):
+        f = StringIO()
+        file_id = 'out{}'.format(len(self.files))
+        yield f, file_id
+        self.files[file_id] = f.getvalue()
+
+    def deleteGlobalFile(self, file_id):
+        self.deleted.append(file_id)
+
+
+class ConcatenateShardsTest(TestCase):
+
+    def test_concatenate(self):
+        files = {'a1': '@a1\n', 'a2': '@a2\n', 'b1': '@b1\n', 'b2': '@b2\n'}
+        shards = [(FileID('a1', 4), FileID('a2', 4)), (FileID('b1', 4), FileID('b2', 4))]
+        job = Expando(fileStore=FakeFileStore(files), tempDir=tempfile.mkdtemp())
+        try:
+            r1, r2 = preprocessing.concatenate_fastq_shards(job, shards, ids_to_delete=['bam'])
+            self.assertEqual(os.listdir(job.tempDir), [])
+        finally:
+            shutil.rmtree(job.tempDir)
+        self.assertEqual((files[r1], files[r2]), ('@a1\n@b1\n', '@a2\n@b2\n'))
+        self.assertEqual((r1.size, r2.size), (8, 8))
+        self.assertEqual(sorted(job.fileStore.deleted), ['a1', 'a2', 'b1', 'b2', 'bam'])
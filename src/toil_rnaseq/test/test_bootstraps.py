@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+from unittest import TestCase
+
+from toil_rnaseq.tools import hera_version
+from toil_rnaseq.tools import kallisto_version
+from toil_rnaseq.tools import quantifiers
+from toil_rnaseq.tools.quantifiers import bootstrap_outputs
+from toil_rnaseq.utils.bootstraps import summarize_bootstraps
+from toil_rnaseq.utils.expando import Expando
+
+# Bootstraps of two transcripts as "kallisto h5dump" writes them from Hera's abundance.h5, whose targets are
+# GENCODE transcript headers
+transcripts = [('ENST00000456328.2|ENSG00000223972.5|DDX11L1-202|', '1657', '1490.5'),
+               ('ENST00000450305.2|ENSG00000223972.5|DDX11L1-201|', '632', '465.5')]
+hera_bootstraps = [[transcripts[0] + (est_counts, tpm), transcripts[1] + ('0', '0')]
+                   for est_counts, tpm in [('4', '2.5'), ('1', '1'), ('3', '2'), ('2', '1.5')]]
+
+
+class BootstrapTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_bootstraps(self, bootstrap_dir):
+        for i, rows in enumerate(hera_bootstraps):
+            with open(os.path.join(bootstrap_dir, 'bs_abundance_{}.tsv'.format(i)), 'w') as f:
+                f.write('target_id\tlength\teff_length\test_counts\ttpm\n')
+                f.writelines('\t'.join(row) + '\n' for row in rows)
+
+    def read_summary(self, path):
+        values = array('f')
+        with open(path, 'rb') as f:
+            values.fromstring(f.read())
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def test_summary(self):
+        self.write_bootstraps(self.work_dir)
+        summary_path, description_path = summarize_bootstraps(self.work_dir, self.work_dir)
+        with open(description_path) as f:
+            description = json.load(f)
+        self.assertEqual((description['bootstraps'], description['targets']), (4, 2))
+        self.assertEqual(description['shape'], [2, 7, 2])
+        values = self.read_summary(summary_path)
+        self.assertEqual(len(values), 2 * 7 * 2)
+        # est_counts of the first transcript over bootstraps 4, 1, 3, 2: mean, variance, and quantiles.
+        # The second transcript has no reads in any bootstrap
+        self.assertEqual(['{:g}'.format(x) for x in values[0::2][:7]],
+                         ['2.5', '1.66667', '1.075', '1.75', '2.5', '3.25', '3.925'])
+        self.assertEqual(list(values[1::2][:7]), [0.0] * 7)
+        # TPM follows, in the same layout
+        self.assertEqual(['{:g}'.format(x) for x in values[14::2][:2]], ['1.75', '0.416667'])
+
+    def test_hera_outputs(self):
+        calls = []
+
+        def docker_call(job, workDir, parameters, tool, record_as=None):
+            calls.append((parameters[0], tool, record_as))
+            self.write_bootstraps(os.path.join(workDir, parameters[2][len('/data/'):]))
+        docker_call_, quantifiers.docker_call = quantifiers.docker_call, docker_call
+        try:
+            h5_path = os.path.join(self.work_dir, 'abundance.h5')
+            tsv_path = os.path.join(self.work_dir, 'abundance.tsv')
+            outputs = bootstrap_outputs(None, self.work_dir, self.work_dir, Expando(num=4, summarize=True, keep=False),
+                                        [tsv_path, h5_path], hera_version)
+        finally:
+            quantifiers.docker_call = docker_call_
+        # Hera's bootstraps are dumped with Kallisto's image, and the call is profiled as Hera's
+        self.assertEqual(calls, [('h5dump', kallisto_version, hera_version)])
+        self.assertEqual([os.path.basename(x) for x in outputs],
+                         ['abundance.tsv', 'bootstrap_summary.f32', 'bootstrap_summary.json'])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'bootstraps')))
+
+    def test_no_summary(self):
+        outputs = ['abundance.tsv', 'abundance.h5']
+        self.assertEqual(bootstrap_outputs(None, self.work_dir, self.work_dir,
+                                           Expando(num=100, summarize=False, keep=True), outputs, hera_version),
+                         outputs)
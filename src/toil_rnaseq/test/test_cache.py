@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools import preprocessing
+from toil_rnaseq.tools.preprocessing import preprocess
+from toil_rnaseq.utils import cache
+from toil_rnaseq.utils.cache import url_identity
+from toil_rnaseq.utils.expando import Expando
+
+
+class FakeJob(object):
+
+    def __init__(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.fileStore = self
+        self.children = []
+
+    def log(self, message):
+        pass
+
+    def writeGlobalFile(self, path):
+        return os.path.basename(path)
+
+    def addChildJobFn(self, function, *args, **kwargs):
+        self.children.append(function)
+        return Expando(rv=lambda: 'processed')
+
+
+class CacheKeyTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.functions = cache.url_etag, cache.url_size, preprocessing.fetch
+        self.etags, self.sizes, self.keys = {}, {}, []
+        cache.url_etag = self.etags.get
+        cache.url_size = self.sizes.get
+
+        def fetch(location, key, work_dir):
+            self.keys.append(key)
+            return {'R1.fastq': os.path.join(work_dir, 'R1.fastq')}
+        preprocessing.fetch = fetch
+
+    def tearDown(self):
+        cache.url_etag, cache.url_size, preprocessing.fetch = self.functions
+        shutil.rmtree(self.work_dir)
+
+    def url(self, name, text):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return 'file://' + path
+
+    def key(self, url):
+        config = Expando(cache=Expando(url=self.work_dir + '/'), url=url, uuid='sample', file_type='fq',
+                         paired=False, cutadapt=True, fwd_3pr_adapter='AGATCGGAAGAG', rev_3pr_adapter='AGATCGGAAGAG')
+        job = FakeJob()
+        try:
+            result = preprocess(job, config)
+        finally:
+            shutil.rmtree(job.tempDir)
+        return self.keys.pop() if result == ('R1.fastq', None) else None
+
+    def test_url_identity(self):
+        self.etags['s3://bucket/R1.fastq.gz'] = '"9f86d08"'
+        self.sizes.update({'s3://bucket/R1.fastq.gz': 100, 'http://example.com/R1.fastq.gz': 100})
+        self.assertEqual(url_identity('s3://bucket/R1.fastq.gz'), 'etag:"9f86d08"')
+        self.assertEqual(url_identity('http://example.com/R1.fastq.gz'), 'size:100')
+        self.assertIsNone(url_identity('ftp://example.com/R1.fastq.gz'))
+        self.assertIsNone(url_identity('file://' + os.path.join(self.work_dir, 'missing.fastq')))
+
+    def test_preprocessing_key(self):
+        key = self.key(self.url('R1.fastq', 'ACGT'))
+        self.assertIsNotNone(key)
+        # Keys follow the content of inputs, not their location or size
+        self.assertEqual(self.key(self.url('moved.fastq', 'ACGT')), key)
+        self.assertNotEqual(self.key(self.url('R1.fastq', 'TTTT')), key)
+        self.etags['http://example.com/R1.fastq'] = '"1"'
+        http_key = self.key('http://example.com/R1.fastq')
+        self.etags['http://example.com/R1.fastq'] = '"2"'
+        self.assertNotEqual(self.key('http://example.com/R1.fastq'), http_key)
+
+    def test_unidentified_inputs(self):
+        # Without an ETag or size, the sample is processed without looking up or storing a cache entry
+        job = FakeJob()
+        config = Expando(cache=Expando(url=self.work_dir + '/'), url='ftp://example.com/R1.fastq', uuid='sample',
+                         file_type='fq')
+        try:
+            self.assertEqual(preprocess(job, config), 'processed')
+        finally:
+            shutil.rmtree(job.tempDir)
+        self.assertEqual(self.keys, [])
+        self.assertEqual(job.children, [preprocessing.download_and_process_fastqs])
@@ -0,0 +1,62 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+import yaml
+
+from toil_rnaseq import utils
+from toil_rnaseq.utils import UserError
+from toil_rnaseq.utils import configuration_sanity_checks
+from toil_rnaseq.utils import generate_config
+from toil_rnaseq.utils import rexpando
+from toil_rnaseq.utils import user_input_config
+
+
+class ConfigTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.work_dir)
+
+    def install(self, *programs):
+        for program in programs:
+            path = os.path.join(self.work_dir, program)
+            open(path, 'w').close()
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def test_user_input_round_trip(self):
+        # Answering "skip" to every option writes the defaults back out
+        answers = iter(['y'] + ['n'] * 1000)
+        utils.raw_input = lambda prompt: next(answers)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            path = user_input_config(os.path.join(self.work_dir, 'config.yaml'))
+        finally:
+            del utils.raw_input
+            sys.stdout = stdout
+        with open(path) as f:
+            text = f.read()
+        self.assertEqual(yaml.safe_load(text), yaml.safe_load(generate_config()))
+        # Each option is written once, following only its own comments
+        options = [x.split(':')[0] for x in text.split('\n') if x and not x.startswith('#')]
+        self.assertEqual(sorted(options), sorted(yaml.safe_load(generate_config())))
+
+    def test_program_checks(self):
+        config = rexpando(yaml.safe_load(generate_config()))
+        config.update(kallisto_index='file:///kallisto.idx', output_dir=os.path.join(self.work_dir, 'output'),
+                      tool_backends={'default': 'singularity', 'kallisto': 'native'})
+        os.environ['PATH'] = self.work_dir
+        self.install('curl', 'kallisto')
+        # Docker isn't needed when no tool runs with it, but Singularity (or Apptainer) is
+        with self.assertRaisesRegexp(UserError, 'apptainer or singularity must be installed'):
+            configuration_sanity_checks(config.copy())
+        self.install('apptainer')
+        configuration_sanity_checks(config.copy())
@@ -0,0 +1,50 @@
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools.execution import execute
+
+# Stand-in for a natively installed samtools: "view" prints the file it is given, anything else fails
+fake_samtools = """#!/bin/bash
+test "$1" = view && cat "$2"
+"""
+
+
+class ExecuteTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bin_dir = tempfile.mkdtemp()
+        path = os.path.join(self.bin_dir, 'samtools')
+        with open(path, 'w') as f:
+            f.write(fake_samtools)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.bin_dir + os.pathsep + self.path
+        with open(os.path.join(self.work_dir, 'sample.sam'), 'w') as f:
+            f.write('alignments\n')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.bin_dir)
+
+    def test_native(self):
+        # Paths under /data refer to the work directory
+        output, usage = execute(samtools_version, ['view', '/data/sample.sam'], self.work_dir, 'native',
+                                check_output=True)
+        self.assertEqual(output, 'alignments\n')
+        self.assertGreater(usage['memory'], 0)
+
+        out_path = os.path.join(self.work_dir, 'out.sam')
+        with open(out_path, 'w') as f:
+            execute(samtools_version, ['view', '/data/sample.sam'], self.work_dir, 'native', outfile=f)
+        with open(out_path) as f:
+            self.assertEqual(f.read(), 'alignments\n')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            execute(samtools_version, ['index', '/data/sample.sam'], self.work_dir, 'native')
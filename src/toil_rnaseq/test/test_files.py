@@ -0,0 +1,104 @@
+import gzip
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.utils import files
+from toil_rnaseq.utils.files import deliver_file
+from toil_rnaseq.utils.files import open_output
+from toil_rnaseq.utils.files import tarball_files
+
+
+class DeliverFileTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.mkdir(self.output_dir)
+        self.path = os.path.join(self.work_dir, 'sample.sorted.bam')
+        with open(self.path, 'w') as f:
+            f.write('alignments')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def read_output(self):
+        with open(os.path.join(self.output_dir, 'sample.sorted.bam')) as f:
+            return f.read()
+
+    def test_rename_owned(self):
+        self.assertEqual(deliver_file(self.path, self.output_dir, owned=True), 'rename')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read_output(), 'alignments')
+
+    def test_link_shared(self):
+        # Depending on the filesystem, the file is cloned or hardlinked, and is left in place
+        self.assertIn(deliver_file(self.path, self.output_dir), ['reflink', 'hardlink'])
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(self.read_output(), 'alignments')
+
+    def test_copy_fallback(self):
+        def fail(src, dest):
+            raise OSError(18, 'Invalid cross-device link')
+        reflink, link = files._reflink, os.link
+        files._reflink, os.link = fail, fail
+        try:
+            self.assertEqual(deliver_file(self.path, self.output_dir), 'copy')
+        finally:
+            files._reflink, os.link = reflink, link
+        self.assertEqual(self.read_output(), 'alignments')
+        self.assertEqual(os.listdir(self.output_dir), ['sample.sorted.bam'])
+
+
+class TarballFilesTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'abundance.tsv')
+        with open(self.path, 'w') as f:
+            f.write('target_id\tlength\teff_length\test_counts\ttpm\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def members(self, name):
+        with tarfile.open(os.path.join(self.work_dir, name)) as f:
+            return f.getnames()
+
+    def test_plain_tar(self):
+        # Tool outputs are left uncompressed, so they aren't compressed twice when consolidated
+        tarball_files('kallisto.tar', [self.path], output_dir=self.work_dir, prefix='Kallisto/')
+        with open(os.path.join(self.work_dir, 'kallisto.tar'), 'rb') as f:
+            self.assertNotEqual(f.read(2), '\x1f\x8b')
+        self.assertEqual(self.members('kallisto.tar'), ['Kallisto/abundance.tsv'])
+
+    def test_gzipped_tar(self):
+        tarball_files('kallisto.tar.gz', [self.path], output_dir=self.work_dir)
+        gzip.open(os.path.join(self.work_dir, 'kallisto.tar.gz')).read()
+        self.assertEqual(self.members('kallisto.tar.gz'), ['abundance.tsv'])
+
+    def test_relative_path(self):
+        with self.assertRaises(ValueError):
+            tarball_files('kallisto.tar', ['abundance.tsv'], output_dir=self.work_dir)
+
+
+class OpenOutputTest(TestCase):
+
+    def test_file(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            with open_output(os.path.join(work_dir, 'matrix.tsv')) as f:
+                f.write('gene_id\n')
+            self.assertTrue(f.closed)
+            with open(os.path.join(work_dir, 'matrix.tsv')) as f:
+                self.assertEqual(f.read(), 'gene_id\n')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_stdout(self):
+        with open_output() as f:
+            self.assertIs(f, sys.stdout)
+        self.assertFalse(sys.stdout.closed)
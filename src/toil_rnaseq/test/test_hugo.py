@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.utils.hugo import MappingTable
+from toil_rnaseq.utils.hugo import build_table
+from toil_rnaseq.utils.hugo import map_rsem_output
+
+
+class HugoTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        tsv_path = os.path.join(self.work_dir, 'mapping.tsv')
+        with open(tsv_path, 'w') as f:
+            f.write('# id\tname\nENSG00000141510.16\tTP53\nENSG00000012048\tBRCA1\nENST00000269305.8\tTP53-201\n')
+        self.table_path = os.path.join(self.work_dir, 'hugo.map')
+        self.assertEqual(build_table(tsv_path, self.table_path), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_lookup(self):
+        table = MappingTable(self.table_path)
+        self.assertEqual(len(table), 3)
+        names = table.lookup(['ENSG00000141510.16', 'ENSG00000012048.20', 'ENSG00000000003.14', 'ENSG00000141510.16'])
+        self.assertEqual(names, {'ENSG00000141510.16': 'TP53', 'ENSG00000012048.20': 'BRCA1'})
+
+    def test_map_rsem_output(self):
+        isoforms_path = os.path.join(self.work_dir, 'rsem_isoforms.results')
+        with open(isoforms_path, 'w') as f:
+            f.write('transcript_id\tgene_id\tlength\tTPM\n'
+                    'ENST00000269305.8\tENSG00000141510.16\t2579\t10.5\n'
+                    'ENST00000000001.1\tENSG00000000001.1\t100\t0.00\n')
+        output_path = os.path.join(self.work_dir, 'rsem_isoforms.hugo.results')
+        map_rsem_output(MappingTable(self.table_path), isoforms_path, output_path, 'isoforms')
+        with open(output_path) as f:
+            self.assertEqual(f.read(), 'transcript_id\tgene_id\tlength\tTPM\n'
+                                       'TP53-201\tTP53\t2579\t10.5\n'
+                                       'ENST00000000001.1\tENSG00000000001.1\t100\t0.00\n')
@@ -0,0 +1,51 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+from unittest import TestCase
+
+from toil_rnaseq.tools.images import format_pulls
+from toil_rnaseq.tools.images import pull_images
+
+# Stand-in for the docker command. Images in the registry and on the node are empty files in two directories
+fake_docker = """#!/bin/bash
+name=$(echo "${{@: -1}}" | tr / _)
+case "$1" in
+    image) test -e "{dir}/node/$name" ;;
+    pull) sleep 0.5
+          test -e "{dir}/registry/$name" || {{ echo "manifest unknown" >&2; exit 1; }}
+          touch "{dir}/node/$name" ;;
+esac
+"""
+
+
+class ImagesTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for name in ['registry', 'node']:
+            os.mkdir(os.path.join(self.work_dir, name))
+        self.docker = os.path.join(self.work_dir, 'docker')
+        with open(self.docker, 'w') as f:
+            f.write(fake_docker.format(dir=self.work_dir))
+        os.chmod(self.docker, os.stat(self.docker).st_mode | stat.S_IEXEC)
+        self.images = ['quay.io/ucsc_cgl/star:2.4.2a', 'quay.io/ucsc_cgl/rsem:1.2.25', 'quay.io/ucsc_cgl/hera:1.1']
+        for image in self.images[:2]:
+            open(os.path.join(self.work_dir, 'registry', image.replace('/', '_')), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_pull(self):
+        start = time.time()
+        results = pull_images(self.images, num_threads=3, docker=self.docker)
+        # Pulls run concurrently
+        self.assertLess(time.time() - start, 1.2)
+        self.assertEqual([(x['cached'], x['error']) for x in results],
+                         [(False, None), (False, None), (False, 'manifest unknown')])
+
+        # Pulled images are cached on the node
+        results = pull_images(self.images[:2], docker=self.docker)
+        self.assertEqual([x['cached'] for x in results], [True, True])
+        self.assertTrue(format_pulls(results).endswith('2 of 2 images cached, 0 pulled in 0s, 0 failed'))
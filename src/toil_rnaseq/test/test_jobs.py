@@ -0,0 +1,81 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools.jobs import map_job
+from toil_rnaseq.tools.jobs import read_samples
+from toil_rnaseq.tools.jobs import store_samples
+from toil_rnaseq.utils.expando import Expando
+
+
+class FakeToil(object):
+
+    def importFile(self, url):
+        return url[len('file://'):]
+
+
+class FakeJob(object):
+    """Records the children a job function adds, with a file store reading the imported files in place"""
+
+    def __init__(self):
+        self.children = []
+        self.fileStore = Expando(readGlobalFile=lambda file_id: file_id)
+
+    def addChildJobFn(self, fn, *args):
+        self.children.append((fn, args))
+
+
+def expand(samples, func, batch=False):
+    """Runs the tree of `map_job` jobs, returning the arguments of each call of `func` and the most children a job
+    of the tree has (branches), and the most calls of `func` a leaf makes"""
+    calls, widest, pending = [], (0, 0), [samples]
+    while pending:
+        job = FakeJob()
+        map_job(job, func, pending.pop(0), 'arg')
+        branches = len([x for x in job.children if x[0] is map_job])
+        widest = max(widest[0], branches), max(widest[1], len(job.children) - branches)
+        for fn, args in job.children:
+            if fn is map_job:
+                pending.append(args[1])
+            else:
+                calls.append(args)
+    return calls, widest
+
+
+class MapJobTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.samples = [['fq', 'paired', 'uuid{}'.format(i), 'file:///r{}_1.fq,file:///r{}_2.fq'.format(i, i)]
+                        for i in xrange(250)]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_read_samples(self):
+        samples = store_samples(FakeToil(), self.samples, self.work_dir)
+        samples.start, samples.stop = 17, 42
+        self.assertEqual(read_samples(FakeJob(), samples), self.samples[17:42])
+        samples.start, samples.stop = 249, 250
+        self.assertEqual(read_samples(FakeJob(), samples), self.samples[-1:])
+
+    def test_tree(self):
+        func = lambda job, sample, arg: None
+        samples = store_samples(FakeToil(), self.samples, self.work_dir, branching_factor=3, leaf_size=20)
+        calls, widest = expand(samples, func)
+        # Every sample is spawned exactly once, in order, and no job has more children than allowed
+        self.assertEqual(calls, [(x, 'arg') for x in self.samples])
+        self.assertEqual(widest, (3, 14))
+
+        samples = store_samples(FakeToil(), self.samples, self.work_dir, branching_factor=3, leaf_size=300)
+        self.assertEqual(len(expand(samples, func)[0]), 250)
+
+    def test_batches(self):
+        samples = store_samples(FakeToil(), self.samples, self.work_dir, leaf_size=100, batch_size=40)
+        calls, _ = expand(samples, lambda job, batch, arg: None)
+        self.assertEqual([x for batch, _ in calls for x in batch], self.samples)
+        self.assertTrue(all(len(batch) <= 40 for batch, _ in calls))
+
+    def test_empty(self):
+        samples = store_samples(FakeToil(), [], self.work_dir)
+        self.assertEqual(expand(samples, lambda job, sample, arg: None), ([], (0, 0)))
@@ -0,0 +1,70 @@
+import math
+import os
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_rnaseq.utils.matrix import add_tarball
+from toil_rnaseq.utils.matrix import append_sample
+from toil_rnaseq.utils.matrix import export_table
+from toil_rnaseq.utils.matrix import load_matrix
+from toil_rnaseq.utils.matrix import read_column
+
+
+def rsem_genes(rows):
+    header = 'gene_id\ttranscript_id(s)\tlength\teffective_length\texpected_count\tTPM\tFPKM\n'
+    return header + ''.join('{}\tT\t100\t90\t{}\t{}\t0\n'.format(*x) for x in rows)
+
+
+class MatrixTest(TestCase):
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def test_append(self):
+        append_sample(self.store, 'sample-1', {'rsem-genes': rsem_genes([('G1', 10, 1.5), ('G2', 20, 2.5)])})
+        # Features are reordered to match the first sample, and missing features are NaN
+        append_sample(self.store, 'sample-2', {'rsem-genes': rsem_genes([('G2', 40, 4.5), ('G3', 1, 1)])})
+        matrix = load_matrix(self.store, 'rsem-genes')
+        self.assertEqual(matrix.features, ['G1', 'G2'])
+        self.assertEqual(matrix.samples.keys(), ['sample-1', 'sample-2'])
+        self.assertEqual(list(read_column(matrix, 'sample-1')), [1.5, 2.5])
+        self.assertEqual(list(read_column(matrix, 'sample-1', 'counts')), [10, 20])
+        column = read_column(matrix, 'sample-2')
+        self.assertTrue(math.isnan(column[0]))
+        self.assertEqual(column[1], 4.5)
+
+        f = StringIO()
+        export_table(matrix, f, value='counts', samples=['sample-2', 'sample-1'])
+        self.assertEqual(f.getvalue(), 'feature\tsample-2\tsample-1\nG1\tnan\t10\nG2\t40\t20\n')
+
+    def test_replace_and_recover(self):
+        append_sample(self.store, 'sample-1', {'rsem-genes': rsem_genes([('G1', 10, 1.5)])})
+        append_sample(self.store, 'sample-2', {'rsem-genes': rsem_genes([('G1', 20, 2.5)])})
+        append_sample(self.store, 'sample-1', {'rsem-genes': rsem_genes([('G1', 30, 3.5)])})
+        matrix = load_matrix(self.store, 'rsem-genes')
+        self.assertEqual(matrix.samples.keys(), ['sample-1', 'sample-2'])
+        self.assertEqual(list(read_column(matrix, 'sample-1')), [3.5])
+
+        # A column written without its sample being indexed is overwritten by the next sample
+        with open(os.path.join(matrix.dir, 'tpm.f32'), 'ab') as f:
+            f.write('\0' * 4)
+        append_sample(self.store, 'sample-3', {'rsem-genes': rsem_genes([('G1', 40, 4.5)])})
+        matrix = load_matrix(self.store, 'rsem-genes')
+        self.assertEqual(list(read_column(matrix, 'sample-3')), [4.5])
+        self.assertEqual(os.path.getsize(os.path.join(matrix.dir, 'tpm.f32')), 12)
+
+    def test_tarball(self):
+        tarball = os.path.join(self.store, 'sample-1.tar.gz')
+        data = rsem_genes([('G1', 10, 1.5)])
+        with tarfile.open(tarball, 'w:gz') as tar:
+            for name in ['sample-1/RSEM/rsem_genes.results', 'sample-1/RSEM/Hugo/rsem_genes.hugo.results']:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, StringIO(data))
+        self.assertEqual(add_tarball(os.path.join(self.store, 'matrix'), tarball), ('sample-1', ['rsem-genes']))
@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+import yaml
+
+from toil_rnaseq.utils import UserError
+from toil_rnaseq.utils import generate_config
+from toil_rnaseq.utils import optional_defaults
+from toil_rnaseq.utils import rexpando
+from toil_rnaseq.utils.planner import plan_sample
+from toil_rnaseq.utils.planner import simulate
+from toil_rnaseq.utils.policy import load_curves
+from toil_rnaseq.utils.resources import load_model
+
+
+def job(name, tool, cores, seconds, after=(), memory=1, disk=1):
+    return {'name': name, 'tool': tool, 'cores': cores, 'memory': memory, 'disk': disk, 'seconds': seconds,
+            'after': list(after)}
+
+
+class SimulateTest(TestCase):
+
+    def test_dependencies(self):
+        plans = [[job('download', 'download', 1, 10), job('star', 'star', 4, 100, ['download']),
+                  job('rsem', 'rsem', 2, 50, ['star'])]]
+        self.assertEqual(simulate(plans, 1, 8, 10, 10), 160)
+
+    def test_ready_jobs_pass_blocked_tool(self):
+        # The second STAR job doesn't fit next to the first, but Kallisto behind it in the manifest does
+        plans = [[job('star', 'star', 3, 10)], [job('star', 'star', 3, 10)], [job('kallisto', 'kallisto', 1, 20)]]
+        self.assertEqual(simulate(plans, 1, 4, 10, 10), 20)
+
+    def test_memory_and_nodes(self):
+        # Cores fit two jobs on a node but memory only fits one, until a second node is added
+        plans = [[job('star', 'star', 1, 10, memory=6)]] * 2
+        self.assertEqual(simulate(plans, 1, 4, 10, 10), 20)
+        self.assertEqual(simulate(plans, 2, 4, 10, 10), 10)
+
+    def test_job_too_large(self):
+        with self.assertRaises(UserError):
+            simulate([[job('star', 'star', 16, 10)]], 4, 8, 10, 10)
+
+    def test_no_samples(self):
+        self.assertEqual(simulate([], 1, 8, 10, 10), 0)
+
+
+class PlanSampleTest(TestCase):
+
+    def setUp(self):
+        self.config = rexpando(yaml.safe_load(generate_config()))
+        for option, default in optional_defaults.iteritems():
+            self.config.setdefault(option, default)
+        self.config.update(star_index='file:///star.tar.gz', rsem_ref='file:///rsem.tar.gz', bamqc=True, cores=16,
+                           node_memory=256 * 1024 ** 3, resources=load_model(None), scaling=load_curves(None))
+        self.sample = ['fq', 'paired', 'sample', 'file:///R1.fastq.gz,file:///R2.fastq.gz', '1000000000,1000000000']
+
+    def test_fused(self):
+        jobs = {x['name']: x for x in plan_sample(self.sample, self.config)}
+        self.config.fuse_star_rsem = True
+        fused = {x['name']: x for x in plan_sample(self.sample, self.config)}
+        # RSEM's time and cores go to the STAR job, not to BamQC, which is wired after it
+        self.assertNotIn('rsem', fused)
+        self.assertEqual(fused['bamqc'], jobs['bamqc'])
+        self.assertGreater(fused['star']['seconds'], jobs['star']['seconds'])
+        self.assertEqual(fused['star']['cores'], min(16, jobs['star']['cores'] + jobs['rsem']['cores']))
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.policy import allocate_cores
+from toil_rnaseq.utils.policy import choose_cores
+from toil_rnaseq.utils.policy import runtime
+
+
+class PolicyTest(TestCase):
+
+    curve = {1: 1000, 2: 520, 4: 280, 8: 200, 16: 180}
+
+    def test_runtime(self):
+        # Measured points are returned as is, and between them wall time is linear in threads
+        self.assertEqual(runtime(self.curve, 4), 280)
+        self.assertEqual(runtime(self.curve, 3), 400)
+        self.assertEqual(runtime(self.curve, 12), 190)
+        # Outside the measured range the closest measurement is used
+        self.assertEqual(runtime(self.curve, 32), 180)
+        self.assertEqual(runtime({4: 300, 8: 200}, 1), 300)
+
+    def test_choose_cores(self):
+        # Sixteen 1-core jobs quantify 57.6 samples an hour, eight 2-core jobs 55.4 and four 4-core jobs 51.4.
+        # When memory only fits four jobs, 1-core jobs drop to 14.4 samples an hour and 4-core jobs win
+        self.assertEqual(choose_cores(self.curve, 16), 1)
+        self.assertEqual(choose_cores(self.curve, 16, max_concurrent=4), 4)
+        self.assertEqual(choose_cores(self.curve, 16, max_concurrent=1), 16)
+        self.assertEqual(choose_cores(self.curve, 16, max_concurrent=0), 16)
+
+    def test_allocate_cores(self):
+        # Jobs are sized for the node shape in the config, not the node the workflow is built on
+        config = Expando(scaling={'star': self.curve}, resources={}, cores=16, node_memory=160 * 1024 ** 3)
+        self.assertEqual(allocate_cores(config, 'star-colocated', '10G'), 1)
+        config.node_memory = 40 * 1024 ** 3
+        self.assertEqual(allocate_cores(config, 'star', '10G'), 4)
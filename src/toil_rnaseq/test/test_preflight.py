@@ -0,0 +1,64 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.utils import preflight
+from toil_rnaseq.utils.preflight import find_completed
+from toil_rnaseq.utils.preflight import order_by_size
+
+
+class PreflightTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def url(self, name, size):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        return 'file://' + path
+
+    def test_order_by_size(self):
+        small = ['fq', 'paired', 'small', self.url('s1.fq', 10) + ',' + self.url('s2.fq', 10)]
+        large = ['fq', 'paired', 'large', self.url('l1.fq', 100) + ',' + self.url('l2.fq', 100)]
+        missing = ['fq', 'paired', 'missing', 'file:///missing_1.fq,' + self.url('m2.fq', 1)]
+        known = ['fq', 'paired', 'known', 'http://example.com/k1.fq,http://example.com/k2.fq']
+        known_sizes = {'http://example.com/k1.fq': 60, 'http://example.com/k2.fq': 60}
+        samples = order_by_size([small, large, missing, known], '1K', known_sizes)
+        # Inputs whose size isn't found count as max-sample-size, and known sizes aren't looked up again
+        self.assertEqual([x[2] for x in samples], ['missing', 'large', 'known', 'small'])
+        self.assertEqual([x[4] for x in samples], [',1', '100,100', '60,60', '10,10'])
+        self.assertEqual(samples[1][:4], large)
+
+    def tarball(self, uuid):
+        path = os.path.join(self.work_dir, uuid + '.tar.gz')
+        with tarfile.open(path, 'w:gz') as f:
+            f.add(self.url('{}.tsv'.format(uuid), 10000)[len('file://'):], arcname='{}/results.tsv'.format(uuid))
+        return path
+
+    def test_find_completed(self):
+        samples = [['fq', 'paired', x, 'file:///{}.fq'.format(x)] for x in ['done', 'pending', 'truncated', 'empty']]
+        self.tarball('done')
+        with open(self.tarball('truncated'), 'r+') as f:
+            f.truncate(os.path.getsize(f.name) // 2)
+        with tarfile.open(os.path.join(self.work_dir, 'empty.tar.gz'), 'w:gz'):
+            pass
+        completed, pending, failed = find_completed(samples, self.work_dir)
+        # Truncated tarballs and tarballs without members are rerun
+        self.assertEqual([x[2] for x in completed], ['done'])
+        self.assertEqual([x[2] for x in pending], ['pending'])
+        self.assertEqual([x[2] for x in failed], ['truncated', 'empty'])
+
+    def test_find_completed_s3(self):
+        samples = [['fq', 'paired', x, 'file:///{}.fq'.format(x)] for x in ['done', 'pending', 'empty']]
+        listing, preflight.s3_listing = preflight.s3_listing, lambda x: {'done.tar.gz': 100, 'empty.tar.gz': 0}
+        try:
+            completed, pending, failed = find_completed(samples, 's3://bucket/output/')
+        finally:
+            preflight.s3_listing = listing
+        self.assertEqual([[x[2] for x in y] for y in [completed, pending, failed]], [['done'], ['pending'], ['empty']])
@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools import hera_version
+from toil_rnaseq.tools import profiling
+from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools.execution import backends_variable
+from toil_rnaseq.tools.execution import set_backends
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.resources import fit_model
+from toil_rnaseq.utils.resources import read_history
+
+# Stand-in for a natively installed samtools that holds 1 MB of temporary files while it runs
+fake_samtools = """#!/bin/bash
+head -c 1048576 /dev/zero > "$2.tmp"
+sleep 0.5
+rm "$2.tmp"
+"""
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bin_dir = tempfile.mkdtemp()
+        path = os.path.join(self.bin_dir, 'samtools')
+        with open(path, 'w') as f:
+            f.write(fake_samtools)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.environ = os.environ['PATH'], os.environ.get(backends_variable)
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        set_backends({'samtools': 'native'})
+        self.interval, profiling.sample_interval = profiling.sample_interval, 0.05
+        self.messages = []
+        self.job = Expando(log=self.messages.append)
+
+    def tearDown(self):
+        os.environ['PATH'], backends = self.environ
+        if backends is None:
+            del os.environ[backends_variable]
+        else:
+            os.environ[backends_variable] = backends
+        profiling.sample_interval = self.interval
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.bin_dir)
+
+    def test_stage(self):
+        profiling.profile_stage(self.job, 'sort', 1000)
+        profiling.docker_call(self.job, tool=samtools_version, parameters=['sort', '/data/a.bam'],
+                              workDir=self.work_dir)
+        record = profiling.records(self.job)[0]
+        self.assertEqual((record['tool'], record['input_bytes'], record['backend']), ('sort', 1000, 'native'))
+        # Temporary files removed before the tool exits count towards its peak disk
+        self.assertGreaterEqual(record['disk'], 1048576)
+
+        # The record logged by the job can be fitted from the workflow's log
+        log = os.path.join(self.work_dir, 'toil.log')
+        with open(log, 'w') as f:
+            f.writelines('INFO Got message from job at time 01-01-2024 00:00:00: {}\n'.format(x)
+                         for x in self.messages * 3)
+        self.assertEqual(read_history([log]), [json.loads(json.dumps(record))] * 3)
+        self.assertIn('sort', fit_model(read_history([log])))
+
+    def test_no_stage(self):
+        profiling.docker_call(self.job, tool=samtools_version, parameters=['index', '/data/a.bam'],
+                              workDir=self.work_dir)
+        record = profiling.records(self.job)[0]
+        self.assertEqual((record['tool'], record['input_bytes']), ('samtools', None))
+        self.assertEqual(fit_model([record] * 3), {})
+
+    def test_record_as(self):
+        profiling.docker_call(self.job, tool=samtools_version, parameters=['index', '/data/a.bam'],
+                              workDir=self.work_dir, record_as=hera_version)
+        record = profiling.records(self.job)[0]
+        # The call runs with its own image's backend but is written with the profile of the image it's recorded as
+        self.assertEqual((record['tool'], record['image'], record['backend']), ('hera', hera_version, 'native'))
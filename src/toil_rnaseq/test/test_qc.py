@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools import bamqc_version
+from toil_rnaseq.tools import profiling
+from toil_rnaseq.tools import qc
+from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools import star_version
+from toil_rnaseq.tools.execution import backends_variable
+from toil_rnaseq.tools.execution import set_backends
+from toil_rnaseq.tools.qc import bamqc
+from toil_rnaseq.utils.expando import Expando
+
+
+class BamQCProfileTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bin_dir = tempfile.mkdtemp()
+        path = os.path.join(self.bin_dir, 'samtools')
+        with open(path, 'w') as f:
+            f.write('#!/bin/bash\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.environ = os.environ['PATH'], os.environ.get(backends_variable)
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        set_backends({'samtools': 'native'})
+        self.functions = qc.docker_call, profiling.sample_interval
+        profiling.sample_interval = 0.05
+
+        # Each tool of the job runs as a native samtools, profiled under its own image
+        def docker_call(job, tool, parameters=None, workDir=None, **kwargs):
+            for name in ['readDist.txt', 'bam_umend_qc.tsv', 'bam_umend_qc.json']:
+                open(os.path.join(workDir, name), 'w').close()
+            self.call(job, tool)
+        qc.docker_call = docker_call
+
+    def tearDown(self):
+        os.environ['PATH'], backends = self.environ
+        if backends is None:
+            del os.environ[backends_variable]
+        else:
+            os.environ[backends_variable] = backends
+        qc.docker_call, profiling.sample_interval = self.functions
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.bin_dir)
+
+    def call(self, job, image):
+        profiling.docker_call(job, tool=samtools_version, parameters=['view'], workDir=self.work_dir,
+                              record_as=image)
+
+    def test_colocated_profile(self):
+        # Profiles are kept by id(job), so the job outlives the test for its records not to be another job's
+        self.job = Expando(log=lambda message: None)
+        profiling.profile_stage(self.job, 'star-colocated', 1000)
+        self.call(self.job, star_version)
+        bamqc(self.job, os.path.join(self.work_dir, 'rnaAligned.out.bam'), Expando(uuid='sample'))
+        # BamQC run within the STAR job writes only its own record, STAR's is written to STAR's tarball
+        with tarfile.open(os.path.join(self.work_dir, 'bam_qc.tar')) as tar:
+            profile = json.load(tar.extractfile('profile.json'))
+        self.assertEqual([x['image'] for x in profile], [bamqc_version])
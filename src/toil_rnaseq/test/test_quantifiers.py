@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import yaml
+from toil.fileStore import FileID
+from toil.job import Job
+
+from toil_rnaseq import toil_rnaseq as rnaseq
+from toil_rnaseq.tools import quantifiers
+from toil_rnaseq.tools.quantifiers import bootstrap_options
+from toil_rnaseq.tools.quantifiers import run_hera
+from toil_rnaseq.tools.quantifiers import run_kallisto
+from toil_rnaseq.tools.quantifiers import run_kallisto_batch
+from toil_rnaseq.tools.quantifiers import run_quantifiers
+from toil_rnaseq.utils import generate_config
+from toil_rnaseq.utils import optional_defaults
+from toil_rnaseq.utils import rexpando
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.policy import load_curves
+from toil_rnaseq.utils.resources import load_model
+
+
+class FakeJob(object):
+
+    def __init__(self, work_dir, events, cores=4):
+        self.tempDir = work_dir
+        self.fileStore = self
+        self.events = events
+        self.cores = cores
+
+    def log(self, message):
+        pass
+
+    def readGlobalFile(self, file_id, path):
+        self.events.append(('read', str(file_id)))
+        with open(path, 'w') as f:
+            f.write(str(file_id))
+        return path
+
+    def writeGlobalFile(self, path):
+        return os.path.basename(os.path.dirname(path))
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.tempDir)
+
+
+class BatchKallistoTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.functions = quantifiers.download_url, quantifiers.kallisto
+        self.events = []
+
+        def kallisto(job, work_dir, index_path, r1_path, r2_path=None, output_dir=None, **kwargs):
+            with open(r1_path) as f:
+                name = f.read()
+            self.events.append(('start', name))
+            time.sleep(0.2)
+            self.events.append(('end', name))
+            return os.path.join(output_dir, 'kallisto.tar.gz')
+        quantifiers.download_url = lambda url, name, work_dir: os.path.join(work_dir, name)
+        quantifiers.kallisto = kallisto
+
+    def tearDown(self):
+        quantifiers.download_url, quantifiers.kallisto = self.functions
+        shutil.rmtree(self.work_dir)
+
+    def test_prefetch(self):
+        samples = [(FileID('a1', 4), FileID('a2', 4)), (FileID('b1', 4), None), (FileID('c1', 4), FileID('c2', 4))]
+        job = FakeJob(self.work_dir, self.events)
+        self.assertEqual(run_kallisto_batch(job, samples, 'file:///kallisto.idx'), ['sample0', 'sample1', 'sample2'])
+        # Samples are quantified in order, each one's fastqs read while the previous sample quantifies
+        self.assertEqual([x for x in self.events if x[0] == 'start'], [('start', 'a1'), ('start', 'b1'),
+                                                                      ('start', 'c1')])
+        self.assertLess(self.events.index(('read', 'b1')), self.events.index(('end', 'a1')))
+        self.assertLess(self.events.index(('read', 'c2')), self.events.index(('end', 'b1')))
+        # Work directories are removed once a sample's output is written
+        self.assertEqual(os.listdir(self.work_dir), [])
+
+
+class CacheKeyTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.functions = quantifiers.fetch, quantifiers.fastqc, quantifiers.kallisto, quantifiers.download_url
+        self.keys = []
+
+        def fetch(cache, key, work_dir):
+            self.keys.append(key)
+            return {'output.tar.gz': os.path.join(work_dir, 'output.tar.gz')}
+        quantifiers.fetch = fetch
+        quantifiers.fastqc = lambda job, work_dir, r1_path, r2_path: 'fastqc.tar.gz'
+        quantifiers.download_url = lambda url, name, work_dir: os.path.join(work_dir, name)
+        self.config = Expando(cache=Expando(path=self.work_dir), kallisto_index='file:///kallisto.idx',
+                              hera_index='file:///hera.tar.gz', kallisto_bootstraps=0, hera_bootstraps=30,
+                              summarize_bootstraps=True, keep_bootstraps=False)
+        self.r1, self.r2 = FileID('a1', 4), FileID('a2', 4)
+
+    def tearDown(self):
+        quantifiers.fetch, quantifiers.fastqc, quantifiers.kallisto, quantifiers.download_url = self.functions
+        shutil.rmtree(self.work_dir)
+
+    def job(self):
+        work_dir = tempfile.mkdtemp(dir=self.work_dir)
+        return FakeJob(work_dir, [])
+
+    def test_colocated_keys(self):
+        for tool, run in [('kallisto', run_kallisto), ('hera', run_hera)]:
+            run(self.job(), self.r1, self.r2, self.config[tool + '_index'], cache=self.config.cache,
+                bootstraps=bootstrap_options(self.config, tool))
+        outputs = run_quantifiers(self.job(), self.r1, self.r2, self.config, ['fastqc', 'kallisto', 'hera'])
+        self.assertEqual(sorted(outputs), ['fastqc', 'hera', 'kallisto'])
+        # Running the quantifiers together reuses the cache entries of running each alone, and FastQC isn't cached
+        self.assertEqual(len(self.keys), 4)
+        self.assertEqual(sorted(self.keys[:2]), sorted(self.keys[2:]))
+        self.assertNotEqual(self.keys[0], self.keys[1])
+
+    def test_no_cache(self):
+        self.config.cache = None
+        quantifiers.kallisto = lambda job, work_dir, *args, **kwargs: os.path.join(work_dir, 'kallisto.tar.gz')
+        self.assertEqual(run_quantifiers(self.job(), self.r1, None, self.config, ['kallisto']),
+                         {'kallisto': 'kallisto'})
+        self.assertEqual(self.keys, [])
+
+
+class BatchWorkflowTest(TestCase):
+
+    def test_kallisto_waits_for_preprocessing(self):
+        config = rexpando(yaml.safe_load(generate_config()))
+        for option, default in optional_defaults.iteritems():
+            config.setdefault(option, default)
+        config.update(output_dir='/tmp/output', kallisto_index='file:///kallisto.idx', maxCores=4, cache=None,
+                      hugo_table_id=None, resources=load_model(None), scaling=load_curves(None))
+        samples = [['fq', 'paired', 'sample{}'.format(i), 'file:///R1.fastq,file:///R2.fastq'] for i in xrange(3)]
+        root = Job()
+        rnaseq.batch_workflow(root, samples, config)
+
+        preprocessing = [x.encapsulatedFollowOn for x in root._children]
+        self.assertEqual(len(preprocessing), 3)
+        kallisto = [x for x in preprocessing[0]._children if len(x._directPredecessors) > 1]
+        # One Kallisto job for the batch, started once every sample is preprocessed and not after any sample's jobs
+        self.assertEqual(len(kallisto), 1)
+        self.assertEqual(kallisto[0]._directPredecessors, set(preprocessing))
+        for x in preprocessing[1:]:
+            self.assertIn(kallisto[0], x._children)
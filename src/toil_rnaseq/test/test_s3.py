@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from toil_rnaseq.utils import s3
+from toil_rnaseq.utils.s3 import s3_writer
+from toil_rnaseq.utils.s3 import sse_headers
+from toil_rnaseq.utils.s3 import sse_key
+from toil_rnaseq.utils.s3 import upload_file
+
+
+class FakeBucket(object):
+    """
+    Stand-in for a boto Bucket that keeps objects in memory. Parts listed in `failures` fail that many times.
+    """
+
+    def __init__(self, failures=None):
+        self.objects, self.headers = {}, {}
+        self.failures = dict(failures or {})
+        self.cancelled = 0
+        self.lock = threading.Lock()
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def initiate_multipart_upload(self, name, headers=None):
+        return FakeMultiPartUpload(self, name, headers)
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name):
+        self.bucket, self.name = bucket, name
+
+    def set_contents_from_string(self, data, headers=None):
+        self.bucket.objects[self.name] = data
+        self.bucket.headers[self.name] = headers
+
+
+class FakeMultiPartUpload(object):
+
+    def __init__(self, bucket, name, headers):
+        self.bucket, self.name, self.headers = bucket, name, headers
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num, headers=None, size=None):
+        assert headers == self.headers
+        with self.bucket.lock:
+            if self.bucket.failures.get(part_num):
+                self.bucket.failures[part_num] -= 1
+                raise IOError('Connection reset')
+        self.parts[part_num] = fp.read(size)
+
+    def complete_upload(self):
+        self.bucket.objects[self.name] = ''.join(self.parts[x] for x in sorted(self.parts))
+        self.bucket.headers[self.name] = self.headers
+
+    def cancel_upload(self):
+        self.bucket.cancelled += 1
+
+
+class S3Test(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.part_size, self.retry_delay = s3.part_size, s3.retry_delay
+        s3.part_size, s3.retry_delay = 10, 0
+        self.data = ''.join(chr(x % 256) for x in xrange(95))
+        self.path = os.path.join(self.work_dir, 'sample.tar.gz')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        s3.part_size, s3.retry_delay = self.part_size, self.retry_delay
+        shutil.rmtree(self.work_dir)
+
+    def test_small_file(self):
+        bucket = FakeBucket()
+        s3.part_size = 1000
+        upload_file(self.path, 's3://bucket/dir/sample.tar.gz', bucket=bucket)
+        self.assertEqual(bucket.objects['dir/sample.tar.gz'], self.data)
+
+    def test_multipart_with_retries(self):
+        bucket = FakeBucket(failures={2: 1, 7: 2})
+        upload_file(self.path, 's3://bucket/sample.tar.gz', num_slots=3, bucket=bucket)
+        self.assertEqual(bucket.objects['sample.tar.gz'], self.data)
+
+    def test_failed_part_cancels_upload(self):
+        bucket = FakeBucket(failures={3: s3.part_attempts})
+        self.assertRaises(IOError, upload_file, self.path, 's3://bucket/sample.tar.gz', bucket=bucket)
+        self.assertNotIn('sample.tar.gz', bucket.objects)
+        self.assertEqual(bucket.cancelled, 1)
+
+    def test_sse_c(self):
+        key_path = os.path.join(self.work_dir, 'master.key')
+        with open(key_path, 'wb') as f:
+            f.write('k' * 32)
+        bucket = FakeBucket()
+        upload_file(self.path, 's3://bucket/sample.tar.gz', s3_key_path=key_path, bucket=bucket)
+        key = sse_key(key_path, 's3://bucket/sample.tar.gz')
+        self.assertEqual(len(key), 32)
+        self.assertNotEqual(key, sse_key(key_path, 's3://bucket/other.tar.gz'))
+        self.assertEqual(bucket.headers['sample.tar.gz'], sse_headers(key))
+
+    def test_writer(self):
+        bucket = FakeBucket()
+        with s3_writer('s3://bucket/sample.tar.gz', bucket=bucket) as f:
+            for i in xrange(0, len(self.data), 7):
+                f.write(self.data[i:i + 7])
+        self.assertEqual(bucket.objects['sample.tar.gz'], self.data)
+
+    def test_writer_failure_uploads_nothing(self):
+        bucket = FakeBucket()
+        with self.assertRaises(ValueError):
+            with s3_writer('s3://bucket/sample.tar.gz', bucket=bucket) as f:
+                f.write(self.data)
+                raise ValueError('Compression failed')
+        self.assertEqual(bucket.objects, {})
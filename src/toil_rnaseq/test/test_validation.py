@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from unittest import TestCase
+
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.validation import check_url
+from toil_rnaseq.utils.validation import validate_inputs
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves the current directory, refusing anything under /private"""
+
+    def send_head(self):
+        if self.path.startswith('/private'):
+            self.send_error(403)
+            return None
+        return SimpleHTTPRequestHandler.send_head(self)
+
+    def log_message(self, *args):
+        pass
+
+
+class ValidationTest(TestCase):
+    """
+    Checks local stand-ins for remote inputs: file:// URLs and an HTTP server on localhost
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for name in ['R1.fastq.gz', 'R2.fastq.gz', 'index.tar.gz']:
+            with open(os.path.join(self.work_dir, name), 'w') as f:
+                f.write('x' * 100)
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        self.server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.http = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.config = Expando(star_index=self.http + 'index.tar.gz', rsem_ref=None, kallisto_index=None,
+                              hera_index=None, genome_fasta=None, gdc_token=None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_file(self):
+        result = check_url('file://' + os.path.join(self.work_dir, 'R1.fastq.gz'))
+        self.assertEqual((result['status'], result['size']), ('ok', 100))
+        result = check_url('file://' + os.path.join(self.work_dir, 'missing.fastq.gz'))
+        self.assertEqual(result['status'], 'missing')
+
+    def test_http(self):
+        result = check_url(self.http + 'R1.fastq.gz')
+        self.assertEqual((result['status'], result['size']), ('ok', 100))
+        self.assertEqual(check_url(self.http + 'missing.fastq.gz')['status'], 'missing')
+        self.assertEqual(check_url(self.http + 'private/R1.fastq.gz')['status'], 'forbidden')
+
+    def test_validate_inputs(self):
+        samples = [['fq', 'paired', 'sample-1', self.http + 'R1.fastq.gz,' + self.http + 'R2.fastq.gz'],
+                   ['fq', 'single', 'sample-2', 'file://' + os.path.join(self.work_dir, 'missing.fastq.gz')]]
+        cache_path = os.path.join(self.work_dir, 'cache.json')
+        results = validate_inputs(samples, self.config, cache_path=cache_path, rate=None)
+        self.assertEqual([(x['source'], x['status']) for x in results],
+                         [('star-index', 'ok'), ('sample-1', 'ok'), ('sample-1', 'ok'), ('sample-2', 'missing')])
+
+        # Successful remote checks are cached and reused once the server is gone
+        with open(cache_path) as f:
+            self.assertEqual(len(json.load(f)), 3)
+        self.server.shutdown()
+        results = validate_inputs(samples[:1], self.config, cache_path=cache_path, rate=None)
+        self.assertEqual([x['status'] for x in results], ['ok', 'ok', 'ok'])
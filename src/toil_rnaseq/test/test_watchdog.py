@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_rnaseq.tools.watchdog import Watchdog
+from toil_rnaseq.tools.watchdog import star_progress
+from toil_rnaseq.utils.expando import Expando
+
+# Header and first rows of a STAR Log.progress.out
+progress_log = """\
+           Time    Speed        Read     Read   Mapped   Mapped   Mapped   Mapped Unmapped Unmapped Unmapped Unmapped
+                    M/hr      number   length   unique   length   MMrate    multi   multi+       MM    short    other
+Jan 17 10:36:32     60.7     1011584      202    92.5%    201.6     0.3%     2.5%     0.0%     0.0%     4.7%     0.2%
+Jan 17 10:37:32     61.2     2034816      202    92.4%    201.6     0.3%     2.5%     0.0%     0.0%     4.8%     0.2%
+"""
+
+
+class WatchdogTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, text):
+        with open(os.path.join(self.work_dir, name), 'w') as f:
+            f.write(text)
+
+    def test_star_progress(self):
+        self.assertIsNone(star_progress(self.work_dir))
+        self.write('rnaLog.out', 'Jan 17 10:35:30 ..... started mapping\n')
+        self.write('rnaLog.progress.out', progress_log)
+        self.assertEqual(star_progress(self.work_dir), 2034816)
+        # Sorting the BAM after mapping reports no progress, and isn't a stall
+        self.write('rnaLog.out', 'Jan 17 10:35:30 ..... started mapping\nJan 17 11:02:11 ..... finished mapping\n')
+        self.assertIsNone(star_progress(self.work_dir))
+
+    def test_stall(self):
+        reads, messages, stops = [0], [], []
+        watchdog = Watchdog(messages.append, 'STAR', lambda: reads[0],
+                            Expando(min_rate=1000, stall_seconds=300, retries=1))
+        watchdog.stop_tool = lambda: stops.append(True)
+        for minute, count in enumerate([0, 600000, 1200000, 1210000, 1220000, 1230000, 1240000, 1250000]):
+            reads[0] = count
+            watchdog.check(minute * 60.0)
+        self.assertIn('STAR: 600,000 reads, 10,000 reads/s', messages)
+        # Five minutes after the rate dropped to 167 reads per second, STAR is stopped once
+        self.assertTrue(watchdog.stalled)
+        self.assertEqual(stops, [True])
+        self.assertIn('STAR stalled: 167 reads/s over the last 5 minutes, below 1,000 reads/s', messages)
+
+    def test_report_only(self):
+        watchdog = Watchdog(lambda x: None, 'STAR', lambda: 100, Expando(min_rate=1000, stall_seconds=60, retries=0))
+        watchdog.stop_tool = lambda: self.fail('Stopped without retries')
+        for second in [0.0, 60.0, 120.0]:
+            watchdog.check(second)
+        self.assertTrue(watchdog.stalled)
+        self.assertFalse(watchdog.stopped)
@@ -3,9 +3,12 @@ from __future__ import print_function
 
 # Standard imports
 import argparse
+import json
 import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
 
 # Non-standard imports
 import yaml
@@ -14,30 +17,66 @@ from toil.job import Job, PromisedRequirement
 
 # Local imports
 from tools.aligners import run_star
+from tools.benchmark import benchmark
+from tools.benchmark import thread_counts
 from tools.bams import sort_and_save_bam
+from tools.execution import set_backends
+from tools.execution import tool_backend
+from tools.images import format_pulls
+from tools.images import pull_images
+from tools.images import pull_threads
+from tools.images import required_images
+from tools.images import warm_up
 from tools.jobs import cleanup_ids
 from tools.jobs import consolidate_output
 from tools.jobs import map_job
 from tools.jobs import save_wiggle
-from tools.preprocessing import download_and_process_bam
-from tools.preprocessing import download_and_process_fastqs
-from tools.preprocessing import download_and_process_tar
+from tools.jobs import store_samples
+from tools.preprocessing import preprocess
 from tools.qc import run_bamqc
 from tools.qc import run_fastqc
+from tools.quantifiers import bootstrap_options
 from tools.quantifiers import run_hera
 from tools.quantifiers import run_kallisto
+from tools.quantifiers import run_kallisto_batch
+from tools.quantifiers import run_quantifiers
 from tools.quantifiers import run_rsem
 from tools.quantifiers import run_rsem_gene_mapping
+from tools.watchdog import watchdog_options
 from utils import UserError, rexpando
 from utils import configuration_sanity_checks
 from utils import generate_config
+from utils.expando import Expando
 from utils import generate_manifest
 from utils import parse_samples
 from utils import require
 from utils import user_input_config
 from utils import user_input_manifest
+from utils.cache import cache_location
 from utils.files import generate_file
+from utils.files import open_output
+from utils.hugo import import_mapping
+from utils.matrix import add_tarball
+from utils.matrix import export_table
+from utils.matrix import load_matrix
+from utils.matrix import tables
+from utils.matrix import value_columns
 from utils.filesize import human2bytes
+from utils.policy import allocate_cores
+from utils.planner import format_plan
+from utils.planner import plan_run
+from utils.policy import load_curves
+from utils.policy import node_memory
+from utils.preflight import find_completed
+from utils.preflight import order_by_size
+from utils.preflight import sample_sizes
+from utils.resources import fit_model
+from utils.resources import load_model
+from utils.resources import predict
+from utils.resources import read_history
+from utils.resources import save_model
+from utils.validation import format_failures
+from utils.validation import validate_inputs
 
 
 def workflow(job, sample, config):
@@ -45,113 +84,238 @@ def workflow(job, sample, config):
     Creates workflow graph for each sample based on configuration options
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
-    :param list(str, str, str, str) sample: Sample information - filetype, paired/unpaired, UUID, and URL
+    :param list(str) sample: Sample information - filetype, paired/unpaired, UUID, URL, and optionally the
+        size of each URL found during pre-flight
     :param Expando config: Dict-like object containing workflow options as attributes
     """
-    # Create copy of config to store sample-specific information
-    config = config.copy()
-    config.file_type, config.paired, config.uuid, config.url = sample
-    config.paired = True if config.paired == 'paired' else False
-    config.cores = min(config.maxCores, multiprocessing.cpu_count())
+    config = sample_config(sample, config)
+
+    # Pull the sample's images on this node before its tool jobs are scheduled
+    if config.warm_up_images:
+        warm_up(job, config, [sample])
 
     # Download and process input based on file type
     # `inputs` will return the FileStoreID(s) of the R1 / R2 fastq
-    if config.file_type == 'bam':
-        disk = '2G' if config.ci_test else config.max_sample_size
-        disk = human2bytes(disk) * 5
-        inputs = job.wrapJobFn(download_and_process_bam, config, disk=disk).encapsulate()
-
-    elif config.file_type == 'tar':
-        inputs = job.wrapJobFn(download_and_process_tar, config).encapsulate()
-
-    else:
-        config.gz = True if config.url.split(',')[0].endswith('gz') else None  # Check if fastqs are gzipped
-        inputs = job.wrapJobFn(download_and_process_fastqs, config).encapsulate()
+    inputs = job.wrapJobFn(preprocess, config).encapsulate()
 
     # Add inputs as first child to root job
     job.addChild(inputs)
+    output = sample_jobs(job, config, inputs)
+
+    # Cleanup and Consolidate
+    job.addFollowOnJobFn(cleanup_ids, [inputs.rv(0), inputs.rv(1)])
+    job.addFollowOnJobFn(consolidate_output, config, output, cores=allocate_cores(config, 'consolidate'))
+
+
+def sample_config(sample, config):
+    """
+    Copy of the config holding a sample's information
+
+    :param list(str) sample: Sample information - filetype, paired/unpaired, UUID, URL, and optionally the
+        size of each URL found during pre-flight
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :rtype: Expando
+    """
+    config = config.copy()
+    config.file_type, config.paired, config.uuid, config.url = sample[:4]
+    config.url_sizes = sample[4] if len(sample) > 4 else None
+    config.paired = True if config.paired == 'paired' else False
+    config.cores = min(config.maxCores, multiprocessing.cpu_count())
+    config.node_memory = node_memory()
+    return config
+
 
-    # Define preliminary disk and create dictionary for storing output
-    disk = PromisedRequirement(lambda xs: sum(x.size for x in xs if x) + human2bytes('2G'), inputs.rv())
-    cores = min(16, config.cores) if config.cores >= 32 else config.cores  # Core optimization
-    output = {}
+def sample_jobs(job, config, inputs, kallisto_id=None):
+    """
+    Wires the jobs that process a sample's fastqs as successors of the job that preprocesses them
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Sample's config, from `sample_config`
+    :param Job inputs: Job returning the FileStoreID(s) of the R1 / R2 fastq
+    :param Promise kallisto_id: Kallisto output of the sample, if it is quantified by a batch Kallisto job
+    :return: Output FileStoreIDs keyed by their location in the consolidated output
+    :rtype: dict(str, Promise)
+    """
+    batch = kallisto_id is not None
+    model = config.resources
+
+    # Create dictionary for storing output
+    # Requirements are predicted from the size of each job's input by the resource model
+    output = {'Kallisto': kallisto_id} if batch else {}
 
     # DAG wiring for remainder of workflow
+    # FastQC, Kallisto, and Hera can share one job that reads the fastqs once
+    colocated = [tool for tool, enabled in [('fastqc', config.fastqc),
+                                            ('kallisto', config.kallisto_index and not batch),
+                                            ('hera', config.hera_index)] if enabled]
+    colocated = colocated if config.colocate_quantifiers and len(colocated) > 1 else []
+    if colocated:
+        disk = PromisedRequirement(lambda xs: predict(model, 'quantifiers', 'disk', sum(x.size for x in xs if x)),
+                                   inputs.rv())
+        quantifiers = job.wrapJobFn(run_quantifiers, r1_id=inputs.rv(0), r2_id=inputs.rv(1), config=config,
+                                    tools=colocated, cores=allocate_cores(config, 'quantifiers'), disk=disk)
+        inputs.addChild(quantifiers)
+        names = {'fastqc': 'QC/fastQC', 'kallisto': 'Kallisto', 'hera': 'Hera'}
+        for tool in colocated:
+            output[names[tool]] = quantifiers.rv(tool)
+
     # FASTQC
-    if config.fastqc:
-        fastqc = job.wrapJobFn(run_fastqc, r1_id=inputs.rv(0), r2_id=inputs.rv(1), cores=2, disk=disk)
+    if config.fastqc and 'fastqc' not in colocated:
+        disk = PromisedRequirement(lambda xs: predict(model, 'fastqc', 'disk', sum(x.size for x in xs if x)),
+                                   inputs.rv())
+        fastqc = job.wrapJobFn(run_fastqc, r1_id=inputs.rv(0), r2_id=inputs.rv(1),
+                               cores=allocate_cores(config, 'fastqc'), disk=disk)
         inputs.addChild(fastqc)
         output['QC/fastQC'] = fastqc.rv()
 
     # Kallisto
-    if config.kallisto_index:
+    if config.kallisto_index and not batch and 'kallisto' not in colocated:
+        disk = PromisedRequirement(lambda xs: predict(model, 'kallisto', 'disk', sum(x.size for x in xs if x)),
+                                   inputs.rv())
         kallisto = job.wrapJobFn(run_kallisto, r1_id=inputs.rv(0), r2_id=inputs.rv(1),
-                                 kallisto_index_url=config.kallisto_index, cores=cores, disk=disk)
+                                 kallisto_index_url=config.kallisto_index, cache=config.cache,
+                                 bootstraps=bootstrap_options(config, 'kallisto'),
+                                 cores=allocate_cores(config, 'kallisto'), disk=disk)
         inputs.addChild(kallisto)
         output['Kallisto'] = kallisto.rv()
 
     # Hera
-    if config.hera_index:
+    if config.hera_index and 'hera' not in colocated:
+        disk = PromisedRequirement(lambda xs: predict(model, 'hera', 'disk', sum(x.size for x in xs if x)),
+                                   inputs.rv())
         hera = job.wrapJobFn(run_hera, r1_id=inputs.rv(0), r2_id=inputs.rv(1),
-                             hera_index_url=config.hera_index, cores=config.cores, disk=disk)
+                             hera_index_url=config.hera_index, cache=config.cache,
+                             bootstraps=bootstrap_options(config, 'hera'),
+                             cores=allocate_cores(config, 'hera'), disk=disk)
         inputs.addChild(hera)
         output['Hera'] = hera.rv()
 
     # STAR and RSEM
     if config.star_index and config.rsem_ref:
+        # In co-located mode BamQC and saving the aligned BAM / wiggle run within the STAR job,
+        # so post-alignment outputs (sorted / duplicate-marked BAMs) share the STAR job's disk
+        colocate = config.colocate_post_alignment and any([config.bamqc, config.save_bam, config.wiggle])
+        star_tool = 'star-colocated' if colocate else 'star'
+        # When fused, RSEM's reference shares the STAR job's disk, while the transcriptome BAM is streamed.
+        # RSEM runs alongside STAR, so the job has RSEM's cores on top of STAR's
+        rsem_disk = predict(model, 'rsem', 'disk') if config.fuse_star_rsem else 0
+        rsem_cores = allocate_cores(config, 'rsem') if config.fuse_star_rsem else 0
+        # Jobs saving a CRAM also hold the genome FASTA and the CRAM. The colocated STAR prior already counts the BAMs
+        cram = config.save_bam and config.save_bam_format == 'cram'
+        star_cram_disk = predict(model, 'cram', 'disk') if cram and colocate else 0
         if config.ci_test:
             disk = '2G'
             mem = '2G'
+            cores = min(config.cores, allocate_cores(config, star_tool, mem) + rsem_cores)
         else:
-            disk = PromisedRequirement(lambda xs: sum(x.size for x in xs if x) + human2bytes('50G'), inputs.rv())
-            mem = '40G'
-
-        # STAR returns: transcriptome_id, star_id, aligned_id, wiggle_id
+            disk = PromisedRequirement(lambda xs: predict(model, star_tool, 'disk', sum(x.size for x in xs if x)) +
+                                       rsem_disk + star_cram_disk, inputs.rv())
+            mem = PromisedRequirement(lambda xs: predict(model, star_tool, 'memory', sum(x.size for x in xs if x)),
+                                      inputs.rv())
+            # Cores depend on how many STAR jobs fit in the node's memory
+            cores = PromisedRequirement(lambda xs: min(config.cores, rsem_cores + allocate_cores(
+                config, star_tool, predict(model, star_tool, 'memory', sum(x.size for x in xs if x)))), inputs.rv())
+
+        # STAR returns: transcriptome_id, star_id, aligned_id, wiggle_id, bamqc_id, followed by RSEM's outputs if fused
         sort = True if config.wiggle else False
-        save_bam = any([config.save_bam, config.bamqc])
+        save_bam = any([config.save_bam, config.bamqc]) and not colocate
+        rsem_options = Expando(ref_url=config.rsem_ref, paired=config.paired, hugo_table_id=config.hugo_table_id,
+                               cores=rsem_cores)
         star = job.wrapJobFn(run_star, inputs.rv(0), inputs.rv(1), star_index_url=config.star_index,
                              wiggle=config.wiggle, sort=sort, save_aligned_bam=save_bam,
-                             cores=config.cores, memory=mem, disk=disk)
+                             config=config if colocate else None, cache=config.cache,
+                             rsem_options=rsem_options if config.fuse_star_rsem else None,
+                             watchdog=watchdog_options(config),
+                             cores=cores, memory=mem, disk=disk)
+        # A stalled STAR is retried by a child of its job, whose outputs its successors must wait for
+        if config.watchdog_retries:
+            star = star.encapsulate()
         inputs.addChild(star)
         output['QC/STAR'] = star.rv(1)
 
         # BamQC
-        if config.bamqc:
-            cores = min(4, config.cores)
-            disk = PromisedRequirement(lambda x: x.size, star.rv(2))
-            bamqc = job.wrapJobFn(run_bamqc, aligned_bam_id=star.rv(2), config=config,
-                                  save_bam=config.save_bam, disk=disk, cores=cores)
+        if config.bamqc and colocate:
+            output['QC/BamQC'] = star.rv(4)
+        elif config.bamqc:
+            disk = PromisedRequirement(lambda x: predict(model, 'bamqc', 'disk', x.size) +
+                                       (predict(model, 'cram', 'disk', x.size) if cram else 0), star.rv(2))
+            bamqc = job.wrapJobFn(run_bamqc, aligned_bam_id=star.rv(2), config=config, save_bam=config.save_bam,
+                                  disk=disk, cores=allocate_cores(config, 'bamqc'))
             star.addChild(bamqc)
             output['QC/BamQC'] = bamqc.rv()
 
         # Handle optional files user can save
         # Note: if bamqc is enabled, the bam is saved within the `run_bamqc` job
-        if config.save_bam and not config.bamqc:
-            disk = PromisedRequirement(lambda x: x.size, star.rv(2))
+        if config.save_bam and not config.bamqc and not colocate:
+            disk = PromisedRequirement(lambda x: predict(model, 'sort', 'disk', x.size) +
+                                       (predict(model, 'cram', 'disk', x.size) if cram else 0), star.rv(2))
             star.addChildJobFn(sort_and_save_bam, config, bam_id=star.rv(2), skip_sort=sort, disk=disk)
-        if config.wiggle:
-            disk = PromisedRequirement(lambda x: x.size, star.rv(3))
+        if config.wiggle and not colocate:
+            disk = PromisedRequirement(lambda x: predict(model, 'wiggle', 'disk', x.size), star.rv(3))
             star.addChildJobFn(save_wiggle, config, wiggle_id=star.rv(3), disk=disk)
 
-        # RSEM returns: gene_id, isoform_id
-        rsem = job.wrapJobFn(run_rsem, bam_id=star.rv(0), rsem_ref_url=config.rsem_ref, paired=config.paired,
-                             cores=cores, disk=PromisedRequirement(lambda x: x.size + human2bytes('20G'), star.rv(0)))
-        star.addChild(rsem)
-
-        # RSEM postprocess returns: rsem_id, rsem_hugo_id
-        rsem_postprocess = job.wrapJobFn(run_rsem_gene_mapping, rsem_gene_id=rsem.rv(0), rsem_isoform_id=rsem.rv(1))
-        rsem.addChild(rsem_postprocess)
-        output['RSEM'] = rsem_postprocess.rv(0)
-        output['RSEM/Hugo'] = rsem_postprocess.rv(1)
+        # RSEM returns: gene_id, isoform_id, profile_id
+        # With a HUGO mapping table, RSEM returns: rsem_id, rsem_hugo_id
+        if config.fuse_star_rsem:
+            rsem = star
+            rsem_ids = [star.rv(5), star.rv(6), star.rv(7)]
+        else:
+            disk = PromisedRequirement(lambda x: predict(model, 'rsem', 'disk', x.size), star.rv(0))
+            rsem = job.wrapJobFn(run_rsem, bam_id=star.rv(0), rsem_ref_url=config.rsem_ref, paired=config.paired,
+                                 cache=config.cache, hugo_table_id=config.hugo_table_id,
+                                 cores=allocate_cores(config, 'rsem'), disk=disk)
+            star.addChild(rsem)
+            rsem.addChildJobFn(cleanup_ids, ids_to_delete=[star.rv(0)])
+            rsem_ids = [rsem.rv(0), rsem.rv(1), rsem.rv(2)]
+        if config.hugo_table_id:
+            output['RSEM'] = rsem_ids[0]
+            output['RSEM/Hugo'] = rsem_ids[1]
+        else:
+            # RSEM postprocess returns: rsem_id, rsem_hugo_id
+            rsem_postprocess = job.wrapJobFn(run_rsem_gene_mapping, rsem_gene_id=rsem_ids[0],
+                                             rsem_isoform_id=rsem_ids[1], rsem_profile_id=rsem_ids[2])
+            rsem.addChild(rsem_postprocess)
+            output['RSEM'] = rsem_postprocess.rv(0)
+            output['RSEM/Hugo'] = rsem_postprocess.rv(1)
+            rsem_postprocess.addChildJobFn(cleanup_ids, ids_to_delete=rsem_ids)
 
         # Cleanup
         star.addFollowOnJobFn(cleanup_ids, ids_to_delete=[star.rv(2), star.rv(3)])
-        rsem.addChildJobFn(cleanup_ids, ids_to_delete=[star.rv(0)])
-        rsem_postprocess.addChildJobFn(cleanup_ids, ids_to_delete=[rsem.rv(0), rsem.rv(1)])
 
-    # Cleanup and Consolidate
-    job.addFollowOnJobFn(cleanup_ids, [inputs.rv(0), inputs.rv(1)])
-    job.addFollowOnJobFn(consolidate_output, config, output)
+    return output
+
+
+def batch_workflow(job, samples, config):
+    """
+    Creates the workflow graph for a batch of samples that share one Kallisto job. The Kallisto job only waits for
+    the batch's preprocessing, and each sample is consolidated once its own jobs and the Kallisto job finish.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list(list(str)) samples: Sample information for each sample in the batch
+    :param Expando config: Dict-like object containing workflow options as attributes
+    """
+    configs = [sample_config(sample, config) for sample in samples]
+    if config.warm_up_images:
+        warm_up(job, configs[0], samples)
+    inputs = [job.wrapJobFn(preprocess, x).encapsulate() for x in configs]
+    for x in inputs:
+        job.addChild(x)
+
+    # Two samples are on disk at once while the next sample is prefetched
+    disk = PromisedRequirement(lambda *xs: predict(config.resources, 'kallisto', 'disk',
+                                                   2 * max(sum(y.size for y in x if y) for x in xs)),
+                               *[x.rv() for x in inputs])
+    kallisto = job.wrapJobFn(run_kallisto_batch, [x.rv() for x in inputs], kallisto_index_url=config.kallisto_index,
+                             bootstraps=bootstrap_options(config, 'kallisto'),
+                             cores=allocate_cores(configs[0], 'kallisto'), disk=disk)
+    for x in inputs:
+        x.addChild(kallisto)
+
+    # Follow-ons of a sample's preprocessing wait for its jobs and for the Kallisto job, a child of every sample's
+    for i, (x, y) in enumerate(zip(inputs, configs)):
+        output = sample_jobs(job, y, x, kallisto_id=kallisto.rv(i))
+        x.addFollowOnJobFn(cleanup_ids, [x.rv(0), x.rv(1)])
+        x.addFollowOnJobFn(consolidate_output, y, output, cores=allocate_cores(y, 'consolidate'))
 
 
 def main():
@@ -191,6 +355,94 @@ def main():
     elif args.command == 'manifest-input':
         user_input_manifest(manifest_path)
 
+    # Refit the resource model from recorded job history
+    elif args.command == 'fit-resources':
+        model = load_model(args.model) if os.path.exists(args.model) else {}
+        model = fit_model(read_history(args.history), model)
+        save_model(model, args.model)
+        print('Resource model for {} tools written to: {}'.format(len(model), args.model))
+
+    # Measure how each tool's runtime scales with threads on this node shape
+    elif args.command == 'benchmark':
+        require(os.path.exists(args.config), '{} not found. Run "toil-rnaseq generate"'.format(args.config))
+        config = configuration_sanity_checks(rexpando(yaml.load(open(args.config).read())))
+        config.resources = load_model(config.resource_model)
+        set_backends(config.tool_backends)
+        # A run can't have more threads than the node has cores
+        cores = min(int(args.maxCores) if args.maxCores else sys.maxint, multiprocessing.cpu_count())
+        threads = args.threads or thread_counts(cores)
+        require(max(threads) <= cores, 'Thread counts above the {} cores available: {}'.format(
+            cores, ', '.join(str(x) for x in threads if x > cores)))
+        with Toil(args) as toil:
+            curves = toil.start(Job.wrapJobFn(benchmark, config, threads, args.num_reads, disk='30G'))
+        with open(args.output, 'w') as f:
+            json.dump(curves, f, indent=2, sort_keys=True)
+        for tool, curve in sorted(curves.iteritems()):
+            print('{}: {}'.format(tool, ', '.join('{} threads {:.0f}s'.format(k, v) for k, v in sorted(curve.items()))))
+        print('Scaling curves written to: {}. Set "scaling-curves" in the config to use them.'.format(args.output))
+
+    # Report what a run would request from the cluster and how long it would take, without running it
+    elif args.command == 'plan':
+        require(os.path.exists(args.manifest), '{} not found. Run "toil-rnaseq generate"'.format(args.manifest))
+        require(os.path.exists(args.config), '{} not found. Run "toil-rnaseq generate"'.format(args.config))
+        samples = parse_samples(args.manifest)
+        config = configuration_sanity_checks(rexpando(yaml.load(open(args.config).read())))
+        config.cores, config.node_memory = args.node_cores, human2bytes(args.node_memory)
+        config.resources = load_model(config.resource_model)
+        config.scaling = load_curves(config.scaling_curves)
+
+        # Samples are planned in the order the run would schedule them
+        if config.order_samples_by_size:
+            samples = order_by_size(samples, config.max_sample_size)
+        else:
+            samples = sample_sizes(samples)
+        plan = plan_run(samples, config, args.nodes, args.node_cores, human2bytes(args.node_memory),
+                        human2bytes(args.node_disk))
+        if args.format == 'json':
+            print(json.dumps(plan, indent=2, sort_keys=True))
+        else:
+            print(format_plan(plan))
+
+    # Check every input URL without running the workflow
+    elif args.command == 'validate':
+        require(os.path.exists(args.manifest), '{} not found. Run "toil-rnaseq generate"'.format(args.manifest))
+        require(os.path.exists(args.config), '{} not found. Run "toil-rnaseq generate"'.format(args.config))
+        samples = parse_samples(args.manifest)
+        config = configuration_sanity_checks(rexpando(yaml.load(open(args.config).read())))
+        results = validate(samples, config, cache_path=args.cache or config.validation_cache)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print('Results of each check written to: {}'.format(args.output))
+
+    # Pull every image the config needs on this node, e.g. when provisioning nodes
+    elif args.command == 'pull-images':
+        require(os.path.exists(args.config), '{} not found. Run "toil-rnaseq generate"'.format(args.config))
+        config = configuration_sanity_checks(rexpando(yaml.load(open(args.config).read())))
+        samples = parse_samples(args.manifest) if args.manifest else None
+        images = [x for x in required_images(config, samples)
+                  if tool_backend(x, config.tool_backends or {}) == 'docker']
+        results = pull_images(images, num_threads=args.threads, docker=args.docker)
+        print(format_pulls(results))
+        failed = [x['image'] for x in results if x['error']]
+        require(not failed, 'Failed to pull: {}'.format(', '.join(failed)))
+
+    # Add the outputs of earlier runs to a cohort matrix
+    elif args.command == 'cohort-add':
+        for tarball in args.tarballs:
+            uuid, added = add_tarball(args.store, tarball)
+            print('Added {} to: {}'.format(uuid, ', '.join(added)))
+
+    # Write one table of a cohort matrix as a tab-separated gene x sample matrix
+    elif args.command == 'cohort-export':
+        matrix = load_matrix(args.store, args.table)
+        samples = args.samples
+        if samples:
+            missing = [x for x in samples if x not in matrix.samples]
+            require(not missing, 'Samples not in the cohort matrix: {}'.format(', '.join(missing)))
+        with open_output(args.output) as f:
+            export_table(matrix, f, value=args.value, samples=samples)
+
     # Workflow execution
     elif args.command == 'run':
 
@@ -206,12 +458,82 @@ def main():
         # Sanity check configuration file
         config = configuration_sanity_checks(config)
 
+        # Load resource model used to size each job, tools without a fitted model use the built-in defaults
+        config.resources = load_model(config.resource_model)
+        config.scaling = load_curves(config.scaling_curves)
+        config.cache = cache_location(config)
+
+        # Tools that don't run with Docker, inherited by every job through the environment Toil copies to workers
+        set_backends(config.tool_backends)
+
+        # Pre-flight: skip samples whose output already exists
+        if args.skip_completed and not args.restart:
+            completed, samples, failed = find_completed(samples, config.output_dir)
+            print('Samples skipped (output complete): {}'.format(len(completed)))
+            print('Samples pending (no output): {}'.format(len(samples)))
+            print('Samples failed (output incomplete or corrupt, will be rerun): {}'.format(len(failed)))
+            for sample in failed:
+                print('\t{}'.format(sample[2]))
+            samples += failed
+            if not samples:
+                print('All samples are complete, nothing to do.')
+                return
+
+        # Pre-flight: check that every input can be reached before anything is scheduled
+        known_sizes = None
+        if config.validate_inputs and not args.restart:
+            results = validate(samples, config, cache_path=config.validation_cache)
+            known_sizes = {x['url']: x['size'] for x in results}
+
+        # Pre-flight: find input sizes to size download jobs and schedule the largest samples first
+        if config.order_samples_by_size and not args.restart:
+            samples = order_by_size(samples, config.max_sample_size, known_sizes)
+            num_found = sum(1 for x in samples for size in x[4].split(',') if size)
+            num_urls = sum(len(x[4].split(',')) for x in samples)
+            print('Found the size of {} of {} inputs, others assume max-sample-size'.format(num_found, num_urls))
+
         # Start the workflow, calling map_job() to run the workflow for each sample
         with Toil(args) as toil:
             if args.restart:
                 toil.restart()
             else:
-                toil.start(Job.wrapJobFn(map_job, workflow, samples, config))
+                # Samples are read from the job store by the jobs that spawn them, keeping the root job small
+                # With a Kallisto batch size, jobs at the bottom of the tree spawn batches of samples
+                batch_size = config.kallisto_batch_size if config.kallisto_index else 1
+                work_dir = tempfile.mkdtemp()
+                try:
+                    samples = store_samples(toil, samples, work_dir, branching_factor=config.map_branching_factor,
+                                            leaf_size=config.map_leaf_size, batch_size=batch_size)
+                    # The HUGO mapping table is built once and read by each node through Toil's file cache
+                    config.hugo_table_id = import_mapping(toil, config.hugo_mapping, work_dir) \
+                        if config.hugo_mapping else None
+                finally:
+                    shutil.rmtree(work_dir)
+                toil.start(Job.wrapJobFn(map_job, batch_workflow if batch_size > 1 else workflow, samples, config))
+
+
+def validate(samples, config, cache_path=None):
+    """
+    Checks every sample and index URL, printing a summary
+
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str cache_path: Path to JSON file caching successful checks, or None
+    :return: Result of each check
+    :rtype: list(dict)
+    :raises UserError: If any URL is missing or can't be read
+    """
+    results = validate_inputs(samples, config, cache_path=cache_path)
+    ok = [x for x in results if x['status'] == 'ok']
+    unchecked = [x for x in results if x['status'] == 'unchecked']
+    print('Checked {} input URLs: {} OK, {} failed, {} could not be checked'.format(
+        len(results), len(ok), len(results) - len(ok) - len(unchecked), len(unchecked)))
+    for x in unchecked:
+        print('\t{source}: could not be checked ({detail}) {url}'.format(**x))
+    failures = format_failures(results)
+    if failures:
+        raise UserError('\n\nThe following inputs are unreachable:\n{}\n'.format(failures))
+    return results
 
 
 def cli():
@@ -239,12 +561,102 @@ def cli():
     parser_run.add_argument('--config', default=config_path, type=str,
                             help='Path to (filled in) config file, created with "generate" or "config-input". '
                                  '\nDefault value: "%(default)s"')
+    parser_run.add_argument('--skip-completed', action='store_true',
+                            help='Skip samples whose output (<UUID>.tar.gz) is already in the output-dir')
 
     manifest_path = os.path.join(cwd, 'manifest-toil-rnaseq.tsv')
     group.add_argument('--manifest', default=manifest_path, type=str,
                        help='Path to (filled in) manifest file, created with "generate" or "manifest-input". '
                             '\nDefault value: "%(default)s"')
 
+    # Resource model subparser
+    parser_fit = subparsers.add_parser('fit-resources', help='Fits the resource model from recorded job history.')
+    parser_fit.add_argument('--history', nargs='+', required=True, type=str,
+                            help='Job history files: JSON records with "tool", "input_bytes", and the observed\n'
+                                 '"disk", "memory", "cpu_seconds", and "wall_seconds" of each job. The workflow\'s\n'
+                                 'log (--logFile) has a record of every tool call. The "profile.json" files in\n'
+                                 'output tarballs only cover STAR, RSEM, Kallisto, Hera, FastQC, and BamQC, so\n'
+                                 'stages such as sort, bam, cutadapt, and bam-shard need the log.')
+    parser_fit.add_argument('--model', default=os.path.join(cwd, 'resource-model.json'), type=str,
+                            help='Resource model to update. Set "resource-model" in the config to use it.'
+                                 '\nDefault value: "%(default)s"')
+
+    # Benchmark subparser
+    parser_bench = subparsers.add_parser('benchmark', help='Measures how the runtime of each tool scales with threads.')
+    parser_bench.add_argument('--config', default=config_path, type=str,
+                              help='Path to (filled in) config file. Tools with an index or reference are benchmarked.'
+                                   '\nDefault value: "%(default)s"')
+    parser_bench.add_argument('--threads', nargs='+', type=int,
+                              help='Thread counts to run each tool with, up to the cores available.\n'
+                                   'Default: powers of two up to the cores available, and all of them')
+    parser_bench.add_argument('--num-reads', default=1000000, type=int,
+                              help='Number of read pairs in the synthetic sample. Default value: "%(default)s"')
+    parser_bench.add_argument('--output', default=os.path.join(cwd, 'scaling-curves.json'), type=str,
+                              help='Path to write scaling curves to.\nDefault value: "%(default)s"')
+
+    # Plan subparser
+    parser_plan = subparsers.add_parser('plan', help='Reports the jobs, resource requests, and predicted makespan of a '
+                                                     'run without running it.')
+    parser_plan.add_argument('--config', default=config_path, type=str,
+                             help='Path to (filled in) config file. \nDefault value: "%(default)s"')
+    parser_plan.add_argument('--manifest', default=manifest_path, type=str,
+                             help='Path to (filled in) manifest file. \nDefault value: "%(default)s"')
+    parser_plan.add_argument('--nodes', default=1, type=int,
+                             help='Number of nodes to estimate the makespan for. Default value: "%(default)s"')
+    parser_plan.add_argument('--node-cores', default=multiprocessing.cpu_count(), type=int,
+                             help='Cores per node. Default value (this node): "%(default)s"')
+    parser_plan.add_argument('--node-memory', default='{}G'.format(node_memory() // 1024 ** 3), type=str,
+                             help='Memory per node, e.g. "60G". Default value (this node): "%(default)s"')
+    parser_plan.add_argument('--node-disk', default='500G', type=str,
+                             help='Disk per node, e.g. "1T". Default value: "%(default)s"')
+    parser_plan.add_argument('--format', default='table', choices=['table', 'json'],
+                             help='Output format. Default value: "%(default)s"')
+
+    # Validate subparser
+    parser_validate = subparsers.add_parser('validate', help='Checks that every sample and index URL exists and can '
+                                                             'be read.')
+    parser_validate.add_argument('--config', default=config_path, type=str,
+                                 help='Path to (filled in) config file. \nDefault value: "%(default)s"')
+    parser_validate.add_argument('--manifest', default=manifest_path, type=str,
+                                 help='Path to (filled in) manifest file. \nDefault value: "%(default)s"')
+    parser_validate.add_argument('--cache', default=None, type=str,
+                                 help='Path to JSON file that keeps successful checks for a day.'
+                                      '\nDefault value: "validation-cache" from the config')
+    parser_validate.add_argument('--output', default=None, type=str,
+                                 help='Path to write the result of each check to (JSON)')
+
+    # Pull images subparser
+    parser_pull = subparsers.add_parser('pull-images', help='Pulls the Docker images of every tool the config uses, '
+                                                            'concurrently, and reports which were already cached.')
+    parser_pull.add_argument('--config', default=config_path, type=str,
+                             help='Path to (filled in) config file. \nDefault value: "%(default)s"')
+    parser_pull.add_argument('--manifest', default=None, type=str,
+                             help='Path to manifest file, to leave out images only needed for BAM or GDC inputs it '
+                                  'doesn\'t have. Default: images for every input type')
+    parser_pull.add_argument('--threads', default=pull_threads, type=int,
+                             help='Number of images pulled at once. Default value: "%(default)s"')
+    parser_pull.add_argument('--docker', default='docker', type=str,
+                             help='Docker command. Default value: "%(default)s"')
+
+    # Cohort matrix subparsers
+    parser_cohort_add = subparsers.add_parser('cohort-add', help='Adds the quantifications of consolidated outputs '
+                                                                 '(<UUID>.tar.gz) to a cohort matrix.')
+    parser_cohort_add.add_argument('--store', required=True, type=str,
+                                   help='Directory of the cohort matrix, e.g. "cohort-matrix" from the config')
+    parser_cohort_add.add_argument('tarballs', nargs='+', type=str, help='Consolidated outputs of samples')
+    parser_cohort_export = subparsers.add_parser('cohort-export', help='Writes a table of a cohort matrix as a '
+                                                                       'tab-separated feature x sample matrix.')
+    parser_cohort_export.add_argument('--store', required=True, type=str,
+                                      help='Directory of the cohort matrix, e.g. "cohort-matrix" from the config')
+    parser_cohort_export.add_argument('--table', default='rsem-genes', choices=tables.values(),
+                                      help='Table to export. Default value: "%(default)s"')
+    parser_cohort_export.add_argument('--value', default='tpm', choices=value_columns.keys(),
+                                      help='Value to export. Default value: "%(default)s"')
+    parser_cohort_export.add_argument('--samples', nargs='+', default=None, type=str,
+                                      help='UUIDs of samples to export, in order. Default: all samples')
+    parser_cohort_export.add_argument('--output', default=None, type=str,
+                                      help='Path to write the matrix to. Default: standard output')
+
     # If no arguments provided, print full help menu
     if len(sys.argv) == 1:
         parser.print_help()
@@ -252,6 +664,7 @@ def cli():
 
     # Add Toil options
     Job.Runner.addToilOptions(parser_run)
+    Job.Runner.addToilOptions(parser_bench)
     return parser.parse_args()
 
 
@@ -11,3 +11,8 @@ picardtools_version = 'quay.io/ucsc_cgl/picardtools:2.10.9--23fc31175415b14dbf33
 gdc_version = 'jvivian/gdc-client:1.4'
 
 bamqc_version = 'quay.io/ucsc_cgl/bamqc:1.0--a5b6a69bdf4fcc9ef7959d98e53259e0218c7a52'
+
+# Image of each tool, keyed by the tool name used in `tool-backends`
+tool_versions = {x.split('/')[-1].split(':')[0]: x for x in [
+    cutadapt_version, fastqc_version, star_version, rsem_version, rsemgenemapping_version, kallisto_version,
+    hera_version, samtools_version, picardtools_version, gdc_version, bamqc_version]}
@@ -1,14 +1,38 @@
 import os
+import shutil
 import subprocess
+import time
+from multiprocessing.pool import ThreadPool
 
-from toil.lib.docker import dockerCall
 
+from toil_rnaseq.tools import samtools_version
 from toil_rnaseq.tools import star_version
+from toil_rnaseq.tools.bams import sort_and_save
+from toil_rnaseq.tools.jobs import save_wiggle_file
+from toil_rnaseq.tools.profiling import docker_call
+from toil_rnaseq.tools.profiling import profile_stage
+from toil_rnaseq.tools.profiling import write_profile
+from toil_rnaseq.tools.qc import bamqc
+from toil_rnaseq.tools.quantifiers import quantify_rsem
+from toil_rnaseq.tools.quantifiers import rsem
+from toil_rnaseq.tools.quantifiers import rsem_outputs
+from toil_rnaseq.tools.quantifiers import rsem_prefix
+from toil_rnaseq.tools.watchdog import Stalled
+from toil_rnaseq.tools.watchdog import Watchdog
+from toil_rnaseq.tools.watchdog import retry_memory_factor
+from toil_rnaseq.tools.watchdog import star_progress
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils import docker_path
+from toil_rnaseq.utils.cache import fetch
+from toil_rnaseq.utils.cache import file_hash
+from toil_rnaseq.utils.cache import stage_key
+from toil_rnaseq.utils.cache import store
 from toil_rnaseq.utils.files import tarball_files
 from toil_rnaseq.utils.urls import download_url
 
 
-def run_star(job, r1_id, r2_id, star_index_url, wiggle=False, sort=False, save_aligned_bam=False):
+def run_star(job, r1_id, r2_id, star_index_url, wiggle=False, sort=False, save_aligned_bam=False, config=None,
+             cache=None, rsem_options=None, watchdog=None):
     """
     Performs alignment of fastqs to bam via STAR
 
@@ -22,18 +46,124 @@ def run_star(job, r1_id, r2_id, star_index_url, wiggle=False, sort=False, save_a
     :param bool wiggle: If True, will output a wiggle file and return it
     :param bool sort: If True, will sort output by coordinate
     :param bool save_aligned_bam: If True, will output an aligned BAM and save it
-    :return: FileStoreID from RSEM
-    :rtype: str
+    :param Expando config: If provided, BamQC and saving of the aligned BAM / wiggle are run within this job
+        (co-located post-alignment) instead of returning the aligned BAM and wiggle to the fileStore
+    :param Expando cache: If provided, STAR's outputs are reused from / stored in this stage cache
+    :param Expando rsem_options: If provided, RSEM quantifies the transcriptome BAM within this job, which is
+        streamed to RSEM through a named pipe unless STAR's outputs are cached. Has the `ref_url`, `paired`, and
+        `hugo_table_id` arguments of `run_rsem`, and the `cores` of the job's cores RSEM runs with alongside STAR
+    :param Expando watchdog: If provided, STAR's throughput is logged and stalls flagged, see `watchdog_options`.
+        With retries left, a stalled STAR is stopped and this job is retried by a child with more memory
+    :return: FileStoreIDs for the transcriptome BAM, STAR output, aligned BAM, wiggle, and BamQC output.
+        With `rsem_options`, there is no transcriptome BAM and the return value of `run_rsem` follows
+    :rtype: tuple(str, str, str, str, str)
+    """
+    # Read in fastq(s)
+    profile_stage(job, 'star-colocated' if config else 'star', sum(x.size for x in [r1_id, r2_id] if x))
+    r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq')) if r1_id and r2_id else None
+
+    aligned_bam = 'rnaAligned.sortedByCoord.out.bam' if sort else 'rnaAligned.out.bam'
+    aligned_bam_path = os.path.join(job.tempDir, aligned_bam)
+    wiggle_name = 'rnaSignal.UniqueMultiple.str1.out.bg'
+    wiggle_path = os.path.join(job.tempDir, wiggle_name)
+    transcriptome_path = os.path.join(job.tempDir, 'rnaAligned.toTranscriptome.out.bam')
+
+    # Reuse the outputs of an identical alignment. Co-located post-alignment isn't cached as it saves outputs itself
+    key = None
+    if cache and not config:
+        key = stage_key('star', star_version, [star_index_url, sort, wiggle, save_aligned_bam],
+                        [file_hash(r1_path), file_hash(r2_path)])
+    cached = fetch(cache, key, job.tempDir) if key else None
+
+    # RSEM reads the transcriptome BAM while STAR writes it, unless the BAM is stored for reuse.
+    # The job's cores are split between them
+    stream = rsem_options and not key
+    try:
+        if stream:
+            os.mkfifo(transcriptome_path)
+            star_cores = max(1, job.cores - rsem_options.cores)
+            _stream(transcriptome_path,
+                    writer=lambda: star(job, star_index_url, r1_path, r2_path, sort=sort, wiggle=wiggle,
+                                        watchdog=watchdog, cores=star_cores),
+                    reader=lambda: rsem(job, rsem_options.ref_url, transcriptome_path, rsem_prefix,
+                                        paired=rsem_options.paired, cores=rsem_options.cores))
+            os.remove(transcriptome_path)
+        elif not cached:
+            star(job, star_index_url, r1_path, r2_path, sort=sort, wiggle=wiggle, watchdog=watchdog)
+    except Stalled:
+        memory = int(job.memory * retry_memory_factor)
+        job.log('Retrying STAR with {} bytes of memory, {} retries left'.format(memory, watchdog.retries - 1))
+        return job.addChildJobFn(run_star, r1_id, r2_id, star_index_url, wiggle=wiggle, sort=sort,
+                                 save_aligned_bam=save_aligned_bam, config=config, cache=cache,
+                                 rsem_options=rsem_options, watchdog=Expando(watchdog, retries=watchdog.retries - 1),
+                                 cores=job.cores, memory=memory, disk=job.disk).rv()
+
+    # Check output bam isnt size zero if sorted
+    if sort and not cached:
+        assert os.stat(aligned_bam_path).st_size > 0, 'Aligned bam failed to sort. Ensure sufficient memory is free.'
+
+    # Store outputs for reuse
+    if key and not cached:
+        outputs = ['rnaAligned.toTranscriptome.out.bam', 'rnaLog.final.out', 'rnaSJ.out.tab']
+        outputs += [aligned_bam] if save_aligned_bam else []
+        outputs += [wiggle_name] if wiggle else []
+        store(cache, key, [os.path.join(job.tempDir, x) for x in outputs], job.fileStore.getLocalTempDir())
+
+    # Write files to fileStore
+    transcriptome_id = job.fileStore.writeGlobalFile(transcriptome_path) if not rsem_options else None
+    aligned_id, wiggle_id, bamqc_id = None, None, None
+    if config:
+        bamqc_tar = post_alignment(job, config, aligned_bam_path, wiggle_path if wiggle else None, sorted_bam=sort)
+        bamqc_id = job.fileStore.writeGlobalFile(bamqc_tar) if bamqc_tar else None
+    else:
+        aligned_id = job.fileStore.writeGlobalFile(aligned_bam_path) if save_aligned_bam else None
+        wiggle_id = job.fileStore.writeGlobalFile(wiggle_path) if wiggle else None
+
+    # Tar output files, store in fileStore, and return FileStoreIDs. Co-located steps are profiled separately:
+    # BamQC within its tarball, and saving the aligned BAM with samtools alongside STAR's profile
+    output_files = [os.path.join(job.tempDir, x) for x in ['rnaLog.final.out', 'rnaSJ.out.tab']]
+    output_files.append(write_profile(job, job.tempDir, image=star_version))
+    if config and config.save_bam:
+        output_files.append(write_profile(job, job.tempDir, name='samtools_profile.json', image=samtools_version))
+    tarball_files('star.tar', file_paths=output_files, output_dir=job.tempDir)
+    star_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'star.tar'))
+    star_ids = transcriptome_id, star_id, aligned_id, wiggle_id, bamqc_id
+    if not rsem_options:
+        return star_ids
+
+    # Otherwise RSEM quantifies the stored BAM right away, on this node
+    if stream:
+        return star_ids + rsem_outputs(job, rsem_options.hugo_table_id)
+    return star_ids + quantify_rsem(job, transcriptome_path, rsem_options.ref_url, paired=rsem_options.paired,
+                                    cache=cache, hugo_table_id=rsem_options.hugo_table_id)
+
+
+def star(job, star_index_url, r1_path, r2_path=None, sort=False, wiggle=False, watchdog=None, cores=None):
+    """
+    Runs STAR on local fastqs in the job's temporary directory, where its output is written
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str star_index_url: STAR index tarball
+    :param str r1_path: Path to fastq (pair 1)
+    :param str r2_path: Path to fastq (pair 2 if applicable, else None)
+    :param bool sort: If True, will sort output by coordinate
+    :param bool wiggle: If True, will output a wiggle file
+    :param Expando watchdog: If provided, STAR's progress is followed, see `watchdog_options`
+    :param int cores: Number of threads, defaults to the job's cores
     """
     # Download and untar STAR index file
-    download_url(url=star_index_url, name='starIndex.tar.gz', work_dir=job.tempDir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(job.tempDir, 'starIndex.tar.gz'), '-C', job.tempDir])
-    os.remove(os.path.join(job.tempDir, 'starIndex.tar.gz'))
-    star_index = os.path.join('/data', os.listdir(job.tempDir)[0]) if len(os.listdir(job.tempDir)) == 1 else '/data'
+    index_dir = os.path.join(job.tempDir, 'star-index')
+    os.mkdir(index_dir)
+    download_url(url=star_index_url, name='starIndex.tar.gz', work_dir=index_dir)
+    subprocess.check_call(['tar', '-xvf', os.path.join(index_dir, 'starIndex.tar.gz'), '-C', index_dir])
+    os.remove(os.path.join(index_dir, 'starIndex.tar.gz'))
+    if len(os.listdir(index_dir)) == 1:
+        index_dir = os.path.join(index_dir, os.listdir(index_dir)[0])
 
     # Define parameters
-    parameters = ['--runThreadN', str(job.cores),
-                  '--genomeDir', star_index,
+    parameters = ['--runThreadN', str(cores or job.cores),
+                  '--genomeDir', docker_path(index_dir, job.tempDir),
                   '--outFileNamePrefix', 'rna',
                   '--outSAMunmapped', 'Within',
                   '--quantMode', 'TranscriptomeSAM',
@@ -52,40 +182,90 @@ def run_star(job, r1_id, r2_id, star_index_url, wiggle=False, sort=False, save_a
     # Modify parameters based on function arguments
     if sort:
         parameters.extend(['--outSAMtype', 'BAM', 'SortedByCoordinate', '--limitBAMsortRAM', '49268954168'])
-        aligned_bam = 'rnaAligned.sortedByCoord.out.bam'
     else:
         parameters.extend(['--outSAMtype', 'BAM', 'Unsorted'])
-        aligned_bam = 'rnaAligned.out.bam'
     if wiggle:
         parameters.extend(['--outWigType', 'bedGraph',
                            '--outWigStrand', 'Unstranded',
                            '--outWigReferencesPrefix', 'chr'])
-
-    # Read in fastq(s) and modify parameters based on
-    job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
-    if r1_id and r2_id:
-        job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq'))
-        parameters.extend(['--readFilesIn', '/data/R1.fastq', '/data/R2.fastq'])
-    else:
-        parameters.extend(['--readFilesIn', '/data/R1.fastq'])
+    parameters.extend(['--readFilesIn'] + [docker_path(x) for x in [r1_path, r2_path] if x])
 
     # Call: STAR
-    dockerCall(job=job, tool=star_version, workDir=job.tempDir, parameters=parameters)
+    monitor = Watchdog(job.log, 'STAR', lambda: star_progress(job.tempDir), watchdog) if watchdog else None
+    docker_call(job=job, tool=star_version, workDir=job.tempDir, parameters=parameters, watchdog=monitor)
+    shutil.rmtree(os.path.join(job.tempDir, 'star-index'))
 
-    # Check output bam isnt size zero if sorted
-    aligned_bam_path = os.path.join(job.tempDir, aligned_bam)
-    if sort:
-        assert os.stat(aligned_bam_path).st_size > 0, 'Aligned bam failed to sort. Ensure sufficient memory is free.'
 
-    # Write files to fileStore
-    transcriptome_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'rnaAligned.toTranscriptome.out.bam'))
-    aligned_id = job.fileStore.writeGlobalFile(aligned_bam_path) if save_aligned_bam else None
-    wiggle_path = os.path.join(job.tempDir, 'rnaSignal.UniqueMultiple.str1.out.bg')
-    wiggle_id = job.fileStore.writeGlobalFile(wiggle_path) if wiggle else None
+def post_alignment(job, config, aligned_bam_path, wiggle_path=None, sorted_bam=False):
+    """
+    Runs BamQC and saves the aligned BAM / wiggle from STAR's working directory so the aligned BAM
+    never round-trips through the fileStore. Independent steps run concurrently in a thread pool.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str aligned_bam_path: Path to STAR's genome aligned BAM
+    :param str wiggle_path: Path to STAR's wiggle file, if it should be saved
+    :param bool sorted_bam: If True, the aligned BAM is already sorted by coordinate
+    :return: Path to BamQC tarball if BamQC was run, otherwise None
+    :rtype: str
+    """
+    tasks = []
+    # Note: if bamqc is enabled, the bam is saved by bamqc
+    if config.bamqc:
+        tasks.append((bamqc, (job, aligned_bam_path, config), {'save_bam': config.save_bam}))
+    elif config.save_bam:
+        tasks.append((sort_and_save, (job, config, aligned_bam_path), {'skip_sort': sorted_bam}))
+    if wiggle_path:
+        tasks.append((save_wiggle_file, (config, wiggle_path), {}))
+    if not tasks:
+        return None
+
+    pool = ThreadPool(len(tasks))
+    try:
+        results = [pool.apply_async(func, args, kwargs) for func, args, kwargs in tasks]
+        results = [x.get() for x in results]
+    finally:
+        pool.close()
+        pool.join()
+    return results[0] if config.bamqc else None
 
-    # Tar output files, store in fileStore, and return FileStoreIDs
-    output_files = [os.path.join(job.tempDir, x) for x in ['rnaLog.final.out', 'rnaSJ.out.tab']]
-    tarball_files('star.tar.gz', file_paths=output_files, output_dir=job.tempDir)
-    star_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'star.tar.gz'))
 
-    return transcriptome_id, star_id, aligned_id, wiggle_id
+def _stream(fifo_path, writer, reader):
+    """
+    Runs a tool writing a named pipe alongside the tool reading it. Opening a named pipe blocks until its other end
+    is opened, so once either tool fails, the failed tool's end is opened and closed until the other tool exits,
+    which then sees the pipe closed instead of waiting forever. The error of the tool that failed first is raised.
+
+    :param str fifo_path: Path to named pipe
+    :param function writer: Runs the tool writing the pipe
+    :param function reader: Runs the tool reading the pipe
+    """
+    pool = ThreadPool(2)
+    try:
+        results = [pool.apply_async(writer), pool.apply_async(reader)]
+        failed = None
+        while not all(x.ready() for x in results):
+            for result, flags in zip(results, [os.O_WRONLY, os.O_RDONLY]):
+                if result.ready() and not result.successful():
+                    failed = failed or result
+                    _open_end(fifo_path, flags)
+            time.sleep(1)
+        for result in [failed] + results if failed else results:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _open_end(fifo_path, flags):
+    """
+    Opens and closes one end of a named pipe without waiting for the other end
+
+    :param str fifo_path: Path to named pipe
+    :param int flags: os.O_WRONLY or os.O_RDONLY
+    """
+    try:
+        os.close(os.open(fifo_path, flags | os.O_NONBLOCK))
+    except OSError:
+        # Opening the write end fails (ENXIO) while nothing has the read end open yet
+        pass
@@ -1,15 +1,18 @@
 import os
 from urlparse import urlparse
 
-from toil.lib.docker import dockerCall
-from toil.lib.docker import dockerCheckOutput
 
 from toil_rnaseq.tools import gdc_version
 from toil_rnaseq.tools import picardtools_version
 from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools.profiling import docker_call
+from toil_rnaseq.tools.profiling import docker_check_output
+from toil_rnaseq.tools.profiling import profile_stage
 from toil_rnaseq.utils import docker_path
 from toil_rnaseq.utils.files import copy_files
+from toil_rnaseq.utils.urls import download_url
 from toil_rnaseq.utils.urls import move_or_upload
+from toil_rnaseq.utils.urls import output_stream
 
 
 def assert_bam_is_paired_end(job, bam_path, region='chr6'):
@@ -35,7 +38,7 @@ def assert_bam_is_paired_end(job, bam_path, region='chr6'):
         parameters = ['view', '-c', '-f', '1',
                       docker_bam_path,
                       r]  # Chr6 chosen for testing, any region with reads will work
-        out = dockerCheckOutput(job, workDir=work_dir, parameters=parameters, tool=samtools_version)
+        out = docker_check_output(job, workDir=work_dir, parameters=parameters, tool=samtools_version)
         results.append(int(out.strip()))
     assert any(x for x in results if x != 0), 'BAM is not paired-end, aborting run.'
 
@@ -50,7 +53,7 @@ def index_bam(job, bam_path):
     """
     work_dir = os.path.dirname(os.path.abspath(bam_path))
     parameters = ['index', docker_path(bam_path)]
-    dockerCall(job, workDir=work_dir, parameters=parameters, tool=samtools_version)
+    docker_call(job, workDir=work_dir, parameters=parameters, tool=samtools_version)
 
 
 def convert_bam_to_fastq(job, bam_path, check_paired=True, ignore_validation_errors=True):
@@ -71,12 +74,94 @@ def convert_bam_to_fastq(job, bam_path, check_paired=True, ignore_validation_err
     parameters = ['SamToFastq', 'I={}'.format(docker_path(bam_path)), 'F=/data/R1.fq', 'F2=/data/R2.fq']
     if ignore_validation_errors:
         parameters.append('VALIDATION_STRINGENCY=SILENT')
-    dockerCall(job=job, workDir=work_dir, parameters=parameters, tool=picardtools_version)
+    docker_call(job=job, workDir=work_dir, parameters=parameters, tool=picardtools_version)
     r1 = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R1.fq'))
     r2 = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2.fq'))
     return r1, r2
 
 
+def get_read_groups(job, bam_path):
+    """
+    Reads the IDs of the read groups declared in a BAM header
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam_path: Path to BAM
+    :return: Read group IDs
+    :rtype: list(str)
+    """
+    work_dir = os.path.dirname(os.path.abspath(bam_path))
+    header = docker_check_output(job, workDir=work_dir, parameters=['view', '-H', docker_path(bam_path)],
+                                 tool=samtools_version)
+    read_groups = []
+    for line in header.splitlines():
+        if line.startswith('@RG'):
+            fields = dict(x.split(':', 1) for x in line.split('\t')[1:] if ':' in x)
+            read_groups.append(fields['ID'])
+    return read_groups
+
+
+def count_reads(job, bam_path, read_groups=None):
+    """
+    Counts the records of a BAM, or only those tagged with one of the given read groups
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam_path: Path to BAM
+    :param list(str) read_groups: IDs of read groups to count
+    :return: Number of records
+    :rtype: int
+    """
+    work_dir = os.path.dirname(os.path.abspath(bam_path))
+    parameters = ['view', '-c', '-@', str(job.cores)]
+    if read_groups:
+        with open(os.path.join(work_dir, 'read_groups.txt'), 'w') as f:
+            f.write('\n'.join(read_groups) + '\n')
+        parameters.extend(['-R', '/data/read_groups.txt'])
+    parameters.append(docker_path(bam_path))
+    out = docker_check_output(job, workDir=work_dir, parameters=parameters, tool=samtools_version)
+    return int(out.strip())
+
+
+def shardable_read_groups(job, bam_path):
+    """
+    Read groups a BAM can be split into. Reads without a read group, or in one missing from the header, would be
+    dropped by `convert_read_group_to_fastq`, so no read groups are returned unless they account for every read.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam_path: Path to BAM
+    :return: Read group IDs, empty if the BAM must be converted whole
+    :rtype: list(str)
+    """
+    read_groups = get_read_groups(job, bam_path)
+    if len(read_groups) < 2:
+        return []
+    if count_reads(job, bam_path, read_groups) != count_reads(job, bam_path):
+        job.log('Reads outside of the read groups declared in the header, converting the whole BAM')
+        return []
+    return read_groups
+
+
+def convert_read_group_to_fastq(job, bam_id, read_group):
+    """
+    Extracts one read group from a BAM and converts it to a pair of FASTQ files
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam_id: FileStoreID of BAM
+    :param str read_group: ID of the read group to convert
+    :return: FileStoreIDs for R1 and R2 of the read group
+    :rtype: tuple(str, str)
+    """
+    profile_stage(job, 'bam-shard', bam_id.size)
+    job.fileStore.readGlobalFile(bam_id, os.path.join(job.tempDir, 'input.bam'))
+    parameters = ['view', '-b',
+                  '-r', read_group,
+                  '-@', str(job.cores),
+                  '-o', '/data/shard.bam',
+                  '/data/input.bam']
+    docker_call(job, workDir=job.tempDir, parameters=parameters, tool=samtools_version)
+    os.remove(os.path.join(job.tempDir, 'input.bam'))
+    return convert_bam_to_fastq(job, os.path.join(job.tempDir, 'shard.bam'), check_paired=False)
+
+
 def download_bam_from_gdc(job, work_dir, url, token):
     """
     Downloads BAM file from the GDC using an url (format: "gdc://<GDC ID>") and a GDC access token
@@ -96,7 +181,7 @@ def download_bam_from_gdc(job, work_dir, url, token):
                   '-d', '/data',
                   '-t', '/data/{}'.format(os.path.basename(token)),
                   parsed_url.netloc]
-    dockerCall(job, tool=gdc_version, parameters=parameters, workDir=work_dir)
+    docker_call(job, tool=gdc_version, parameters=parameters, workDir=work_dir)
     files = [x for x in os.listdir(os.path.join(work_dir, parsed_url.netloc)) if x.lower().endswith('.bam')]
     assert len(files) == 1, 'More than one BAM found from GDC URL: {}'.format(files)
     bam_path = os.path.join(work_dir, parsed_url.netloc, files[0])
@@ -112,21 +197,99 @@ def sort_and_save_bam(job, config, bam_id, skip_sort=True):
     :param bool skip_sort: If True, skips sort step and upload BAM
     :param FileID bam_id: FileID for STARs genome aligned bam
     """
+    profile_stage(job, 'sort', bam_id.size)
     bam_path = os.path.join(job.tempDir, 'aligned.bam')
-    sorted_bam = os.path.join(job.tempDir, '{}.sorted.bam'.format(config.uuid))
     job.fileStore.readGlobalFile(bam_id, bam_path)
+    sort_and_save(job, config, bam_path, skip_sort=skip_sort)
+
+
+def sort_and_save(job, config, bam_path, skip_sort=True):
+    """
+    Sorts a local BAM using samtools and moves or uploads it to the output location.
+    If `save-bam-format` is cram, samtools writes an indexed, reference-based CRAM directly, see `write_cram`.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str bam_path: Path to STARs genome aligned bam
+    :param bool skip_sort: If True, skips sort step and upload BAM
+    """
+    work_dir = os.path.dirname(os.path.abspath(bam_path))
+    sorted_bam = os.path.join(work_dir, '{}.sorted.bam'.format(config.uuid))
+
+    if config.save_bam_format == 'cram':
+        cram_files = write_cram(job, config, bam_path, os.path.join(work_dir, '{}.sorted.cram'.format(config.uuid)),
+                                sort=not skip_sort)
+        move_or_upload(config, files=cram_files, owned=True)
+        return
+
+    if skip_sort:
+        job.log('Skipping samtools sort as STAR already sorted BAM')
+        os.rename(bam_path, sorted_bam)
+        save_alignment(job, config, sorted_bam)
+        return
 
+    # The sorted alignments are written to stdout and straight to the output location
     parameters = ['sort',
-                  '-o', '/data/{}.sorted.bam'.format(config.uuid),
                   '-O', 'bam',
                   '-T', 'temp',
                   '-@', str(job.cores),
-                  '/data/aligned.bam']
+                  docker_path(bam_path)]
+    with output_stream(config, '{}.sorted.bam'.format(config.uuid)) as f_out:
+        docker_call(job, tool=samtools_version, parameters=parameters, workDir=work_dir, outfile=f_out)
 
-    if skip_sort:
-        job.log('Skipping samtools sort as STAR already sorted BAM')
-        os.rename(bam_path, sorted_bam)
+
+def save_alignment(job, config, bam_path):
+    """
+    Moves or uploads a coordinate sorted BAM, or the indexed CRAM written from it if `save-bam-format` is cram
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str bam_path: Path to coordinate sorted BAM
+    """
+    files = [bam_path]
+    if config.save_bam_format == 'cram':
+        files = write_cram(job, config, bam_path, os.path.splitext(bam_path)[0] + '.cram')
+    move_or_upload(config, files=files, owned=True)
+
+
+def write_cram(job, config, bam_path, cram_path, sort=False):
+    """
+    Writes a BAM as reference-based CRAM using all of the job's cores, and indexes it. samtools sort writes the CRAM
+    directly from an unsorted BAM, so a sorted BAM is never written. The BAM is removed afterwards.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str bam_path: Path to BAM
+    :param str cram_path: Path to CRAM, in the same directory as the BAM
+    :param bool sort: If True, sorts the BAM by coordinate, otherwise it must already be sorted
+    :return: Paths to CRAM and its index (.crai)
+    :rtype: list(str)
+    """
+    work_dir = os.path.dirname(os.path.abspath(bam_path))
+    reference_path = download_reference(config, work_dir)
+    if sort:
+        parameters = ['sort', '-O', 'cram', '-T', 'temp', '--reference', docker_path(reference_path)]
     else:
-        dockerCall(job, tool=samtools_version, parameters=parameters, workDir=job.tempDir)
+        parameters = ['view', '-C', '-T', docker_path(reference_path)]
+    parameters.extend(['-@', str(job.cores),
+                       '-o', docker_path(cram_path),
+                       docker_path(bam_path)])
+    docker_call(job, tool=samtools_version, parameters=parameters, workDir=work_dir)
+    os.remove(bam_path)
+    docker_call(job, tool=samtools_version, parameters=['index', docker_path(cram_path)], workDir=work_dir)
+    return [cram_path, cram_path + '.crai']
+
 
-    move_or_upload(config, files=[sorted_bam])
+def download_reference(config, work_dir):
+    """
+    Downloads the genome FASTA associated with the STAR index, used for CRAM compression
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str work_dir: Directory to download the FASTA to
+    :return: Path to genome FASTA
+    :rtype: str
+    """
+    reference_path = os.path.join(work_dir, os.path.basename(config.genome_fasta))
+    if not os.path.exists(reference_path):
+        download_url(url=config.genome_fasta, work_dir=work_dir)
+    return reference_path
@@ -0,0 +1,176 @@
+import os
+import random
+import shutil
+import subprocess
+
+from toil_rnaseq.tools.aligners import run_star
+from toil_rnaseq.tools.profiling import records
+from toil_rnaseq.tools.quantifiers import run_hera
+from toil_rnaseq.tools.quantifiers import run_kallisto
+from toil_rnaseq.tools.quantifiers import run_rsem
+from toil_rnaseq.utils.resources import predict
+from toil_rnaseq.utils.urls import download_url
+
+# Tools whose thread count follows the cores given to their job
+scalable_tools = ['star', 'rsem', 'kallisto', 'hera']
+
+
+def thread_counts(cores):
+    """
+    Default thread counts to benchmark: powers of two up to the node's cores, and all of its cores
+
+    >>> thread_counts(12)
+    [1, 2, 4, 8, 12]
+    >>> thread_counts(16)
+    [1, 2, 4, 8, 16]
+
+    :param int cores: Number of cores on the node
+    :rtype: list(int)
+    """
+    counts = [2 ** x for x in xrange(cores.bit_length()) if 2 ** x < cores]
+    return counts + [cores]
+
+
+def benchmark(job, config, threads, num_reads):
+    """
+    Runs each configured tool on the same synthetic sample at several thread counts, one run at a time so
+    runs do not compete for the node
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param list(int) threads: Thread counts to run each tool with
+    :param int num_reads: Number of read pairs in the synthetic sample
+    :return: Container wall time in seconds of each tool, keyed by tool and thread count
+    :rtype: dict(str, dict(int, float))
+    """
+    r1_path, r2_path = synthetic_fastqs(job.tempDir, num_reads, transcripts_url=config.rsem_ref)
+    r1_id, r2_id = job.fileStore.writeGlobalFile(r1_path), job.fileStore.writeGlobalFile(r2_path)
+
+    tools = {'star': config.star_index, 'rsem': config.rsem_ref,
+             'kallisto': config.kallisto_index, 'hera': config.hera_index}
+    tools = [x for x in scalable_tools if tools[x] and (x != 'rsem' or config.star_index)]
+    model = config.resources
+
+    # Chain every run so only one is on the node at a time. RSEM quantifies STAR's transcriptome BAM
+    runs, previous, star = [], job, None
+    for tool in tools:
+        for cores in threads:
+            run = job.wrapJobFn(run_benchmark, tool, config, r1_id, r2_id, star=star.rv() if star else None,
+                                cores=cores, memory=predict(model, tool, 'memory', r1_id.size + r2_id.size),
+                                disk=predict(model, tool, 'disk', r1_id.size + r2_id.size))
+            previous.addFollowOn(run)
+            previous = run
+            runs.append(run.rv())
+            star = run if tool == 'star' and star is None else star
+    return previous.addFollowOnJobFn(summarize_benchmark, runs).rv()
+
+
+def run_benchmark(job, tool, config, r1_id, r2_id, star=None):
+    """
+    Runs one tool with as many threads as the job has cores
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str tool: Name of tool, one of `scalable_tools`
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str r1_id: FileStoreID of synthetic R1 fastq
+    :param str r2_id: FileStoreID of synthetic R2 fastq
+    :param dict star: Result of a STAR benchmark run, providing the transcriptome BAM for RSEM
+    :return: Tool, cores, container wall time, and STAR's transcriptome BAM
+    :rtype: dict
+    """
+    result = {'tool': tool, 'cores': job.cores, 'transcriptome_id': None}
+    if tool == 'star':
+        outputs = list(run_star(job, r1_id, r2_id, star_index_url=config.star_index))
+        result['transcriptome_id'] = outputs.pop(0)
+    elif tool == 'rsem':
+        outputs = run_rsem(job, star['transcriptome_id'], rsem_ref_url=config.rsem_ref, paired=True)
+    elif tool == 'kallisto':
+        outputs = [run_kallisto(job, r1_id, r2_id, kallisto_index_url=config.kallisto_index)]
+    else:
+        outputs = [run_hera(job, r1_id, r2_id, hera_index_url=config.hera_index)]
+
+    # Only the timing is kept
+    [job.fileStore.deleteGlobalFile(x) for x in outputs if x is not None]
+    result['seconds'] = sum(x['wall_seconds'] for x in records(job))
+    job.log('Benchmark of {} with {} threads: {:.0f}s'.format(tool, job.cores, result['seconds']))
+    return result
+
+
+def summarize_benchmark(job, runs):
+    """
+    Collects benchmark runs into a scaling curve per tool
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list(dict) runs: Results of `run_benchmark`
+    :return: Container wall time in seconds of each tool, keyed by tool and thread count
+    :rtype: dict(str, dict(int, float))
+    """
+    curves = {}
+    for run in runs:
+        curves.setdefault(run['tool'], {})[int(run['cores'])] = run['seconds']
+    [job.fileStore.deleteGlobalFile(x['transcriptome_id']) for x in runs if x['transcriptome_id']]
+    return curves
+
+
+def synthetic_fastqs(work_dir, num_reads, read_length=76, fragment_length=250, transcripts_url=None, seed=0):
+    """
+    Writes a fixed pair of fastqs. Reads are sampled from the transcripts in an RSEM reference when given,
+    so alignment and quantification do realistic work, otherwise they are random sequence.
+
+    :param str work_dir: Directory to write fastqs to
+    :param int num_reads: Number of read pairs
+    :param int read_length: Length of each read
+    :param int fragment_length: Length of the fragment each read pair is sampled from
+    :param str transcripts_url: URL of RSEM reference tarball
+    :param int seed: Seed of the random number generator, so every benchmark uses the same sample
+    :return: Paths to R1 and R2 fastqs
+    :rtype: tuple(str, str)
+    """
+    rng = random.Random(seed)
+    transcripts = _read_transcripts(work_dir, transcripts_url, fragment_length) if transcripts_url else []
+    if not transcripts:
+        transcripts = [''.join(rng.choice('ACGT') for _ in xrange(10000)) for _ in xrange(100)]
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+
+    r1_path, r2_path = os.path.join(work_dir, 'R1.fastq'), os.path.join(work_dir, 'R2.fastq')
+    quality = 'I' * read_length
+    with open(r1_path, 'w') as f_r1, open(r2_path, 'w') as f_r2:
+        for i in xrange(num_reads):
+            transcript = rng.choice(transcripts)
+            start = rng.randint(0, len(transcript) - fragment_length)
+            fragment = transcript[start:start + fragment_length]
+            r2 = ''.join(complement.get(x, 'N') for x in reversed(fragment[-read_length:]))
+            f_r1.write('@read{0}/1\n{1}\n+\n{2}\n'.format(i, fragment[:read_length], quality))
+            f_r2.write('@read{0}/2\n{1}\n+\n{2}\n'.format(i, r2, quality))
+    return r1_path, r2_path
+
+
+def _read_transcripts(work_dir, rsem_ref_url, min_length):
+    """
+    Reads the transcript sequences RSEM extracts into its reference
+
+    :param str work_dir: Directory to download the reference to
+    :param str rsem_ref_url: URL of RSEM reference tarball
+    :param int min_length: Transcripts shorter than this are skipped
+    :return: Transcript sequences
+    :rtype: list(str)
+    """
+    ref_dir = os.path.join(work_dir, 'rsem_ref')
+    os.mkdir(ref_dir)
+    tar_path = download_url(url=rsem_ref_url, name='rsem_ref.tar.gz', work_dir=ref_dir)
+    subprocess.check_call(['tar', '-xf', tar_path, '-C', ref_dir])
+    fasta = [os.path.join(root, x) for root, _, files in os.walk(ref_dir) for x in files
+             if x.endswith('.transcripts.fa')]
+
+    transcripts, sequence = [], []
+    if fasta:
+        with open(fasta[0]) as f:
+            for line in f:
+                if line.startswith('>'):
+                    transcripts.append(''.join(sequence))
+                    sequence = []
+                else:
+                    sequence.append(line.strip().upper())
+        transcripts.append(''.join(sequence))
+    shutil.rmtree(ref_dir)
+    return [x for x in transcripts if len(x) >= min_length]
@@ -0,0 +1,158 @@
+import json
+import os
+import re
+import subprocess
+
+from toil_rnaseq.tools import tool_versions
+
+# Ways a tool can be run. Docker is the default for every tool
+backend_names = ['docker', 'singularity', 'native']
+
+# Commands of natively installed tools, run in place of the image's entrypoint with the same parameters
+native_commands = {'cutadapt': ['cutadapt'],
+                   'fastqc': ['fastqc'],
+                   'star': ['STAR'],
+                   'rsem': ['rsem-calculate-expression'],
+                   'kallisto': ['kallisto'],
+                   'hera': ['hera'],
+                   'samtools': ['samtools'],
+                   'picardtools': ['picard'],
+                   'gdc-client': ['gdc-client']}
+
+# Environment variable holding the backend of each tool. Set on the leader, Toil passes it on to every worker
+backends_variable = 'TOIL_RNASEQ_TOOL_BACKENDS'
+
+
+def tool_name(image):
+    """
+    Name of the tool in an image
+
+    >>> tool_name('quay.io/ucsc_cgl/samtools:1.5--98b58ba05641ee98fa98414ed28b53ac3048bc09')
+    'samtools'
+
+    :param str image: Docker image
+    :rtype: str
+    """
+    return image.split('/')[-1].split(':')[0]
+
+
+def set_backends(backends):
+    """
+    Makes the configured backends visible to every job of the run
+
+    :param dict(str, str) backends: Backend of each tool, with a "default" for the rest. See `tool-backends`
+    """
+    os.environ[backends_variable] = json.dumps(backends or {})
+
+
+def tool_backend(image, backends=None):
+    """
+    Backend a tool runs with. A default of "native" only applies to tools in `native_commands`
+
+    >>> tool_backend(tool_versions['samtools'], {'default': 'singularity', 'samtools': 'native'})
+    'native'
+    >>> tool_backend(tool_versions['star'], {'default': 'singularity', 'samtools': 'native'})
+    'singularity'
+    >>> tool_backend(tool_versions['bamqc'], {'default': 'native'})
+    'docker'
+
+    :param str image: Docker image of tool
+    :param dict(str, str) backends: Backend of each tool, read from the environment by default
+    :rtype: str
+    """
+    if backends is None:
+        backends = json.loads(os.environ.get(backends_variable) or '{}')
+    name = tool_name(image)
+    if name in backends:
+        return backends[name]
+    default = backends.get('default', 'docker')
+    return 'docker' if default == 'native' and name not in native_commands else default
+
+
+def required_programs(backends):
+    """
+    Programs each node needs to run every tool with its configured backend. Singularity may be installed
+    under its new name, Apptainer.
+
+    >>> required_programs({'star': 'native'})
+    [['docker'], ['STAR']]
+    >>> required_programs({'default': 'singularity', 'samtools': 'native'})
+    [['apptainer', 'singularity'], ['samtools']]
+
+    :param dict(str, str) backends: Backend of each tool, with a "default" for the rest. See `tool-backends`
+    :return: Alternative names of each program, any of which may be installed
+    :rtype: list(list(str))
+    """
+    programs = []
+    for name, image in sorted(tool_versions.iteritems()):
+        backend = tool_backend(image, backends or {})
+        if backend == 'docker':
+            program = ['docker']
+        elif backend == 'singularity':
+            program = ['apptainer', 'singularity']
+        else:
+            program = native_commands[name][:1]
+        if program not in programs:
+            programs.append(program)
+    return programs
+
+
+def command(image, parameters, work_dir, backend):
+    """
+    Command line that runs a tool without Docker. Parameters refer to files under /data, as they would in the
+    container: Singularity binds the work directory to /data, natively they are rewritten to the work directory.
+
+    >>> command(tool_versions['samtools'], ['index', '/data/a.bam'], '/tmp/work', 'native')
+    ['samtools', 'index', '/tmp/work/a.bam']
+    >>> command(tool_versions['picardtools'], ['MarkDuplicates', 'I=/data/a.bam'], '/tmp/work', 'native')
+    ['picard', 'MarkDuplicates', 'I=/tmp/work/a.bam']
+
+    :param str image: Docker image of tool
+    :param list(str) parameters: Parameters passed to the container
+    :param str work_dir: Directory mounted into the container as /data
+    :param str backend: "singularity" or "native"
+    :rtype: list(str)
+    """
+    parameters = [str(x) for x in parameters or []]
+    if backend == 'singularity':
+        return [_singularity(), 'run', '--bind', work_dir + ':/data', '--pwd', '/data',
+                'docker://' + image] + parameters
+    if tool_name(image) not in native_commands:
+        raise ValueError('{} has no native command, set its backend to docker or singularity'.format(image))
+    return native_commands[tool_name(image)] + [re.sub(r'(^|=)/data(?=/|$)', r'\1' + work_dir, x)
+                                                for x in parameters]
+
+
+def execute(image, parameters, work_dir, backend, outfile=None, check_output=False, started=None):
+    """
+    Runs a tool with Singularity or natively, measuring the CPU time and peak memory of the process and its children
+
+    :param str image: Docker image of tool
+    :param list(str) parameters: Parameters passed to the container
+    :param str work_dir: Directory mounted into the container as /data
+    :param str backend: "singularity" or "native"
+    :param file outfile: Stream the tool's standard output is written to
+    :param bool check_output: If True, returns the tool's standard output
+    :param function started: Called with the tool's process once it starts
+    :return: Standard output (if requested), and CPU seconds and peak memory in bytes
+    :rtype: tuple(str, dict)
+    """
+    args = command(image, parameters, work_dir, backend)
+    p = subprocess.Popen(args, cwd=work_dir, stdout=subprocess.PIPE if check_output else outfile, close_fds=True)
+    if started:
+        started(p)
+    output = p.stdout.read() if check_output else None
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, args)
+    # ru_maxrss is in kilobytes on Linux
+    return output, {'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3), 'memory': usage.ru_maxrss * 1024}
+
+
+def _singularity():
+    """Singularity was renamed Apptainer, either command may be installed"""
+    for name in ['apptainer', 'singularity']:
+        if any(os.access(os.path.join(x, name), os.X_OK) for x in os.environ.get('PATH', '').split(os.pathsep)):
+            return name
+    return 'singularity'
@@ -0,0 +1,154 @@
+import fcntl
+import os
+import subprocess
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from toil_rnaseq.tools import bamqc_version
+from toil_rnaseq.tools import cutadapt_version
+from toil_rnaseq.tools import fastqc_version
+from toil_rnaseq.tools import gdc_version
+from toil_rnaseq.tools import hera_version
+from toil_rnaseq.tools import kallisto_version
+from toil_rnaseq.tools import picardtools_version
+from toil_rnaseq.tools import rsem_version
+from toil_rnaseq.tools import rsemgenemapping_version
+from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools import star_version
+from toil_rnaseq.tools.execution import tool_backend
+
+# Images pulled at once. The Docker daemon also downloads several layers of each image concurrently
+pull_threads = 4
+
+# Held while a node's images are pulled, so samples that start on the same node at once don't pull twice
+lock_path = os.path.join(tempfile.gettempdir(), 'toil-rnaseq-images.lock')
+
+
+def required_images(config, samples=None):
+    """
+    Images of the tools a run will use
+
+    >>> from toil_rnaseq.utils.expando import Expando
+    >>> config = Expando(cutadapt=True, fastqc=None, star_index=None, rsem_ref=None, hugo_mapping=None,
+    ...                  save_bam=None, bamqc=None, kallisto_index='kallisto.idx', hera_index=None,
+    ...                  summarize_bootstraps=None, gdc_token=None)
+    >>> [x.split('/')[-1].split(':')[0] for x in required_images(config, [['fq', 'paired', 'uuid', 'file:///R1']])]
+    ['cutadapt', 'kallisto']
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param list(list(str)) samples: Samples parsed from the manifest. If None, images for every input type are included
+    :return: Docker images
+    :rtype: list(str)
+    """
+    images = []
+    if samples is None or any(x[0] == 'bam' for x in samples):
+        images += [samtools_version, picardtools_version]
+    if samples is None and config.gdc_token or samples and any('gdc://' in x[3] for x in samples):
+        images.append(gdc_version)
+    if config.cutadapt:
+        images.append(cutadapt_version)
+    if config.fastqc:
+        images.append(fastqc_version)
+    if config.star_index:
+        images.append(star_version)
+        if config.rsem_ref:
+            images.append(rsem_version)
+            if not config.hugo_mapping:
+                images.append(rsemgenemapping_version)
+        if config.save_bam or config.bamqc:
+            images.append(samtools_version)
+        if config.bamqc:
+            images.append(bamqc_version)
+    if config.kallisto_index or config.hera_index and config.summarize_bootstraps:
+        images.append(kallisto_version)
+    if config.hera_index:
+        images.append(hera_version)
+    return sorted(set(images))
+
+
+def pull_images(images, num_threads=pull_threads, docker='docker'):
+    """
+    Pulls images concurrently, skipping those already on this node
+
+    :param list(str) images: Docker images
+    :param int num_threads: Number of images pulled at once
+    :param str docker: Docker command
+    :return: Result of each image, see `pull_image`
+    :rtype: list(dict)
+    """
+    if not images:
+        return []
+    pool = ThreadPool(min(num_threads, len(images)))
+    try:
+        return pool.map(lambda x: pull_image(x, docker=docker), images)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pull_image(image, docker='docker'):
+    """
+    Pulls an image unless it is already on this node
+
+    :param str image: Docker image
+    :param str docker: Docker command
+    :return: Image, whether it was already on the node (cached), seconds taken, and the error if the pull failed
+    :rtype: dict
+    """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        cached = subprocess.call([docker, 'image', 'inspect', image], stdout=devnull, stderr=devnull) == 0
+    error = None
+    if not cached:
+        p = subprocess.Popen([docker, 'pull', image], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = p.communicate()
+        if p.returncode:
+            error = stderr.strip() or 'docker pull exit code {}'.format(p.returncode)
+    return {'image': image, 'cached': cached, 'seconds': time.time() - start, 'error': error}
+
+
+def format_pulls(results):
+    """
+    Describes the result of each pull, one line each, followed by a summary
+
+    >>> print(format_pulls([{'image': 'star:2.4', 'cached': True, 'seconds': 0.1, 'error': None},
+    ...                     {'image': 'rsem:1.2', 'cached': False, 'seconds': 42.0, 'error': None}]))
+    star:2.4  cached  0s
+    rsem:1.2  pulled  42s
+    1 of 2 images cached, 1 pulled in 42s, 0 failed
+
+    :param list(dict) results: Results from `pull_images`
+    :rtype: str
+    """
+    width = max(len(x['image']) for x in results) if results else 0
+    lines = []
+    for x in results:
+        status = 'cached' if x['cached'] else 'failed' if x['error'] else 'pulled'
+        line = '{}  {}  {:.0f}s'.format(x['image'].ljust(width), status, x['seconds'])
+        lines.append(line + ('  ' + x['error'] if x['error'] else ''))
+    pulled = [x for x in results if not x['cached'] and not x['error']]
+    lines.append('{} of {} images cached, {} pulled in {:.0f}s, {} failed'.format(
+        sum(1 for x in results if x['cached']), len(results), len(pulled), sum(x['seconds'] for x in pulled),
+        sum(1 for x in results if x['error'])))
+    return '\n'.join(lines)
+
+
+def warm_up(job, config, samples):
+    """
+    Pulls the images a sample needs on the node its first job runs on, before its tool jobs are scheduled.
+    Samples starting at once on a node wait for the first to finish pulling, then find the images cached.
+    A failed pull is only logged, the tool's own job pulls the image again. Tools not run with Docker are skipped.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param list(list(str)) samples: Samples whose images are pulled
+    :return: Result of each image, see `pull_image`
+    :rtype: list(dict)
+    """
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results = pull_images([x for x in required_images(config, samples)
+                               if tool_backend(x, config.tool_backends or {}) == 'docker'])
+    job.log('Warmed up images:\n' + format_pulls(results))
+    return results
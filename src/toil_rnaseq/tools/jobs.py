@@ -1,9 +1,25 @@
+import json
+import math
 import os
+import struct
 import tarfile
+from StringIO import StringIO
 from contextlib import closing
 
 from toil_rnaseq.utils import partitions
+from toil_rnaseq.utils.archive import BlockGzipFile
+from toil_rnaseq.utils.archive import HashingReader
+from toil_rnaseq.utils.archive import finish_index
+from toil_rnaseq.utils.archive import index_entry
+from toil_rnaseq.utils.archive import index_name
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.matrix import append_sample
+from toil_rnaseq.utils.matrix import tables
 from toil_rnaseq.utils.urls import move_or_upload
+from toil_rnaseq.utils.urls import output_stream
+
+# Byte offsets of samples in the manifest stored by `store_samples`: little-endian unsigned 64-bit
+offset_format = '<Q'
 
 
 def cleanup_ids(job, ids_to_delete):
@@ -16,28 +32,81 @@ def cleanup_ids(job, ids_to_delete):
     [job.fileStore.deleteGlobalFile(x) for x in ids_to_delete if x is not None]
 
 
-def map_job(job, func, inputs, *args):
+def store_samples(toil, samples, work_dir, branching_factor=100, leaf_size=100, batch_size=1):
+    """
+    Imports samples into the job store as a manifest of tab-separated lines and an index of each line's byte
+    offset, so jobs only carry the range of samples they are responsible for rather than the samples themselves.
+
+    :param Toil toil: Toil context the workflow is started from
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param str work_dir: Directory to write the manifest and index to before import
+    :param int branching_factor: Maximum number of children spawned by a job in the tree
+    :param int leaf_size: Maximum number of samples spawned by a leaf of the tree
+    :param int batch_size: If greater than 1, leaves spawn jobs for batches of up to this many samples
+    :return: Description of all samples for use with `map_job`
+    :rtype: Expando
+    """
+    manifest_path = os.path.join(work_dir, 'samples.tsv')
+    index_path = os.path.join(work_dir, 'samples.idx')
+    with open(manifest_path, 'w') as f_manifest, open(index_path, 'wb') as f_index:
+        for sample in samples:
+            f_index.write(struct.pack(offset_format, f_manifest.tell()))
+            f_manifest.write('\t'.join(sample) + '\n')
+        f_index.write(struct.pack(offset_format, f_manifest.tell()))
+    return Expando(manifest_id=toil.importFile('file://' + manifest_path),
+                   index_id=toil.importFile('file://' + index_path),
+                   start=0, stop=len(samples), branching_factor=branching_factor, leaf_size=leaf_size,
+                   batch_size=batch_size)
+
+
+def map_job(job, func, samples, *args):
     """
     Spawns a tree of jobs to avoid overloading the number of jobs spawned by a single parent.
-    This function is appropriate to use when batching samples greater than 1,000.
+    The tree is expanded lazily: each job splits its range of samples among at most `branching_factor` children
+    until a range holds no more than `leaf_size` samples, at which point the samples are read from the job store.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
-    :param function func: Function to spawn dynamically, passes one sample as first argument
-    :param list inputs: Array of samples to be batched
+    :param function func: Function to spawn dynamically, passes one sample as first argument, or a list of
+        samples if `samples` has a batch size greater than 1
+    :param Expando samples: Range of samples to be batched, from `store_samples`
     :param list args: any arguments to be passed to the function
     """
-    # num_partitions isn't exposed as an argument in order to be transparent to the user.
-    # The value for num_partitions is a tested value
-    num_partitions = 100
-    partition_size = len(inputs) / num_partitions
-    if partition_size > 1:
-        for partition in partitions(inputs, partition_size):
-            job.addChildJobFn(map_job, func, partition, *args)
+    num_samples = samples.stop - samples.start
+    if num_samples > samples.leaf_size:
+        num_children = min(samples.branching_factor, int(math.ceil(num_samples / float(samples.leaf_size))))
+        bounds = [samples.start + num_samples * i // num_children for i in xrange(num_children + 1)]
+        for start, stop in zip(bounds, bounds[1:]):
+            child = samples.copy()
+            child.start, child.stop = start, stop
+            job.addChildJobFn(map_job, func, child, *args)
+    elif samples.batch_size > 1:
+        for batch in partitions(read_samples(job, samples), samples.batch_size):
+            job.addChildJobFn(func, batch, *args)
     else:
-        for sample in inputs:
+        for sample in read_samples(job, samples):
             job.addChildJobFn(func, sample, *args)
 
 
+def read_samples(job, samples):
+    """
+    Reads a range of samples from the manifest in the job store
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando samples: Range of samples, from `store_samples`
+    :return: Samples in the range
+    :rtype: list(list(str))
+    """
+    offset_size = struct.calcsize(offset_format)
+    with open(job.fileStore.readGlobalFile(samples.index_id), 'rb') as f:
+        f.seek(samples.start * offset_size)
+        start = struct.unpack(offset_format, f.read(offset_size))[0]
+        f.seek(samples.stop * offset_size)
+        stop = struct.unpack(offset_format, f.read(offset_size))[0]
+    with open(job.fileStore.readGlobalFile(samples.manifest_id)) as f:
+        f.seek(start)
+        return [line.split('\t') for line in f.read(stop - start).splitlines()]
+
+
 def save_wiggle(job, config, wiggle_id):
     """
     Saves wiggle file that is output from STAR
@@ -51,30 +120,60 @@ def save_wiggle(job, config, wiggle_id):
     move_or_upload(config, [wiggle_path], enforce_ssec=False)
 
 
+def save_wiggle_file(config, wiggle_path):
+    """
+    Saves a local wiggle file that is output from STAR, tagged with the sample UUID
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str wiggle_path: Path to STAR's wiggle file
+    """
+    new_path = os.path.join(os.path.dirname(wiggle_path), config.uuid + '.wiggle.bg')
+    os.rename(wiggle_path, new_path)
+    move_or_upload(config, [new_path], enforce_ssec=False, owned=True)
+
+
 def consolidate_output(job, config, output):
     """
-    Combines the contents of the outputs into one tarball and places in output directory or s3
+    Combines the contents of the outputs into one tarball and places in output directory or s3.
+    Each tool's (uncompressed) tarball is streamed from the fileStore, so the output is compressed exactly once,
+    using the job's cores, and written to the output location (or uploaded to S3) as it is compressed.
+    Each member is compressed into its own gzip blocks and indexed in a sidecar (<UUID>.index.json) with its
+    tool, size, sha256, and byte ranges, so it can be read without the rest of the tarball (see `read_member`).
+    If a cohort matrix is configured, the sample's quantifications are added to it.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param Expando config: Dict-like object containing workflow options as attributes
-    :param dict(str, str) output:
+    :param dict(str, str) output: FileStoreID of each tool's tarball, keyed by its directory in the output
     """
     job.log('Consolidating output: {}'.format(config.uuid))
 
-    # Collect all tarballs from fileStore
-    tars = {}
-    for tool, filestore_id in output.iteritems():
-        tars[os.path.join(config.uuid, tool)] = job.fileStore.readGlobalFile(filestore_id)
-
-    # Consolidate tarballs into one output tar as streams (to avoid unnecessary decompression)
-    out_tar = os.path.join(job.tempDir, config.uuid + '.tar.gz')
-    with tarfile.open(out_tar, 'w:gz') as f_out:
-        for name, tar in tars.iteritems():
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        tarinfo.name = os.path.join(name, os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-
-    # Move to output location
-    move_or_upload(config, files=[out_tar], enforce_ssec=False)
+    # Members are copied between tar streams without being written to disk. Outputs of older runs may be gzipped
+    # Quantifications for the cohort matrix are kept in memory as they pass through
+    quantifications, entries = {}, []
+    archive_name = config.uuid + '.tar.gz'
+    with output_stream(config, archive_name, enforce_ssec=False) as f_out, \
+            BlockGzipFile(f_out, cores=job.cores) as f_gz:
+        # Not a stream ("w|"), which would buffer across members, so each member's header starts a new block
+        with tarfile.open(fileobj=f_gz, mode='w') as tar_out:
+            for name, filestore_id in output.iteritems():
+                with job.fileStore.readGlobalFileStream(filestore_id) as f_in:
+                    with tarfile.open(fileobj=f_in, mode='r|*') as tar_in:
+                        for tarinfo in tar_in:
+                            with closing(tar_in.extractfile(tarinfo)) as f_in_file:
+                                table = tables.get((name, os.path.basename(tarinfo.name)))
+                                if config.cohort_matrix and table:
+                                    quantifications[table] = f_in_file.read()
+                                    f_in_file = StringIO(quantifications[table])
+                                tarinfo.name = os.path.join(config.uuid, name, os.path.basename(tarinfo.name))
+                                start, header_offset = f_gz.new_block(), f_gz.tell()
+                                f_in_file = HashingReader(f_in_file)
+                                tar_out.addfile(tarinfo, fileobj=f_in_file)
+                                entries.append(index_entry(name, tarinfo, header_offset, f_gz.tell(),
+                                                           f_in_file.sha256.hexdigest(), (start, f_gz.new_block())))
+
+    # The index is written once the tarball is complete
+    with output_stream(config, index_name(archive_name), enforce_ssec=False) as f_out:
+        json.dump(finish_index(entries, f_gz, archive_name), f_out, indent=2, sort_keys=True)
+    if quantifications:
+        append_sample(config.cohort_matrix, config.uuid, quantifications)
+        job.log('Added {} to the cohort matrix: {}'.format(config.uuid, ', '.join(sorted(quantifications))))
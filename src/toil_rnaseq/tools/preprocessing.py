@@ -1,17 +1,31 @@
 import os
 import re
+import shutil
 import subprocess
 from subprocess import PIPE
 from urlparse import urlparse
 
+from toil.fileStore import FileID
 from toil.job import PromisedRequirement
-from toil.lib.docker import dockerCall
 
+from bams import assert_bam_is_paired_end
 from bams import convert_bam_to_fastq
+from bams import convert_read_group_to_fastq
 from bams import download_bam_from_gdc
+from bams import shardable_read_groups
 from jobs import cleanup_ids
 from toil_rnaseq.tools import cutadapt_version
+from toil_rnaseq.tools import picardtools_version
+from toil_rnaseq.tools import samtools_version
+from toil_rnaseq.tools.profiling import docker_call
+from toil_rnaseq.tools.profiling import profile_stage
 from toil_rnaseq.utils import require, UserError
+from toil_rnaseq.utils.cache import fetch
+from toil_rnaseq.utils.cache import stage_key
+from toil_rnaseq.utils.cache import store
+from toil_rnaseq.utils.cache import url_identity
+from toil_rnaseq.utils.preflight import input_sizes
+from toil_rnaseq.utils.resources import predict
 from toil_rnaseq.utils.urls import download_url
 from toil_rnaseq.utils.urls import download_url_job
 
@@ -29,6 +43,7 @@ def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
     :rtype: tuple(str, str)
     """
     # Retrieve files and define parameters
+    profile_stage(job, 'cutadapt', sum(x.size for x in [r1_id, r2_id] if x))
     job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
     parameters = ['-a', fwd_3pr_adapter,
                   '-m', '35']
@@ -45,7 +60,7 @@ def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
         parameters.extend(['-o', '/data/R1_cutadapt.fastq', '/data/R1.fastq'])
 
     # Call: CutAdapt
-    dockerCall(job=job, tool=cutadapt_version, workDir=job.tempDir, parameters=parameters)
+    docker_call(job=job, tool=cutadapt_version, workDir=job.tempDir, parameters=parameters)
 
     # Write to fileStore
     r1_cut_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'R1_cutadapt.fastq'))
@@ -54,6 +69,63 @@ def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
     return r1_cut_id, r2_cut_id
 
 
+def preprocess(job, config):
+    """
+    Downloads and processes a sample into a fastq pair (or single fastq if single-ended) based on its file type.
+    If the stage cache is enabled, fastqs from an identical earlier run are reused.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :return: FileStoreIDs of R1 / R2 fastq files
+    :rtype: tuple(str, str)
+    """
+    # Inputs are identified by their content hash or ETag, and aren't cached if that can't be found
+    key = None
+    identities = [url_identity(x) for x in config.url.split(',')] if config.cache else []
+    if None in identities:
+        job.log('Not caching fastqs for {}, inputs could not be identified'.format(config.uuid))
+    elif identities:
+        key = stage_key('preprocessing', [cutadapt_version, samtools_version, picardtools_version],
+                        [config.file_type, config.paired, config.cutadapt, config.fwd_3pr_adapter,
+                         config.rev_3pr_adapter], identities)
+        cached = fetch(config.cache, key, job.tempDir)
+        if cached:
+            job.log('Reusing cached fastqs for {}'.format(config.uuid))
+            return tuple(job.fileStore.writeGlobalFile(cached[x]) if x in cached else None
+                         for x in ['R1.fastq', 'R2.fastq'])
+
+    if config.file_type == 'bam':
+        disk = predict(config.resources, 'bam', 'disk', sum(input_sizes(config)))
+        process = job.addChildJobFn(download_and_process_bam, config, disk=disk)
+    elif config.file_type == 'tar':
+        process = job.addChildJobFn(download_and_process_tar, config)
+    else:
+        config.gz = True if config.url.split(',')[0].endswith('gz') else None  # Check if fastqs are gzipped
+        process = job.addChildJobFn(download_and_process_fastqs, config)
+
+    if key:
+        disk = PromisedRequirement(lambda xs: sum(x.size for x in xs if x), process.rv())
+        return process.addFollowOnJobFn(store_fastqs, config.cache, key, process.rv(), disk=disk).rv()
+    return process.rv()
+
+
+def store_fastqs(job, cache, key, fastq_ids):
+    """
+    Stores processed fastqs in the stage cache
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando cache: Location of the stage cache
+    :param str key: Key of the preprocessing stage
+    :param tuple(str, str) fastq_ids: FileStoreIDs of R1 / R2 fastq files
+    :return: `fastq_ids`
+    :rtype: tuple(str, str)
+    """
+    paths = [job.fileStore.readGlobalFile(x, os.path.join(job.tempDir, name))
+             for x, name in zip(fastq_ids, ['R1.fastq', 'R2.fastq']) if x]
+    store(cache, key, paths, job.fileStore.getLocalTempDir())
+    return fastq_ids
+
+
 def download_and_process_tar(job, config):
     """
     Download tarball containing fastq(s) and process
@@ -64,10 +136,11 @@ def download_and_process_tar(job, config):
     :rtype: tuple(str, str)
     """
     # Define download and process jobs
-    disk = '2G' if config.ci_test else config.max_sample_size
-    download = job.wrapJobFn(download_url_job, config.url, s3_key_path=config.ssec, disk=disk)
+    model = config.resources
+    download = job.wrapJobFn(download_url_job, config.url, s3_key_path=config.ssec,
+                             disk=predict(model, 'download', 'disk', sum(input_sizes(config))))
     process = job.wrapJobFn(process_sample, config, input_tar=download.rv(),
-                            disk=PromisedRequirement(lambda x: x.size * 10, download.rv()))
+                            disk=PromisedRequirement(lambda x: predict(model, 'tar', 'disk', x.size), download.rv()))
 
     # Wire jobs and return processed fastqs
     job.addChild(download)
@@ -84,10 +157,10 @@ def download_and_process_fastqs(job, config):
     :rtype: tuple(str, str)
     """
     # Define download and process jobs
-    disk = '2G' if config.ci_test else config.max_sample_size
-    download = job.wrapJobFn(multiple_fastq_dowloading, config, sample_disk=disk).encapsulate()
-    process = job.wrapJobFn(process_sample, config, fastq_ids=download.rv(),
-                            disk=PromisedRequirement(lambda xs: sum(x.size for x in xs) * 5, download.rv()))
+    model = config.resources
+    download = job.wrapJobFn(multiple_fastq_dowloading, config).encapsulate()
+    disk = PromisedRequirement(lambda xs: predict(model, 'fastqs', 'disk', sum(x.size for x in xs)), download.rv())
+    process = job.wrapJobFn(process_sample, config, fastq_ids=download.rv(), disk=disk)
 
     # Wire jobs and return processed fastqs
     job.addChild(download)
@@ -105,6 +178,7 @@ def download_and_process_bam(job, config):
     :rtype: tuple(str, str)
     """
     parsed_url = urlparse(config.url)
+    profile_stage(job, 'bam', sum(input_sizes(config)))
 
     # Download BAM
     if parsed_url.scheme == 'gdc':
@@ -112,17 +186,62 @@ def download_and_process_bam(job, config):
     else:
         bam_path = download_url(config.url, work_dir=job.tempDir, name='input.bam', s3_key_path=config.ssec)
 
+    # Fan out one conversion job per read group for multi-lane BAMs
+    model = config.resources
+    read_groups = shardable_read_groups(job, bam_path) if config.shard_bam_by_read_group else []
+    if read_groups:
+        job.log('Converting {} read groups of {} in parallel'.format(len(read_groups), config.uuid))
+        assert_bam_is_paired_end(job, bam_path)
+        bam_id = job.fileStore.writeGlobalFile(bam_path)
+        disk = predict(model, 'bam-shard', 'disk', bam_id.size)
+        shards = [job.addChildJobFn(convert_read_group_to_fastq, bam_id, read_group, disk=disk).rv()
+                  for read_group in read_groups]
+        gather = job.addFollowOnJobFn(concatenate_fastq_shards, shards, ids_to_delete=[bam_id])
+        if config.cutadapt:
+            disk = PromisedRequirement(lambda r1, r2: predict(model, 'cutadapt', 'disk', r1.size + r2.size),
+                                       gather.rv(0), gather.rv(1))
+            return gather.addChildJobFn(run_cutadapt, gather.rv(0), gather.rv(1), config.fwd_3pr_adapter,
+                                        config.rev_3pr_adapter, disk=disk).rv()
+        return gather.rv()
+
     # Convert to fastq pairs
     r1, r2 = convert_bam_to_fastq(job, bam_path)
 
     # Return fastq files
     if config.cutadapt:
-        disk = 2 * (r1.size + r2.size)
+        disk = predict(model, 'cutadapt', 'disk', r1.size + r2.size)
         return job.addChildJobFn(run_cutadapt, r1, r2, config.fwd_3pr_adapter,
                                  config.rev_3pr_adapter, disk=disk).rv()
     return r1, r2
 
 
+def concatenate_fastq_shards(job, shards, ids_to_delete=None):
+    """
+    Concatenates per-shard FASTQ pairs into one pair, streaming each shard from and to the fileStore,
+    so nothing is written to the job's disk
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list(tuple(str, str)) shards: FileStoreIDs for R1 and R2 of each shard
+    :param list(str) ids_to_delete: Additional FileStoreIDs to delete once shards are concatenated
+    :return: FileStoreIDs of R1 / R2 fastq files
+    :rtype: tuple(str, str)
+    """
+    fastq_ids = []
+    for i in range(2):
+        size = 0
+        with job.fileStore.writeGlobalFileStream() as (f_out, fastq_id):
+            for shard in shards:
+                with job.fileStore.readGlobalFileStream(shard[i]) as f_in:
+                    shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+                size += shard[i].size
+        # Streamed files have no size, which the requirements of later jobs are predicted from
+        fastq_ids.append(FileID(fastq_id, size))
+
+    # Shards are no longer needed
+    cleanup_ids(job, [x for shard in shards for x in shard] + (ids_to_delete or []))
+    return tuple(fastq_ids)
+
+
 def process_sample(job, config, input_tar=None, fastq_ids=None):
     """
     Converts sample.tar(.gz) or collection of fastqs into a fastq pair (or single fastq if single-ended.)
@@ -188,7 +307,7 @@ def process_sample(job, config, input_tar=None, fastq_ids=None):
             p2.wait()
             processed_r1 = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'R1.fastq'))
             processed_r2 = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'R2.fastq'))
-        disk = 2 * (processed_r1.size + processed_r2.size)
+        disk = predict(config.resources, 'cutadapt', 'disk', processed_r1.size + processed_r2.size)
     else:
         command = 'zcat' if fastqs[0].endswith('.gz') else 'cat'
         if command == 'cat' and len(fastqs) == 1:
@@ -198,7 +317,7 @@ def process_sample(job, config, input_tar=None, fastq_ids=None):
             with open(os.path.join(job.tempDir, 'R1.fastq'), 'w') as f:
                 subprocess.check_call([command] + fastqs, stdout=f)
             processed_r1 = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'R1.fastq'))
-        disk = 2 * processed_r1.size
+        disk = predict(config.resources, 'cutadapt', 'disk', processed_r1.size)
 
     # Cleanup Intermediates
     ids_to_delete = [input_tar] + fastq_ids if delete_fastqs and fastq_ids else [input_tar]
@@ -212,13 +331,13 @@ def process_sample(job, config, input_tar=None, fastq_ids=None):
         return processed_r1, processed_r2
 
 
-def multiple_fastq_dowloading(job, config, sample_disk):
+def multiple_fastq_dowloading(job, config):
     """
-    Convenience function for handling the downloading of multiple fastq files
+    Convenience function for handling the downloading of multiple fastq files.
+    Each download job's disk is sized from its fastq's size if found during pre-flight.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param Expando config: Dict-like object containing workflow options as attributes
-    :param int sample_disk: Amount of disk space to allocate to download jobs
     :return: FileStoreIDs for all fastqs downloaded
     :rtype: list(str,)
     """
@@ -227,7 +346,8 @@ def multiple_fastq_dowloading(job, config, sample_disk):
     urls = config.url.split(',')
     if config.paired:
         require(len(urls) % 2 == 0, 'Fastq pairs must have multiples of 2 URLS separated by comma')
-    for url in urls:
-        fastq_ids.append(job.addChildJobFn(download_url_job, url, s3_key_path=config.ssec, disk=sample_disk).rv())
+    for url, size in zip(urls, input_sizes(config)):
+        disk = predict(config.resources, 'download', 'disk', size)
+        fastq_ids.append(job.addChildJobFn(download_url_job, url, s3_key_path=config.ssec, disk=disk).rv())
 
     return fastq_ids
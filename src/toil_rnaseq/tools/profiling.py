@@ -0,0 +1,309 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+from toil.lib.docker import dockerCall
+from toil.lib.docker import dockerCheckOutput
+
+from toil_rnaseq.tools.execution import execute
+from toil_rnaseq.tools.execution import tool_backend
+from toil_rnaseq.tools.execution import tool_name
+from toil_rnaseq.tools.watchdog import Stalled
+
+# Profiles of every tool call made by a job, keyed by id(job). Calls may come from several threads.
+_profiles = defaultdict(list)
+_lock = threading.Lock()
+
+# Stage of `toil_rnaseq.utils.resources.priors` and input size of each job, keyed by id(job). See `profile_stage`
+_stages = {}
+
+# Seconds between samples of a running tool's work directory and, for containers, cgroup
+sample_interval = 1
+
+# Prefix of the log line holding each tool call's record, read back by `toil-rnaseq fit-resources`
+log_prefix = 'Tool profile: '
+
+# Locations of a container's cgroup for cgroup v1, and for cgroup v2 with the systemd or cgroupfs driver
+_cgroup_v1 = '/sys/fs/cgroup/{controller}/docker/{id}'
+_cgroup_v2 = ['/sys/fs/cgroup/system.slice/docker-{id}.scope', '/sys/fs/cgroup/docker/{id}']
+
+
+def docker_call(job, tool, parameters=None, workDir=None, dockerParameters=None, outfile=None, watchdog=None,
+                record_as=None, stage=None):
+    """
+    Profiled version of `toil.lib.docker.dockerCall`. Takes the same arguments, and optionally a
+    `toil_rnaseq.tools.watchdog.Watchdog` that follows the tool while it runs. `Stalled` is raised if it stops the tool.
+    Tools configured to run with Singularity or natively ignore `dockerParameters`, see `tool-backends`.
+    Calls made with another tool's image, e.g. Hera's h5dump with Kallisto's, are profiled under `record_as`.
+    Calls of a stage run within another stage's job, e.g. RSEM's within STAR's, are recorded under `stage`,
+    a (name, input_bytes) tuple that takes the place of the job's `profile_stage` for this call.
+    """
+    return _profiled(job, dockerCall, tool, parameters, workDir, dockerParameters, outfile=outfile,
+                     watchdog=watchdog, record_as=record_as, stage=stage)
+
+
+def docker_check_output(job, tool, parameters=None, workDir=None, dockerParameters=None):
+    """
+    Profiled version of `toil.lib.docker.dockerCheckOutput`. Takes the same arguments.
+    Tools configured to run with Singularity or natively ignore `dockerParameters`, see `tool-backends`.
+    """
+    return _profiled(job, dockerCheckOutput, tool, parameters, workDir, dockerParameters)
+
+
+def profile_stage(job, stage, input_bytes):
+    """
+    Records a job's tool calls under a stage of `toil_rnaseq.utils.resources.priors`, with the input size the workflow
+    predicted the job's requirements from (reads, not indexes or references), so fitted models are used the same way.
+    Calls of jobs without a stage are recorded under their tool's name, without an input size.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str stage: Name of stage, e.g. "star-colocated"
+    :param int input_bytes: Size of the job's input in bytes
+    """
+    with _lock:
+        _stages[id(job)] = (stage, input_bytes)
+
+
+def records(job):
+    """
+    Profiles of the tool calls made so far by a job
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :return: One record per tool call
+    :rtype: list(dict)
+    """
+    with _lock:
+        return list(_profiles[id(job)])
+
+
+def write_profile(job, work_dir, name='profile.json', start=0, image=None):
+    """
+    Writes the profiles of a job's tool calls as JSON, for inclusion in the job's output tarball.
+    The records can be passed to `toil-rnaseq fit-resources` as job history.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str work_dir: Directory to write the profile to
+    :param str name: Name of the profile
+    :param int start: Index of the first record to write, for jobs that process several samples
+    :param str image: Only write records of this Docker image, for jobs that run several tools concurrently
+    :return: Path to profile
+    :rtype: str
+    """
+    path = os.path.join(work_dir, name)
+    with open(path, 'w') as f:
+        json.dump([x for x in records(job)[start:] if image in (None, x['image'])], f, indent=2, sort_keys=True)
+    return path
+
+
+def _profiled(job, func, tool, parameters, work_dir, docker_parameters, **kwargs):
+    """
+    Runs a container through `func` while a background thread samples its cgroup and the size of its work directory.
+    Tools with another backend run through `execute`, which measures the resource usage of their process instead.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: dockerCall or dockerCheckOutput
+    :param str tool: Docker image
+    :param list(str) parameters: Parameters passed to the container
+    :param str work_dir: Directory mounted into the container as /data
+    :param list(str) docker_parameters: Parameters passed to `docker run`
+    :return: Return value of `func`
+    """
+    watchdog = kwargs.pop('watchdog', None)
+    record_as = kwargs.pop('record_as', None) or tool
+    call_stage = kwargs.pop('stage', None)
+    work_dir = os.path.abspath(work_dir or os.getcwd())
+    backend = tool_backend(tool)
+    name = 'toil-rnaseq-' + uuid4().hex
+    if docker_parameters is None:
+        docker_parameters = ['--rm', '--log-driver', 'none', '-v', work_dir + ':/data']
+    docker_parameters = docker_parameters + ['--name', name]
+
+    before = _file_stats(work_dir)
+    sampler = _Sampler(work_dir, name if backend == 'docker' else None)
+    usage = {}
+    sampler.start()
+    if watchdog:
+        if backend == 'docker':
+            watchdog.stop_tool = lambda: _kill_container(name)
+            watchdog.cpu_seconds = lambda: sampler.stats.get('cpu_seconds')
+        watchdog.start()
+    start = time.time()
+    try:
+        if backend == 'docker':
+            return func(job, tool=tool, parameters=parameters, workDir=work_dir,
+                        dockerParameters=docker_parameters, **kwargs)
+        output, usage = execute(tool, parameters, work_dir, backend, outfile=kwargs.get('outfile'),
+                                check_output=func is dockerCheckOutput,
+                                started=lambda p: setattr(watchdog, 'stop_tool', p.kill) if watchdog else None)
+        return output
+    except Exception:
+        if watchdog and watchdog.stopped:
+            raise Stalled('{} was stopped by its watchdog after stalling'.format(tool))
+        raise
+    finally:
+        wall_seconds = time.time() - start
+        if watchdog:
+            watchdog.stop()
+        sampler.stop()
+        after = _file_stats(work_dir)
+        with _lock:
+            stage, input_bytes = call_stage or _stages.get(id(job), (None, None))
+        stats = dict(sampler.stats) if backend == 'docker' else dict(usage)
+        stats.pop('disk', None)
+        record = dict(stats,
+                      tool=stage or tool_name(record_as),
+                      image=record_as,
+                      backend=backend,
+                      wall_seconds=round(wall_seconds, 3),
+                      input_bytes=input_bytes,
+                      output_bytes=sum(size for path, (size, mtime) in after.iteritems()
+                                       if before.get(path) != (size, mtime)),
+                      disk=max(_disk_bytes(before), sampler.stats.get('disk', 0), _disk_bytes(after)))
+        with _lock:
+            _profiles[id(job)].append(record)
+        job.log(log_prefix + json.dumps(record, sort_keys=True))
+
+
+def _kill_container(name):
+    """
+    Kills a running container
+
+    :param str name: Name of container
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['docker', 'kill', name], stdout=devnull, stderr=devnull)
+
+
+def _file_stats(work_dir):
+    """
+    Size and modification time of every file under a directory
+
+    :param str work_dir: Directory to walk
+    :return: (size, mtime) keyed by path
+    :rtype: dict
+    """
+    stats = {}
+    for root, _, files in os.walk(work_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_size, st.st_mtime)
+    return stats
+
+
+def _disk_bytes(stats):
+    """
+    Total size of the files of a directory
+
+    :param dict stats: Output of `_file_stats`
+    :rtype: int
+    """
+    return sum(size for size, _ in stats.itervalues())
+
+
+class _Sampler(threading.Thread):
+    """
+    Periodically measures the peak size of a tool's work directory (disk) and, for a named container, reads its
+    CPU time, memory, and block I/O from its cgroup. Values are kept from the last sample taken before the tool exited.
+    """
+
+    def __init__(self, work_dir, container_name=None):
+        super(_Sampler, self).__init__()
+        self.daemon = True
+        self.work_dir = work_dir
+        self.container_name = container_name
+        self.container_id = None
+        self.stats = {}
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.stats['disk'] = max(_disk_bytes(_file_stats(self.work_dir)), self.stats.get('disk', 0))
+            if self.container_name and self.container_id is None:
+                self.container_id = _container_id(self.container_name)
+            if self.container_id:
+                self._sample()
+            self._done.wait(sample_interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def _sample(self):
+        cid = self.container_id
+        v2 = next((x.format(id=cid) for x in _cgroup_v2 if os.path.isdir(x.format(id=cid))), None)
+        if v2:
+            cpu = _read_keyed(os.path.join(v2, 'cpu.stat')).get('usage_usec')
+            cpu = cpu / 1e6 if cpu is not None else None
+            memory = _read_int(os.path.join(v2, 'memory.peak')) or _read_int(os.path.join(v2, 'memory.current'))
+            io = _read_io_v2(os.path.join(v2, 'io.stat'))
+        else:
+            cpu = _read_int(os.path.join(_cgroup_v1.format(controller='cpuacct', id=cid), 'cpuacct.usage'))
+            cpu = cpu / 1e9 if cpu is not None else None
+            memory = _read_int(os.path.join(_cgroup_v1.format(controller='memory', id=cid),
+                                            'memory.max_usage_in_bytes'))
+            io = _read_io_v1(os.path.join(_cgroup_v1.format(controller='blkio', id=cid),
+                                          'blkio.throttle.io_service_bytes'))
+        if cpu is not None:
+            self.stats['cpu_seconds'] = round(cpu, 3)
+        if memory is not None:
+            self.stats['memory'] = max(memory, self.stats.get('memory', 0))
+        if io is not None:
+            self.stats['block_read_bytes'], self.stats['block_write_bytes'] = io
+
+
+def _container_id(name):
+    """
+    Full ID of a container, or None if it does not exist yet
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['docker', 'inspect', '--format', '{{.Id}}', name],
+                                           stderr=devnull).strip() or None
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def _read_keyed(path):
+    try:
+        with open(path) as f:
+            return {k: int(v) for k, v in (line.split() for line in f if len(line.split()) == 2)}
+    except (IOError, ValueError):
+        return {}
+
+
+def _read_io_v1(path):
+    try:
+        with open(path) as f:
+            lines = [line.split() for line in f]
+    except IOError:
+        return None
+    read = sum(int(x[2]) for x in lines if len(x) == 3 and x[1] == 'Read')
+    write = sum(int(x[2]) for x in lines if len(x) == 3 and x[1] == 'Write')
+    return read, write
+
+
+def _read_io_v2(path):
+    try:
+        with open(path) as f:
+            fields = [x.split('=') for line in f for x in line.split()[1:]]
+    except IOError:
+        return None
+    read = sum(int(v) for k, v in fields if k == 'rbytes')
+    write = sum(int(v) for k, v in fields if k == 'wbytes')
+    return read, write
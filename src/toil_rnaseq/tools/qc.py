@@ -1,11 +1,14 @@
 import os
 
-from toil.lib.docker import dockerCall
 
 from toil_rnaseq.tools import bamqc_version
 from toil_rnaseq.tools import fastqc_version
+from toil_rnaseq.tools.bams import save_alignment
+from toil_rnaseq.tools.profiling import docker_call
+from toil_rnaseq.tools.profiling import profile_stage
+from toil_rnaseq.tools.profiling import write_profile
+from toil_rnaseq.utils import docker_path
 from toil_rnaseq.utils.files import tarball_files
-from toil_rnaseq.utils.urls import move_or_upload
 
 
 def run_fastqc(job, r1_id, r2_id):
@@ -18,22 +21,40 @@ def run_fastqc(job, r1_id, r2_id):
     :return: FileStoreID of fastQC output (tarball)
     :rtype: str
     """
-    # Read in files and set parameters
-    job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
-    parameters = ['/data/R1.fastq']
+    # Read in files
+    profile_stage(job, 'fastqc', sum(x.size for x in [r1_id, r2_id] if x))
+    r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq')) if r2_id else None
+
+    # Call fastQC and return FileStoreID
+    return job.fileStore.writeGlobalFile(fastqc(job, job.tempDir, r1_path, r2_path))
+
+
+def fastqc(job, work_dir, r1_path, r2_path=None):
+    """
+    Runs FastQC on local fastqs and tars its output. Fastqs must be within `work_dir`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str work_dir: Directory mounted into the container, where output is written
+    :param str r1_path: Path to fastq read 1
+    :param str r2_path: Path to fastq read 2
+    :return: Path to output tarball
+    :rtype: str
+    """
+    parameters = [docker_path(r1_path)]
     output_names = ['R1_fastqc.html', 'R1_fastqc.zip']
-    if r2_id:
-        job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq'))
-        parameters.extend(['-t', '2', '/data/R2.fastq'])
+    if r2_path:
+        parameters.extend(['-t', '2', docker_path(r2_path)])
         output_names.extend(['R2_fastqc.html', 'R2_fastqc.zip'])
 
     # Call fastQC
-    dockerCall(job=job, tool=fastqc_version, workDir=job.tempDir, parameters=parameters)
+    docker_call(job=job, tool=fastqc_version, workDir=work_dir, parameters=parameters)
 
-    # Package output files and return FileStoreID
-    output_files = [os.path.join(job.tempDir, x) for x in output_names]
-    tarball_files(tar_name='fastqc.tar.gz', file_paths=output_files, output_dir=job.tempDir)
-    return job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'fastqc.tar.gz'))
+    # Package output files
+    output_files = [os.path.join(work_dir, x) for x in output_names]
+    output_files.append(write_profile(job, work_dir, image=fastqc_version))
+    tarball_files(tar_name='fastqc.tar', file_paths=output_files, output_dir=work_dir)
+    return os.path.join(work_dir, 'fastqc.tar')
 
 
 def run_bamqc(job, aligned_bam_id, config, save_bam=False):
@@ -48,25 +69,43 @@ def run_bamqc(job, aligned_bam_id, config, save_bam=False):
     :return: FileStoreID for output tar
     :rtype: str
     """
-    job.fileStore.readGlobalFile(aligned_bam_id, os.path.join(job.tempDir, 'input.bam'))
-    dockerCall(job, tool=bamqc_version, workDir=job.tempDir, parameters=['/data/input.bam', '/data'])
+    profile_stage(job, 'bamqc', aligned_bam_id.size)
+    bam_path = os.path.join(job.tempDir, 'input.bam')
+    job.fileStore.readGlobalFile(aligned_bam_id, bam_path)
+    tar_path = bamqc(job, bam_path, config, save_bam=save_bam)
+
+    # Delete intermediates
+    job.fileStore.deleteGlobalFile(aligned_bam_id)
+
+    return job.fileStore.writeGlobalFile(tar_path)
+
+
+def bamqc(job, bam_path, config, save_bam=False):
+    """
+    Runs BAMQC on a local BAM. Outputs are written to the directory containing the BAM
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str bam_path: Path to aligned bam from STAR
+    :param Expando config: Contains sample information
+    :param bool save_bam: Option to save mark-duplicate bam from BAMQC
+    :return: Path to output tar
+    :rtype: str
+    """
+    work_dir = os.path.dirname(os.path.abspath(bam_path))
+    docker_call(job, tool=bamqc_version, workDir=work_dir, parameters=[docker_path(bam_path), '/data'])
 
     # Tar Output files
     output_names = ['readDist.txt', 'bam_umend_qc.tsv', 'bam_umend_qc.json']
-    output_files = [os.path.join(job.tempDir, x) for x in output_names]
-    tarball_files(tar_name='bam_qc.tar.gz', file_paths=output_files, output_dir=job.tempDir)
-    tar_path = os.path.join(job.tempDir, 'bam_qc.tar.gz')
+    output_files = [os.path.join(work_dir, x) for x in output_names]
+    output_files.append(write_profile(job, work_dir, image=bamqc_version))
+    tarball_files(tar_name='bam_qc.tar', file_paths=output_files, output_dir=work_dir)
 
     # Save output BAM - this step is done here instead of in its own job for efficiency
     if save_bam:
         # Tag bam with sample UUID, upload, and delete
-        bam_path = os.path.join(job.tempDir, 'sortedByCoord.md.bam')
-        new_bam = os.path.join(job.tempDir, config.uuid + '.sortedByCoord.md.bam')
-        os.rename(bam_path, new_bam)
-        move_or_upload(config, [new_bam])
-        job.fileStore.deleteGlobalFile(new_bam)
-
-    # Delete intermediates
-    job.fileStore.deleteGlobalFile(aligned_bam_id)
+        md_bam = os.path.join(work_dir, 'sortedByCoord.md.bam')
+        new_bam = os.path.join(work_dir, config.uuid + '.sortedByCoord.md.bam')
+        os.rename(md_bam, new_bam)
+        save_alignment(job, config, new_bam)
 
-    return job.fileStore.writeGlobalFile(tar_path)
+    return os.path.join(work_dir, 'bam_qc.tar')
@@ -1,17 +1,57 @@
 import os
+import shutil
+import stat
 import subprocess
-
-from toil.lib.docker import dockerCall
+from multiprocessing.pool import ThreadPool
 
 from toil_rnaseq.tools import hera_version
 from toil_rnaseq.tools import kallisto_version
 from toil_rnaseq.tools import rsem_version
 from toil_rnaseq.tools import rsemgenemapping_version
+from toil_rnaseq.tools.profiling import docker_call
+from toil_rnaseq.tools.profiling import profile_stage
+from toil_rnaseq.tools.profiling import records
+from toil_rnaseq.tools.profiling import write_profile
+from toil_rnaseq.tools.qc import fastqc
+from toil_rnaseq.utils import docker_path
+from toil_rnaseq.utils.bootstraps import summarize_bootstraps
+from toil_rnaseq.utils.cache import fetch
+from toil_rnaseq.utils.cache import file_hash
+from toil_rnaseq.utils.cache import stage_key
+from toil_rnaseq.utils.cache import store
+from toil_rnaseq.utils.expando import Expando
 from toil_rnaseq.utils.files import tarball_files
+from toil_rnaseq.utils.hugo import load_table
+from toil_rnaseq.utils.hugo import map_rsem_output
 from toil_rnaseq.utils.urls import download_url
 
+# Bootstraps run by Kallisto and Hera, and whether they are summarized and kept, for configs without these options
+default_bootstraps = Expando(num=100, summarize=False, keep=True)
+
+# Prefix of RSEM's output files in the job's temporary directory
+rsem_prefix = 'rsem'
+
+
+def bootstrap_options(config, tool):
+    """
+    Bootstrap options of Kallisto or Hera. Raw bootstraps are always kept unless they are summarized.
+
+    >>> options = bootstrap_options(Expando(kallisto_bootstraps=30, summarize_bootstraps=True,
+    ...                                     keep_bootstraps=None), 'kallisto')
+    >>> sorted(options.items())
+    [('keep', False), ('num', 30), ('summarize', True)]
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str tool: "kallisto" or "hera"
+    :return: Number of bootstraps (num), whether to summarize them (summarize), and whether to keep them (keep)
+    :rtype: Expando
+    """
+    summarize = bool(config.summarize_bootstraps)
+    return Expando(num=config[tool + '_bootstraps'], summarize=summarize,
+                   keep=not summarize or bool(config.keep_bootstraps))
+
 
-def run_kallisto(job, r1_id, r2_id, kallisto_index_url):
+def run_kallisto(job, r1_id, r2_id, kallisto_index_url, cache=None, bootstraps=None):
     """
     RNA quantification via Kallisto
 
@@ -19,37 +59,111 @@ def run_kallisto(job, r1_id, r2_id, kallisto_index_url):
     :param str r1_id: FileStoreID of fastq (pair 1)
     :param str r2_id: FileStoreID of fastq (pair 2 if applicable, otherwise pass None for single-end)
     :param str kallisto_index_url: FileStoreID for Kallisto index file
+    :param Expando cache: If provided, Kallisto's output is reused from / stored in this stage cache
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
     :return: FileStoreID from Kallisto output
     :rtype: str
     """
-    # Retrieve files and define parameters
-    download_url(url=kallisto_index_url, name='kallisto_hg38.idx', work_dir=job.tempDir)
-    job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    # Retrieve files
+    profile_stage(job, 'kallisto', sum(x.size for x in [r1_id, r2_id] if x))
+    r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq')) if r2_id else None
+
+    # Call: Kallisto, unless an identical run is cached, and store output tarball in fileStore
+    def run():
+        index_path = download_url(url=kallisto_index_url, name='kallisto_hg38.idx', work_dir=job.tempDir)
+        return kallisto(job, job.tempDir, index_path, r1_path, r2_path, bootstraps=bootstraps)
+    key = quantifier_key('kallisto', kallisto_index_url, bootstraps, r1_path, r2_path) if cache else None
+    return job.fileStore.writeGlobalFile(cached_tarball(job, cache, key, run))
+
+
+def run_kallisto_batch(job, samples, kallisto_index_url, bootstraps=None):
+    """
+    RNA quantification via Kallisto for a batch of samples, run one after another so the index is only
+    downloaded once. Each sample's fastqs are read from the fileStore while the previous sample quantifies.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list(tuple(str, str)) samples: FileStoreIDs of each sample's fastq pair (pair 2 is None for single-end)
+    :param str kallisto_index_url: FileStoreID for Kallisto index file
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
+    :return: FileStoreIDs from Kallisto output, in the order of `samples`
+    :rtype: list(str)
+    """
+    index_path = download_url(url=kallisto_index_url, name='kallisto_hg38.idx', work_dir=job.tempDir)
+
+    def read_fastqs(i):
+        sample_dir = os.path.join(job.tempDir, 'sample{}'.format(i))
+        os.mkdir(sample_dir)
+        r1_id, r2_id = samples[i]
+        r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(sample_dir, 'R1.fastq'))
+        r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(sample_dir, 'R2.fastq')) if r2_id else None
+        return sample_dir, r1_path, r2_path
+
+    kallisto_ids = []
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(read_fastqs, (0,)) if samples else None
+        for i in xrange(len(samples)):
+            sample_dir, r1_path, r2_path = pending.get()
+            if i + 1 < len(samples):
+                pending = pool.apply_async(read_fastqs, (i + 1,))
+            job.log('Quantifying sample {} of {} in batch'.format(i + 1, len(samples)))
+            profile_stage(job, 'kallisto', sum(x.size for x in samples[i] if x))
+            tar_path = kallisto(job, job.tempDir, index_path, r1_path, r2_path, output_dir=sample_dir,
+                                profile_start=len(records(job)), bootstraps=bootstraps)
+            kallisto_ids.append(job.fileStore.writeGlobalFile(tar_path))
+            shutil.rmtree(sample_dir)
+    finally:
+        pool.close()
+        pool.join()
+    return kallisto_ids
+
+
+def kallisto(job, work_dir, index_path, r1_path, r2_path=None, output_dir=None, profile_start=0, cores=None,
+             bootstraps=None):
+    """
+    Runs Kallisto on local fastqs and tars its output. All paths must be within `work_dir`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str work_dir: Directory mounted into the container
+    :param str index_path: Path to Kallisto index
+    :param str r1_path: Path to fastq (pair 1)
+    :param str r2_path: Path to fastq (pair 2 if applicable, otherwise None for single-end)
+    :param str output_dir: Directory to write output to, defaults to `work_dir`
+    :param int profile_start: Index of this job's first profile record that belongs to this sample
+    :param int cores: Number of threads, defaults to the job's cores
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
+    :return: Path to output tarball
+    :rtype: str
+    """
+    output_dir = output_dir or work_dir
+    bootstraps = bootstraps or default_bootstraps
     parameters = ['quant',
-                  '-i', '/data/kallisto_hg38.idx',
-                  '-t', str(job.cores),
-                  '-o', '/data/',
-                  '-b', '100',
+                  '-i', docker_path(index_path, work_dir),
+                  '-t', str(cores or job.cores),
+                  '-o', docker_path(output_dir, work_dir),
+                  '-b', str(bootstraps.num),
                   '--fusion']
 
     # If R2 fastq is present...
-    if r2_id:
-        job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq'))
-        parameters.extend(['/data/R1.fastq', '/data/R2.fastq'])
+    if r2_path:
+        parameters.extend([docker_path(r1_path, work_dir), docker_path(r2_path, work_dir)])
     else:
-        parameters.extend(['--single', '-l', '200', '-s', '15', '/data/R1.fastq'])
+        parameters.extend(['--single', '-l', '200', '-s', '15', docker_path(r1_path, work_dir)])
 
     # Call: Kallisto
-    dockerCall(job, workDir=job.tempDir, parameters=parameters, tool=kallisto_version)
+    docker_call(job, workDir=work_dir, parameters=parameters, tool=kallisto_version)
 
-    # Tar output files together, store in fileStore, and return
+    # Tar output files together
     output_names = ['run_info.json', 'abundance.tsv', 'abundance.h5', 'fusion.txt']
-    output_files = [os.path.join(job.tempDir, x) for x in output_names]
-    tarball_files(tar_name='kallisto.tar.gz', file_paths=output_files, output_dir=job.tempDir)
-    return job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'kallisto.tar.gz'))
+    output_files = [os.path.join(output_dir, x) for x in output_names]
+    output_files = bootstrap_outputs(job, work_dir, output_dir, bootstraps, output_files, kallisto_version)
+    output_files.append(write_profile(job, output_dir, start=profile_start, image=kallisto_version))
+    tarball_files(tar_name='kallisto.tar', file_paths=output_files, output_dir=output_dir)
+    return os.path.join(output_dir, 'kallisto.tar')
 
 
-def run_rsem(job, bam_id, rsem_ref_url, paired=True):
+def run_rsem(job, bam_id, rsem_ref_url, paired=True, cache=None, hugo_table_id=None):
     """
     RNA quantification with RSEM
 
@@ -57,72 +171,163 @@ def run_rsem(job, bam_id, rsem_ref_url, paired=True):
     :param str bam_id: FileStoreID of transcriptome bam for quantification
     :param str rsem_ref_url: URL of RSEM reference (tarball)
     :param bool paired: If True, uses parameters for paired end data
-    :return: FileStoreIDs for RSEM's gene and isoform output
-    :rtype: str
+    :param Expando cache: If provided, RSEM's output is reused from / stored in this stage cache
+    :param str hugo_table_id: FileStoreID of a HUGO mapping table. If provided, HUGO names are mapped in this job
+        instead of by `run_rsem_gene_mapping`
+    :return: FileStoreIDs for RSEM's gene and isoform output, and RSEM's profile. With a HUGO mapping table,
+        FileStoreIDs of the RSEM and RSEM HUGO tarballs
+    :rtype: tuple(str, str, str)|tuple(str, str)
+    """
+    # Read bam from fileStore
+    profile_stage(job, 'rsem', bam_id.size)
+    bam_path = job.fileStore.readGlobalFile(bam_id, os.path.join(job.tempDir, 'transcriptome.bam'))
+    return quantify_rsem(job, bam_path, rsem_ref_url, paired=paired, cache=cache, hugo_table_id=hugo_table_id)
+
+
+def quantify_rsem(job, bam_path, rsem_ref_url, paired=True, cache=None, hugo_table_id=None):
+    """
+    Runs RSEM on a local transcriptome BAM and stores its output, see `run_rsem`
+
+    :param JobFunctionWrappingJob job: Passed automatically by Toil
+    :param str bam_path: Path to transcriptome bam
+    :param str rsem_ref_url: URL of RSEM reference (tarball)
+    :param bool paired: If True, uses parameters for paired end data
+    :param Expando cache: If provided, RSEM's output is reused from / stored in this stage cache
+    :param str hugo_table_id: FileStoreID of a HUGO mapping table
+    :return: See `run_rsem`
+    :rtype: tuple(str, str, str)|tuple(str, str)
+    """
+    output_paths = [os.path.join(job.tempDir, rsem_prefix + x) for x in ['.genes.results', '.isoforms.results']]
+
+    # Reuse the output of an identical run
+    key = stage_key('rsem', rsem_version, [rsem_ref_url, paired], [file_hash(bam_path)]) if cache else None
+    cached = fetch(cache, key, job.tempDir) if key else None
+    if not cached:
+        rsem(job, rsem_ref_url, bam_path, rsem_prefix, paired=paired)
+        if key:
+            store(cache, key, output_paths, job.fileStore.getLocalTempDir())
+    return rsem_outputs(job, hugo_table_id)
+
+
+def rsem_outputs(job, hugo_table_id=None):
+    """
+    Stores the output RSEM wrote to the job's temporary directory in the fileStore
+
+    :param JobFunctionWrappingJob job: Passed automatically by Toil
+    :param str hugo_table_id: FileStoreID of a HUGO mapping table
+    :return: See `run_rsem`
+    :rtype: tuple(str, str, str)|tuple(str, str)
+    """
+    output_paths = [os.path.join(job.tempDir, rsem_prefix + x) for x in ['.genes.results', '.isoforms.results']]
+
+    # Map HUGO names in-process, saving a job and a container launch
+    if hugo_table_id:
+        table = load_table(job, hugo_table_id)
+        rsem_files = [os.path.join(job.tempDir, 'rsem_{}.results'.format(x)) for x in ['genes', 'isoforms']]
+        hugo_files = [os.path.join(job.tempDir, 'rsem_{}.hugo.results'.format(x)) for x in ['genes', 'isoforms']]
+        for path, rsem_path, hugo_path, kind in zip(output_paths, rsem_files, hugo_files, ['genes', 'isoforms']):
+            os.rename(path, rsem_path)
+            map_rsem_output(table, rsem_path, hugo_path, kind)
+        return rsem_tarballs(job, rsem_files + [write_profile(job, job.tempDir, image=rsem_version)], hugo_files)
+
+    # Store output in fileStore and return
+    gene_id = job.fileStore.writeGlobalFile(output_paths[0])
+    isoform_id = job.fileStore.writeGlobalFile(output_paths[1])
+    profile_id = job.fileStore.writeGlobalFile(write_profile(job, job.tempDir, image=rsem_version))
+    return gene_id, isoform_id, profile_id
+
+
+def rsem(job, rsem_ref_url, bam_path, output_prefix, paired=True, cores=None):
+    """
+    Runs RSEM on a local transcriptome BAM in the job's temporary directory, where its output is written.
+    The BAM may be a named pipe STAR is writing, which RSEM can only read once, so RSEM's own BAMs aren't written.
+    RSEM is profiled as the "rsem" stage whichever job it runs in, without an input size when the BAM is streamed.
+
+    :param JobFunctionWrappingJob job: Passed automatically by Toil
+    :param str rsem_ref_url: URL of RSEM reference (tarball)
+    :param str bam_path: Path to transcriptome bam
+    :param str output_prefix: Prefix of RSEM's output files
+    :param bool paired: If True, uses parameters for paired end data
+    :param int cores: Number of threads, defaults to the job's cores
     """
     # Retrieve RSEM reference
-    download_url(url=rsem_ref_url, name='rsem_ref.tar.gz', work_dir=job.tempDir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(job.tempDir, 'rsem_ref.tar.gz'), '-C', job.tempDir])
-    os.remove(os.path.join(job.tempDir, 'rsem_ref.tar.gz'))
+    ref_dir = os.path.join(job.tempDir, 'rsem-ref')
+    os.mkdir(ref_dir)
+    download_url(url=rsem_ref_url, name='rsem_ref.tar.gz', work_dir=ref_dir)
+    subprocess.check_call(['tar', '-xvf', os.path.join(ref_dir, 'rsem_ref.tar.gz'), '-C', ref_dir])
+    os.remove(os.path.join(ref_dir, 'rsem_ref.tar.gz'))
     # Determine tarball structure - based on it, ascertain folder name and rsem reference prefix
     rsem_files = []
-    for root, directories, files in os.walk(job.tempDir):
+    for root, directories, files in os.walk(ref_dir):
         rsem_files.extend([os.path.join(root, x) for x in files])
     # "grp" is a required RSEM extension that should exist in the RSEM reference
     ref_prefix = [os.path.basename(os.path.splitext(x)[0]) for x in rsem_files if 'grp' in x][0]
-    ref_folder = os.path.join('/data', os.listdir(job.tempDir)[0]) if len(os.listdir(job.tempDir)) == 1 else '/data'
-    # Read bam from fileStore
-    job.fileStore.readGlobalFile(bam_id, os.path.join(job.tempDir, 'transcriptome.bam'))
+    ref_folder = os.path.join(ref_dir, os.listdir(ref_dir)[0]) if len(os.listdir(ref_dir)) == 1 else ref_dir
 
     # Call: RSEM
-    output_prefix = 'rsem'
     parameters = ['--quiet',
                   '--no-qualities',
-                  '-p', str(job.cores),
+                  '-p', str(cores or job.cores),
                   '--forward-prob', '0.5',
                   '--seed-length', '25',
                   '--fragment-length-mean', '-1.0',
-                  '--bam', '/data/transcriptome.bam',
-                  os.path.join(ref_folder, ref_prefix),
+                  '--bam', docker_path(bam_path),
+                  os.path.join(docker_path(ref_folder, job.tempDir), ref_prefix),
                   output_prefix]
     if paired:
         parameters = ['--paired-end'] + parameters
-    dockerCall(job, parameters=parameters, workDir=job.tempDir, tool=rsem_version)
-
-    # Store output in fileStore and return
-    gene_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, output_prefix + '.genes.results'))
-    isoform_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, output_prefix + '.isoforms.results'))
-    return gene_id, isoform_id
+    streamed = stat.S_ISFIFO(os.stat(bam_path).st_mode)
+    if streamed:
+        parameters = ['--no-bam-output'] + parameters
+    docker_call(job, parameters=parameters, workDir=job.tempDir, tool=rsem_version,
+                stage=('rsem', None if streamed else os.path.getsize(bam_path)))
+    shutil.rmtree(ref_dir)
 
 
-def run_rsem_gene_mapping(job, rsem_gene_id, rsem_isoform_id):
+def run_rsem_gene_mapping(job, rsem_gene_id, rsem_isoform_id, rsem_profile_id=None):
     """
     Parses RSEM output files to map ENSEMBL IDs to Gencode HUGO gene names
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param str rsem_gene_id: FileStoreID of rsem_gene_ids
     :param str rsem_isoform_id: FileStoreID of rsem_isoform_ids
+    :param str rsem_profile_id: FileStoreID of RSEM's profile, included in the RSEM tarball
     :return: FileStoreID from RSEM post process tarball
     :rytpe: str
     """
     # Retrieve input files
     genes = job.fileStore.readGlobalFile(rsem_gene_id, os.path.join(job.tempDir, 'rsem_genes.results'))
     iso = job.fileStore.readGlobalFile(rsem_isoform_id, os.path.join(job.tempDir, 'rsem_isoforms.results'))
+    rsem_files = [genes, iso]
+    if rsem_profile_id:
+        rsem_files.append(job.fileStore.readGlobalFile(rsem_profile_id, os.path.join(job.tempDir, 'profile.json')))
 
     # Perform HUGO gene / isoform name mapping
     command = ['-g', 'rsem_genes.results', '-i', 'rsem_isoforms.results']
-    dockerCall(job, parameters=command, workDir=job.tempDir, tool=rsemgenemapping_version)
+    docker_call(job, parameters=command, workDir=job.tempDir, tool=rsemgenemapping_version)
     hugo_files = [os.path.join(job.tempDir, x) for x in ['rsem_genes.hugo.results', 'rsem_isoforms.hugo.results']]
+    hugo_files.append(write_profile(job, job.tempDir, name='hugo_profile.json'))
+    return rsem_tarballs(job, rsem_files, hugo_files)
+
+
+def rsem_tarballs(job, rsem_files, hugo_files):
+    """
+    Creates the RSEM and RSEM HUGO tarballs for output and stores them in the fileStore
 
-    # Create tarballs for output, store in fileStore, and return
-    tarball_files('rsem.tar.gz', file_paths=[genes, iso], output_dir=job.tempDir)
-    tarball_files('rsem_hugo.tar.gz', file_paths=hugo_files, output_dir=job.tempDir)
-    rsem_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'rsem.tar.gz'))
-    hugo_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'rsem_hugo.tar.gz'))
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list(str) rsem_files: Paths to RSEM's output and profile
+    :param list(str) hugo_files: Paths to HUGO-mapped output
+    :return: FileStoreIDs of the RSEM and RSEM HUGO tarballs
+    :rtype: tuple(str, str)
+    """
+    tarball_files('rsem.tar', file_paths=rsem_files, output_dir=job.tempDir)
+    tarball_files('rsem_hugo.tar', file_paths=hugo_files, output_dir=job.tempDir)
+    rsem_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'rsem.tar'))
+    hugo_id = job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'rsem_hugo.tar'))
     return rsem_id, hugo_id
 
 
-def run_hera(job, r1_id, r2_id, hera_index_url):
+def run_hera(job, r1_id, r2_id, hera_index_url, cache=None, bootstraps=None):
     """
     RNA-seq quantification using Hera
 
@@ -130,34 +335,186 @@ def run_hera(job, r1_id, r2_id, hera_index_url):
     :param str r1_id: FileStoreID of fastq (pair 1)
     :param str r2_id: FileStoreID of fastq (pair 2 if applicable, otherwise pass None for single-end)
     :param str hera_index_url: URL to hera index file
+    :param Expando cache: If provided, Hera's output is reused from / stored in this stage cache
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
     :return: FileStoreID of Hera outputs
     :rytpe: str
     """
+    # Read in fastq(s)
+    profile_stage(job, 'hera', sum(x.size for x in [r1_id, r2_id] if x))
+    r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq')) if r2_id else None
+
+    # Call: Hera, unless an identical run is cached, and store output tarball in fileStore
+    key = quantifier_key('hera', hera_index_url, bootstraps, r1_path, r2_path) if cache else None
+    tar_path = cached_tarball(job, cache, key, lambda: hera(job, job.tempDir, hera_index_url, r1_path, r2_path,
+                                                            bootstraps=bootstraps))
+    return job.fileStore.writeGlobalFile(tar_path)
+
+
+def quantifier_key(tool, index_url, bootstraps, r1_path, r2_path=None, hashes=None):
+    """
+    Stage cache key of a Kallisto or Hera run, the same whether the tool runs alone or alongside the other quantifiers
+
+    :param str tool: "kallisto" or "hera"
+    :param str index_url: URL of the tool's index
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
+    :param str r1_path: Path to fastq (pair 1)
+    :param str r2_path: Path to fastq (pair 2 if applicable, otherwise None for single-end)
+    :param list(str) hashes: Hashes of the fastqs, if already computed
+    :return: Key from `stage_key`
+    :rtype: str
+    """
+    parameters = [index_url, sorted((bootstraps or default_bootstraps).items())]
+    hashes = hashes or [file_hash(r1_path), file_hash(r2_path)]
+    return stage_key(tool, {'kallisto': kallisto_version, 'hera': hera_version}[tool], parameters, hashes)
+
+
+def cached_tarball(job, cache, key, run):
+    """
+    Returns a stage's output tarball from the stage cache, or runs the stage and stores its tarball
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Expando cache: Location of the stage cache, or None if caching is disabled
+    :param str key: Key of the stage from `stage_key`, or None if caching is disabled
+    :param function run: Runs the stage and returns the path to its output tarball
+    :return: Path to output tarball
+    :rtype: str
+    """
+    if not cache:
+        return run()
+    cached = fetch(cache, key, job.fileStore.getLocalTempDir())
+    if cached:
+        return cached.values()[0]
+    tar_path = run()
+    store(cache, key, [tar_path], job.fileStore.getLocalTempDir())
+    return tar_path
+
+
+def hera(job, work_dir, hera_index_url, r1_path, r2_path=None, cores=None, bootstraps=None):
+    """
+    Runs Hera on local fastqs and tars its output. Fastqs must be within `work_dir`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str work_dir: Directory mounted into the container, where output is written
+    :param str hera_index_url: URL to hera index file
+    :param str r1_path: Path to fastq (pair 1)
+    :param str r2_path: Path to fastq (pair 2 if applicable, otherwise None for single-end)
+    :param int cores: Number of threads, defaults to the job's cores
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
+    :return: Path to output tarball
+    :rtype: str
+    """
+    bootstraps = bootstraps or default_bootstraps
+
     # Download and process hera index
-    download_url(url=hera_index_url, name='hera-index.tar.gz', work_dir=job.tempDir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(job.tempDir, 'hera-index.tar.gz'), '-C', job.tempDir])
-    os.remove(os.path.join(job.tempDir, 'hera-index.tar.gz'))
-    hera_index = os.path.join('/data', os.listdir(job.tempDir)[0]) if len(os.listdir(job.tempDir)) == 1 else '/data'
+    index_dir = os.path.join(work_dir, 'hera-index')
+    os.mkdir(index_dir)
+    download_url(url=hera_index_url, name='hera-index.tar.gz', work_dir=index_dir)
+    subprocess.check_call(['tar', '-xvf', os.path.join(index_dir, 'hera-index.tar.gz'), '-C', index_dir])
+    os.remove(os.path.join(index_dir, 'hera-index.tar.gz'))
+    if len(os.listdir(index_dir)) == 1:
+        index_dir = os.path.join(index_dir, os.listdir(index_dir)[0])
 
     # Define parameters
     parameters = ['quant',
-                  '-i', hera_index,
-                  '-t', str(job.cores),
-                  '-b', '100',  # Bootstraps
+                  '-i', docker_path(index_dir, work_dir),
+                  '-t', str(cores or job.cores),
+                  '-b', str(bootstraps.num),  # Bootstraps
                   '-w', '1',  # Output BAM (1 = no output)
-                  '/data/R1.fastq']
-
-    # Read in fastq(s)
-    job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
-    if r1_id and r2_id:
-        job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq'))
-        parameters.append('/data/R2.fastq')
+                  docker_path(r1_path, work_dir)]
+    if r2_path:
+        parameters.append(docker_path(r2_path, work_dir))
 
     # Call: Hera
-    dockerCall(job, parameters=parameters, workDir=job.tempDir, tool=hera_version)
+    docker_call(job, parameters=parameters, workDir=work_dir, tool=hera_version)
 
-    # Tar output files, store in fileStore, and return FileStoreID
+    # Tar output files
     output_names = ['abundance.gene.tsv', 'abundance.h5', 'abundance.tsv', 'fusion.bedpe', 'summary']
-    output_files = [os.path.join(job.tempDir, x) for x in output_names]
-    tarball_files(tar_name='hera.tar.gz', file_paths=output_files, output_dir=job.tempDir)
-    return job.fileStore.writeGlobalFile(os.path.join(job.tempDir, 'hera.tar.gz'))
+    output_files = [os.path.join(work_dir, x) for x in output_names]
+    output_files = bootstrap_outputs(job, work_dir, work_dir, bootstraps, output_files, hera_version)
+    output_files.append(write_profile(job, work_dir, image=hera_version))
+    tarball_files(tar_name='hera.tar', file_paths=output_files, output_dir=work_dir)
+    return os.path.join(work_dir, 'hera.tar')
+
+
+def bootstrap_outputs(job, work_dir, output_dir, bootstraps, output_files, image):
+    """
+    Adds a summary of the bootstraps in abundance.h5 to a quantifier's outputs, if requested, and leaves out
+    abundance.h5 unless the raw bootstraps are kept. Hera's abundance.h5 has the same layout as Kallisto's,
+    so both are dumped with "kallisto h5dump", which is profiled under the quantifier's image.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str work_dir: Directory mounted into the container
+    :param str output_dir: Directory holding abundance.h5, within `work_dir`
+    :param Expando bootstraps: Bootstrap options, see `bootstrap_options`
+    :param list(str) output_files: Paths to the quantifier's outputs
+    :param str image: Docker image of the quantifier, e.g. `hera_version`
+    :return: Paths to outputs
+    :rtype: list(str)
+    """
+    h5_path = os.path.join(output_dir, 'abundance.h5')
+    if not (bootstraps.summarize and bootstraps.num):
+        return output_files
+    bootstrap_dir = os.path.join(output_dir, 'bootstraps')
+    os.mkdir(bootstrap_dir)
+    parameters = ['h5dump', '-o', docker_path(bootstrap_dir, work_dir), docker_path(h5_path, work_dir)]
+    docker_call(job, workDir=work_dir, parameters=parameters, tool=kallisto_version, record_as=image)
+    summary_files = summarize_bootstraps(bootstrap_dir, output_dir)
+    shutil.rmtree(bootstrap_dir)
+    return [x for x in output_files if bootstraps.keep or x != h5_path] + summary_files
+
+
+def run_quantifiers(job, r1_id, r2_id, config, tools):
+    """
+    Runs FastQC, Kallisto, and / or Hera concurrently in one job so the fastqs are only read from the fileStore
+    once. Each tool gets its own directory with hard links to the fastqs, and the job's cores are divided among them.
+    Kallisto and Hera share the stage cache entries of `run_kallisto` and `run_hera`.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str r1_id: FileStoreID of fastq (pair 1)
+    :param str r2_id: FileStoreID of fastq (pair 2 if applicable, otherwise pass None for single-end)
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param list(str) tools: Tools to run, any of "fastqc", "kallisto", and "hera"
+    :return: FileStoreID of each tool's output tarball, keyed by tool
+    :rtype: dict(str, str)
+    """
+    profile_stage(job, 'quantifiers', sum(x.size for x in [r1_id, r2_id] if x))
+    r1_path = job.fileStore.readGlobalFile(r1_id, os.path.join(job.tempDir, 'R1.fastq'))
+    r2_path = job.fileStore.readGlobalFile(r2_id, os.path.join(job.tempDir, 'R2.fastq')) if r2_id else None
+
+    # FastQC runs one thread per fastq, the quantifiers split the remaining cores
+    fastqc_cores = (2 if r2_id else 1) if 'fastqc' in tools else 0
+    quantifiers = [x for x in tools if x != 'fastqc']
+    cores = max(1, (job.cores - fastqc_cores) // len(quantifiers)) if quantifiers else 0
+    hashes = [file_hash(r1_path), file_hash(r2_path)] if config.cache and quantifiers else None
+
+    def run_tool(tool):
+        work_dir = os.path.join(job.tempDir, tool)
+        os.mkdir(work_dir)
+        paths = []
+        for path in [x for x in [r1_path, r2_path] if x]:
+            paths.append(os.path.join(work_dir, os.path.basename(path)))
+            os.link(path, paths[-1])
+        paths += [None] * (2 - len(paths))
+        if tool == 'fastqc':
+            return fastqc(job, work_dir, *paths)
+        bootstraps = bootstrap_options(config, tool)
+        index_url = config.kallisto_index if tool == 'kallisto' else config.hera_index
+        key = quantifier_key(tool, index_url, bootstraps, *paths, hashes=hashes) if config.cache else None
+        if tool == 'kallisto':
+            def run():
+                index_path = download_url(url=index_url, name='kallisto_hg38.idx', work_dir=work_dir)
+                return kallisto(job, work_dir, index_path, *paths, cores=cores, bootstraps=bootstraps)
+        else:
+            def run():
+                return hera(job, work_dir, index_url, *paths, cores=cores, bootstraps=bootstraps)
+        return cached_tarball(job, config.cache, key, run)
+
+    pool = ThreadPool(len(tools))
+    try:
+        tar_paths = pool.map(run_tool, tools)
+    finally:
+        pool.close()
+        pool.join()
+    return {tool: job.fileStore.writeGlobalFile(path) for tool, path in zip(tools, tar_paths)}
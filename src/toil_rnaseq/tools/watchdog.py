@@ -0,0 +1,137 @@
+from __future__ import division
+
+import os
+import threading
+import time
+from collections import deque
+
+from toil_rnaseq.utils.expando import Expando
+
+# Seconds between checks of a running tool's progress. STAR updates Log.progress.out every minute
+check_interval = 60
+
+# Memory of a job retried after a stall, relative to the stalled job. Stalls are mostly memory thrashing
+retry_memory_factor = 1.5
+
+
+class Stalled(Exception):
+    """
+    A tool was stopped by its watchdog after its throughput stayed below the threshold
+    """
+
+
+def watchdog_options(config):
+    """
+    Watchdog options of long-running tools
+
+    >>> options = watchdog_options(Expando(watchdog_stall_minutes=30, watchdog_min_rate=1000, watchdog_retries=1))
+    >>> sorted(options.items())
+    [('min_rate', 1000), ('retries', 1), ('stall_seconds', 1800)]
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :return: Reads per second below which a tool stalls (min_rate), for how long (stall_seconds), and how many
+        times a stalled tool's job is retried (retries). Without retries, stalls are only logged
+    :rtype: Expando
+    """
+    return Expando(min_rate=config.watchdog_min_rate, stall_seconds=int(config.watchdog_stall_minutes * 60),
+                   retries=config.watchdog_retries)
+
+
+def star_progress(work_dir, prefix='rna'):
+    """
+    Reads processed by STAR, from the last row of its Log.progress.out. None until mapping starts and once it
+    finishes, as STAR reports no progress while loading the genome or sorting the aligned BAM.
+
+    :param str work_dir: Directory STAR runs in
+    :param str prefix: STAR's --outFileNamePrefix
+    :return: Number of reads
+    :rtype: int
+    """
+    try:
+        with open(os.path.join(work_dir, prefix + 'Log.out')) as f:
+            if 'finished mapping' in f.read().lower():
+                return None
+        with open(os.path.join(work_dir, prefix + 'Log.progress.out')) as f:
+            rows = [line.split() for line in f]
+    except IOError:
+        return None
+    # Rows start with the date and time (three fields), followed by the speed and the number of reads
+    rows = [x for x in rows if len(x) > 4 and x[4].isdigit()]
+    return int(rows[-1][4]) if rows else None
+
+
+class Watchdog(threading.Thread):
+    """
+    Follows the progress of a running tool, logging its throughput every `check_interval` seconds. A stall is
+    flagged once the tool has processed fewer than `min_rate` reads per second over the last `stall_seconds`.
+    With retries left, a stalled tool is stopped through `stop_tool`, which the caller running the tool sets.
+    """
+
+    def __init__(self, log, tool, progress, options, interval=check_interval):
+        """
+        :param function log: Logs a message, e.g. `job.log`
+        :param str tool: Name of tool in messages
+        :param function progress: Returns the number of reads processed so far, or None outside of a phase
+            that reports progress
+        :param Expando options: See `watchdog_options`
+        :param int interval: Seconds between checks
+        """
+        super(Watchdog, self).__init__()
+        self.daemon = True
+        self.log = log
+        self.tool = tool
+        self.progress = progress
+        self.options = options
+        self.interval = interval
+        self.stop_tool = None
+        self.cpu_seconds = None
+        self.stalled = False
+        self.stopped = False
+        self._history = deque()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.check(time.time())
+
+    def stop(self):
+        self._done.set()
+        if self.is_alive():
+            self.join()
+
+    def check(self, now):
+        """
+        Reads the tool's progress and logs its throughput since the last check
+
+        :param float now: Current time
+        """
+        reads = self.progress()
+        if reads is None:
+            self._history.clear()
+            return
+        cpu = self.cpu_seconds() if self.cpu_seconds else None
+        self._history.append((now, reads, cpu))
+        # Keep the last check at least `stall_seconds` old, from which the rate over the whole window is measured
+        while len(self._history) > 2 and self._history[1][0] <= now - self.options.stall_seconds:
+            self._history.popleft()
+        if len(self._history) < 2:
+            return
+
+        last_time, last_reads, last_cpu = self._history[-2]
+        message = '{}: {:,} reads, {:,.0f} reads/s'.format(self.tool, reads, (reads - last_reads) / (now - last_time))
+        if cpu is not None and last_cpu is not None:
+            message += ', {:.1f} cores busy'.format((cpu - last_cpu) / (now - last_time))
+        self.log(message)
+
+        start_time, start_reads, _ = self._history[0]
+        rate = (reads - start_reads) / (now - start_time)
+        if now - start_time < self.options.stall_seconds or rate >= self.options.min_rate:
+            return
+        if not self.stalled:
+            self.log('{} stalled: {:,.0f} reads/s over the last {:.0f} minutes, below {:,} reads/s'.format(
+                self.tool, rate, (now - start_time) / 60, self.options.min_rate))
+        self.stalled = True
+        if self.options.retries and self.stop_tool and not self.stopped:
+            self.log('Stopping {} to retry its job with more memory'.format(self.tool))
+            self.stopped = True
+            self.stop_tool()
@@ -6,9 +6,41 @@ import textwrap
 from collections import OrderedDict, defaultdict
 from urlparse import urlparse
 
+from toil_rnaseq.tools.execution import backend_names
+from toil_rnaseq.tools.execution import native_commands
+from toil_rnaseq.tools.execution import required_programs
+from toil_rnaseq.tools import tool_versions
 from toil_rnaseq.utils.expando import Expando
 
 schemes = ('file', 'http', 's3', 'ftp', 'gdc')
+
+# Defaults for options that may be absent from configs generated by earlier releases
+optional_defaults = {'colocate_post_alignment': None,
+                     'save_bam_format': 'bam',
+                     'genome_fasta': None,
+                     'shard_bam_by_read_group': None,
+                     'resource_model': None,
+                     'map_branching_factor': 100,
+                     'map_leaf_size': 100,
+                     'order_samples_by_size': None,
+                     'scaling_curves': None,
+                     'kallisto_batch_size': 1,
+                     'colocate_quantifiers': None,
+                     'stage_cache': None,
+                     'validate_inputs': None,
+                     'validation_cache': None,
+                     'cohort_matrix': None,
+                     'hugo_mapping': None,
+                     'kallisto_bootstraps': 100,
+                     'hera_bootstraps': 100,
+                     'summarize_bootstraps': None,
+                     'keep_bootstraps': None,
+                     'warm_up_images': None,
+                     'tool_backends': None,
+                     'fuse_star_rsem': None,
+                     'watchdog_stall_minutes': 30,
+                     'watchdog_min_rate': 1000,
+                     'watchdog_retries': 0}
 _iter_types = (list, tuple, set, frozenset)
 
 
@@ -90,9 +122,27 @@ def generate_config():
         # URL {scheme} to hera index
         hera-index: http://courtyard.gi.ucsc.edu/~jvivian/toil-rnaseq-inputs/hera-index.tar.gz
         
+        # Optional: URL {scheme} to a tab-separated file of ENSEMBL gene and transcript IDs and their HUGO names.
+        # If provided, RSEM's output is mapped to HUGO names within the RSEM job instead of in a separate container
+        hugo-mapping: 
+
         # Maximum file size of input sample (for resource allocation during initial download)
+        # Used for every input unless order-samples-by-size is set, then only for inputs whose size can't be found
         max-sample-size: 20G
 
+        # Optional: Path to a resource model fit from job history with "toil-rnaseq fit-resources".
+        # Disk, memory, and cores for each tool are predicted from its input size. Tools not in the model use defaults.
+        resource-model: 
+
+        # Optional: Directory or s3:// URL where outputs of preprocessing, STAR, RSEM, Kallisto, and Hera are kept.
+        # A stage whose inputs, Docker image, and parameters match a cached run reuses its outputs instead of
+        # running again, even with a new job store. Cached reads on S3 are encrypted with the ssec key if provided
+        stage-cache: 
+
+        # Optional: Path to thread-scaling curves measured with "toil-rnaseq benchmark". Cores for STAR, RSEM,
+        # Kallisto, and Hera are chosen to maximize samples per hour on each node instead of using the resource model
+        scaling-curves: 
+
         ##############################################################################################################
         #                                   WORKFLOW OPTIONS (Quality Control)                                       #
         ##############################################################################################################
@@ -127,6 +177,24 @@ def generate_config():
         #                                   ADDITIONAL FILE OUTPUT OPTIONS                                           #
         ##############################################################################################################        
 
+        # Optional: Full path to a directory (on a filesystem shared by all nodes) where the TPM and counts of
+        # RSEM, Kallisto, and Hera are added as each sample completes, as gene x sample float32 matrices.
+        # Export with "toil-rnaseq cohort-export", add earlier outputs with "toil-rnaseq cohort-add"
+        cohort-matrix: 
+
+        # Number of bootstraps run by Kallisto, stored in its abundance.h5. 0 disables bootstrapping
+        kallisto-bootstraps: 100
+
+        # Number of bootstraps run by Hera, stored in its abundance.h5. 0 disables bootstrapping
+        hera-bootstraps: 100
+
+        # Optional: If true, the bootstraps of each transcript are summarized (mean, variance, and quantiles of
+        # est_counts and TPM) as float32 arrays in bootstrap_summary.f32, and abundance.h5 is left out of the output
+        summarize-bootstraps: 
+
+        # Optional: If true, abundance.h5 with the raw bootstraps is kept alongside the summary
+        keep-bootstraps: 
+
         # Optional: If true, saves the wiggle file (.bg extension) output by STAR
         # WARNING: Requires STAR sorting, which has memory leak issues that can crash the workflow 
         wiggle: 
@@ -136,13 +204,81 @@ def generate_config():
         # as read data is assumed to be controlled access
         save-bam: 
 
+        # Optional: Format of the saved alignments, either "bam" or "cram". CRAM is reference-based and
+        # requires the genome-fasta used to build the STAR index
+        save-bam-format: bam
+
+        # Optional: URL {scheme} to the genome FASTA (uncompressed or bgzipped) the STAR index was built from
+        genome-fasta: 
+
+        ##############################################################################################################
+        #                                   WORKFLOW OPTIONS (Performance)                                           #
+        ##############################################################################################################
+
+        # Optional: If true, each sample pulls the Docker images it needs, concurrently, before its tool jobs are
+        # scheduled, so tool jobs holding large reservations don't wait on pulls. Also run by "toil-rnaseq pull-images"
+        warm-up-images: 
+
+        # Optional: How each tool is run: "docker", "singularity" (or Apptainer, from the same images), or "native"
+        # (binaries on the PATH of every node). Set "default" for all tools and override it per tool, e.g.
+        # tool-backends: {{default: singularity, samtools: native}}. Tools without a binary stay on docker when the
+        # default is native. Tools: {tools}
+        tool-backends: 
+
+        # Optional: If true, BamQC and saving of the aligned BAM / wiggle run within the STAR job, so the
+        # aligned BAM is never written to the job store
+        colocate-post-alignment: 
+
+        # Optional: If true, RSEM runs within the STAR job and reads STAR's transcriptome BAM through a named pipe as
+        # it is written, so the BAM is never stored. With a stage-cache the BAM is stored locally for reuse instead
+        fuse-star-rsem: 
+
+        # STAR's throughput is logged every minute. Minutes over which STAR's mapping rate is measured before it is
+        # flagged as stalled
+        watchdog-stall-minutes: 30
+
+        # Reads per second STAR must map over watchdog-stall-minutes to not be flagged as stalled
+        watchdog-min-rate: 1000
+
+        # Number of times a stalled STAR is stopped and its job retried with 1.5 times the memory. 0 only logs stalls
+        watchdog-retries: 0
+
+        # Optional: If true, BAM inputs with more than one read group are converted to fastq with one job per
+        # read group, so conversion of large multi-lane BAMs is spread across nodes
+        shard-bam-by-read-group: 
+
+        # Optional: If true, FastQC, Kallisto, and Hera run concurrently in one job that divides its cores among
+        # them, so the fastqs are only read from the job store once
+        colocate-quantifiers: 
+
+        # Samples are spawned through a tree of jobs. Maximum number of children of each job in the tree
+        map-branching-factor: 100
+
+        # Maximum number of samples spawned by a single job at the bottom of the tree
+        map-leaf-size: 100
+
+        # Number of samples quantified one after another in a single Kallisto job, so the index is only downloaded
+        # once per batch. Useful for many short samples. Batches are formed within jobs at the bottom of the tree
+        kallisto-batch-size: 1
+
+        # Optional: If true, the size of every input is looked up before the run. Download jobs reserve disk
+        # for the actual input size and the largest samples are scheduled first to shorten the tail of the run
+        order-samples-by-size: 
+
+        # Optional: If true, every sample and index URL is checked for existence, size, and access before the run,
+        # so an unreachable input fails the run at once rather than hours into it. Also run by "toil-rnaseq validate"
+        validate-inputs: 
+
+        # Optional: Path to a JSON file that keeps successful URL checks for a day, so reruns skip them
+        validation-cache: 
+
         ##############################################################################################################
         #                                           DEVELOPER OPTIONS                                                #
         ##############################################################################################################        
 
         # Optional: If true, uses resource requirements appropriate for continuous integration
         ci-test: 
-    """.format(scheme=[x + '://' for x in schemes])[1:])
+    """.format(scheme=[x + '://' for x in schemes], tools=', '.join(sorted(tool_versions)))[1:])
 
 
 def user_input_config(config_path):
@@ -289,6 +425,10 @@ def configuration_sanity_checks(config):
     :return: `config` with appropriate changes to output_dir
     :rtype: Expando
     """
+    # Fill in options that are missing from older configs
+    for option, default in optional_defaults.iteritems():
+        config.setdefault(option, default)
+
     # Ensure there are inputs to run something
     require(config.kallisto_index or config.star_index or config.hera_index,
             'URLs not provided for Kallisto, STAR, or Hera, so there is nothing to do!')
@@ -298,11 +438,54 @@ def configuration_sanity_checks(config):
         require(config.star_index and config.rsem_ref, 'Input provided for STAR or RSEM but not both. STAR: '
                                                        '"{}", RSEM: "{}"'.format(config.star_index, config.rsem_ref))
 
+    # CRAM output is compressed against the genome FASTA
+    require(config.save_bam_format in ['bam', 'cram'],
+            'save-bam-format must be "bam" or "cram". User: "{}"'.format(config.save_bam_format))
+    if config.save_bam_format == 'cram':
+        require(config.genome_fasta, 'save-bam-format is cram but no genome-fasta was provided.')
+
     # Ensure file inputs have allowed URL schemes
-    for file_input in [x for x in [config.kallisto_index, config.star_index, config.rsem_ref, config.hera_index] if x]:
+    file_inputs = [config.kallisto_index, config.star_index, config.rsem_ref, config.hera_index, config.genome_fasta]
+    for file_input in [x for x in file_inputs if x]:
         require(urlparse(file_input).scheme in schemes,
                 'Input "{}" in config must have the appropriate URL prefix: {}'.format(file_input, schemes))
 
+    # Shape of the tree of jobs that spawns samples
+    require(isinstance(config.map_branching_factor, int) and config.map_branching_factor >= 2,
+            'map-branching-factor must be an integer of at least 2. User: "{}"'.format(config.map_branching_factor))
+    require(isinstance(config.map_leaf_size, int) and config.map_leaf_size >= 1,
+            'map-leaf-size must be a positive integer. User: "{}"'.format(config.map_leaf_size))
+    require(isinstance(config.kallisto_batch_size, int) and config.kallisto_batch_size >= 1,
+            'kallisto-batch-size must be a positive integer. User: "{}"'.format(config.kallisto_batch_size))
+    for option in ['kallisto_bootstraps', 'hera_bootstraps', 'watchdog_retries']:
+        require(isinstance(config[option], int) and config[option] >= 0,
+                '{} must be a non-negative integer. User: "{}"'.format(option.replace('_', '-'), config[option]))
+    for option in ['watchdog_stall_minutes', 'watchdog_min_rate']:
+        require(isinstance(config[option], (int, float)) and config[option] > 0,
+                '{} must be a positive number. User: "{}"'.format(option.replace('_', '-'), config[option]))
+
+    if config.tool_backends:
+        require(isinstance(config.tool_backends, dict),
+                'tool-backends must map tools to backends. User: "{}"'.format(config.tool_backends))
+        for tool, backend in config.tool_backends.iteritems():
+            require(tool == 'default' or tool in tool_versions,
+                    'Unknown tool in tool-backends: "{}". Tools: {}'.format(tool, ', '.join(sorted(tool_versions))))
+            require(backend in backend_names,
+                    'Backend of {} must be one of {}. User: "{}"'.format(tool, ', '.join(backend_names), backend))
+            require(backend != 'native' or tool == 'default' or tool in native_commands,
+                    '{} has no native command, it must run with docker or singularity.'.format(tool))
+
+    if config.resource_model:
+        require(os.path.exists(config.resource_model), 'Resource model not found: {}'.format(config.resource_model))
+    if config.scaling_curves:
+        require(os.path.exists(config.scaling_curves), 'Scaling curves not found: {}'.format(config.scaling_curves))
+    if config.cohort_matrix:
+        require(config.cohort_matrix.startswith('/'),
+                'cohort-matrix must be a full path to a directory. User: "{}"'.format(config.cohort_matrix))
+    if config.stage_cache:
+        require(config.stage_cache.startswith('/') or urlparse(config.stage_cache).scheme == 's3',
+                'stage-cache must be a full path to a directory or an s3:// URL. User: "{}"'.format(config.stage_cache))
+
     # Output dir checks and handling
     require(config.output_dir, 'No output location specified: {}'.format(config.output_dir))
     if not config.output_dir.startswith('/'):
@@ -321,21 +504,32 @@ def configuration_sanity_checks(config):
         if not os.path.exists(config.output_dir):
             mkdir_p(config.output_dir)
 
-    # Program checks
-    for program in ['curl', 'docker']:
-        require(next(which(program), None), program + ' must be installed on every node.'.format(program))
+    # Program checks, for the backends tools are configured to run with
+    for programs in [['curl']] + required_programs(config.tool_backends):
+        require(any(next(which(x), None) for x in programs),
+                '{} must be installed on every node.'.format(' or '.join(programs)))
 
     return config
 
 
-def docker_path(path):
+def docker_path(path, work_dir=None):
     """
     Converts a path to a file to a "docker path" which replaces the dirname with '/data'
 
+    >>> docker_path('/tmp/a/R1.fastq')
+    '/data/R1.fastq'
+    >>> docker_path('/tmp/a/kallisto/R1.fastq', work_dir='/tmp/a')
+    '/data/kallisto/R1.fastq'
+    >>> docker_path('/tmp/a', work_dir='/tmp/a')
+    '/data'
+
     :param str path: Path to file
+    :param str work_dir: Directory mounted as '/data'. If given, `path` may be in a subdirectory of it
     :return: Path for use in Docker parameters
     :rtype: str
     """
+    if work_dir:
+        return os.path.normpath(os.path.join('/data', os.path.relpath(path, work_dir)))
     return os.path.join('/data', os.path.basename(path))
 
 
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import subprocess
+import tarfile
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from toil_rnaseq.utils import require, UserError
+from toil_rnaseq.utils.s3 import sse_headers
+from toil_rnaseq.utils.s3 import sse_key
+
+# Uncompressed bytes in each gzip member of a consolidated tarball. Blocks are compressed concurrently
+block_size = 4 * 1024 * 1024
+
+# Compression level of each block, the same as gzip's default
+compression_level = 6
+
+# Version of the index sidecar, bumped when its fields change
+index_version = 1
+
+
+class BlockGzipFile(object):
+    """
+    Writable stream that gzips what is written to it as a series of independent gzip members (blocks), which
+    together are an ordinary gzip file. A new block can be started at any point with `new_block`, so a tar
+    member starting there can be decompressed without the blocks before it. Blocks are compressed on a thread
+    pool and written in order, with at most two blocks per thread held in memory.
+    """
+    def __init__(self, f_out, cores=1):
+        self.f_out = f_out
+        self.cores = cores
+        self.pool = ThreadPool(cores)
+        self.pending = deque()
+        self.buffer, self.buffered = [], 0
+        # Uncompressed bytes written, and compressed bytes written to `f_out`
+        self.position, self.compressed = 0, 0
+        # Compressed offset of each block once it is written, ending with the total size on close
+        self.offsets = []
+        self.num_blocks = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.position += len(data)
+        if self.buffered >= block_size:
+            self._submit()
+
+    def tell(self):
+        return self.position
+
+    def new_block(self):
+        """
+        Ends the current block, so what is written next starts a new one
+
+        :return: Number of the next block
+        :rtype: int
+        """
+        self._submit()
+        return self.num_blocks
+
+    def close(self):
+        self._submit()
+        try:
+            while self.pending:
+                self._write_block(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+        self.offsets.append(self.compressed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.pool.terminate()
+        else:
+            self.close()
+
+    def _submit(self):
+        if not self.buffered:
+            return
+        self.pending.append(self.pool.apply_async(_compress, (''.join(self.buffer),)))
+        self.buffer, self.buffered = [], 0
+        self.num_blocks += 1
+        while self.pending and (self.pending[0].ready() or len(self.pending) > 2 * self.cores):
+            self._write_block(self.pending.popleft().get())
+
+    def _write_block(self, block):
+        self.offsets.append(self.compressed)
+        self.f_out.write(block)
+        self.compressed += len(block)
+
+
+class HashingReader(object):
+    """Stream that computes the sha256 of what is read through it"""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def index_entry(tool, tarinfo, header_offset, end_offset, sha256, blocks):
+    """
+    Index entry of one member of a consolidated tarball
+
+    >>> tarinfo = tarfile.TarInfo('uuid/RSEM/rsem_genes.results')
+    >>> tarinfo.size = 1000
+    >>> entry = index_entry('RSEM', tarinfo, 1024, 2560, 'e3b0c442', (2, 3))
+    >>> entry['offset'], entry['size']
+    (1536, 1000)
+
+    :param str tool: Tool's directory in the output
+    :param TarInfo tarinfo: Member
+    :param int header_offset: Uncompressed offset of the member's tar header
+    :param int end_offset: Uncompressed offset after the member's padded contents
+    :param str sha256: Hex digest of the member's contents
+    :param tuple(int, int) blocks: First block of the member and the first block after it
+    :return: Entry with compressed offsets left to `finish_index`
+    :rtype: dict
+    """
+    # Contents are padded to a multiple of the tar block size, and the (variable-size) header comes before them
+    padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return {'name': tarinfo.name, 'tool': tool, 'size': tarinfo.size, 'sha256': sha256,
+            'header_offset': header_offset, 'offset': end_offset - padded_size, 'blocks': blocks}
+
+
+def finish_index(entries, f_gz, archive_name):
+    """
+    Resolves the compressed byte range of each member once every block has been written
+
+    :param list(dict) entries: Entries from `index_entry`
+    :param BlockGzipFile f_gz: Closed stream the tarball was written to
+    :param str archive_name: Name of the tarball
+    :return: Index of the tarball
+    :rtype: dict
+    """
+    for entry in entries:
+        start, end = entry.pop('blocks')
+        entry['compressed_offset'] = f_gz.offsets[start]
+        entry['compressed_size'] = f_gz.offsets[end] - f_gz.offsets[start]
+    return {'version': index_version, 'archive': archive_name, 'compressed_size': f_gz.offsets[-1],
+            'members': entries}
+
+
+def index_name(archive_name):
+    """
+    Name of the index sidecar of a consolidated tarball
+
+    >>> index_name('8f1e3b0c.tar.gz')
+    '8f1e3b0c.index.json'
+
+    :param str archive_name: Name of tarball
+    :rtype: str
+    """
+    return archive_name[:-len('.tar.gz')] + '.index.json'
+
+
+def load_index(url, s3_key_path=None):
+    """
+    :param str url: URL of an index sidecar: local path, file://, http(s)://, or s3://
+    :param str s3_key_path: Path to 32-byte master key, if the index is on S3 and uses SSE-C
+    :rtype: dict
+    """
+    return json.loads(_read_range(url, None, None, s3_key_path))
+
+
+def read_member(url, index, name, s3_key_path=None):
+    """
+    Reads one member of a consolidated tarball, fetching and decompressing only the blocks that hold it.
+    Remote tarballs are read with a ranged request.
+
+    :param str url: URL of tarball: local path, file://, http(s)://, or s3://
+    :param dict index: Index of the tarball, see `load_index`
+    :param str name: Name of member, e.g. "<UUID>/RSEM/rsem_genes.results"
+    :param str s3_key_path: Path to 32-byte master key, if the tarball is on S3 and uses SSE-C
+    :return: Contents of member
+    :rtype: str
+    """
+    member = next((x for x in index['members'] if x['name'] == name), None)
+    require(member, 'No member {} in the index of {}'.format(name, url))
+    data = _decompress(_read_range(url, member['compressed_offset'], member['compressed_size'], s3_key_path))
+    start = member['offset'] - member['header_offset']
+    contents = data[start:start + member['size']]
+    require(hashlib.sha256(contents).hexdigest() == member['sha256'], 'Checksum of {} does not match'.format(name))
+    return contents
+
+
+def _compress(data):
+    """
+    :param str data: Uncompressed block
+    :return: Block as one gzip member
+    :rtype: str
+    """
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data):
+    """
+    Decompresses consecutive gzip members
+
+    >>> _decompress(_compress('tar') + _compress('ball'))
+    'tarball'
+
+    :param str data: gzip members
+    :rtype: str
+    """
+    output = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return ''.join(output)
+
+
+def _read_range(url, start, size, s3_key_path=None):
+    """
+    :param str url: URL of file: local path, file://, http(s)://, or s3://
+    :param int start: Offset of range, or None to read the whole file
+    :param int size: Size of range
+    :param str s3_key_path: Path to 32-byte master key used for SSE-C
+    :rtype: str
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme in ['', 'file']:
+        with open(parsed_url.path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(size)
+    byte_range = 'bytes={}-{}'.format(start, start + size - 1) if start is not None else None
+    if parsed_url.scheme == 's3':
+        headers = sse_headers(sse_key(s3_key_path, url)) if s3_key_path else {}
+        if byte_range:
+            headers['Range'] = byte_range
+        try:
+            import boto
+        except ImportError:
+            raise UserError('\n\nboto must be installed to read outputs from S3\n\n')
+        bucket = boto.connect_s3().get_bucket(parsed_url.netloc, validate=False)
+        return bucket.new_key(parsed_url.path.lstrip('/')).get_contents_as_string(headers=headers)
+    command = ['curl', '-fsL', '--retry', '5', url] + (['-r', byte_range[len('bytes='):]] if byte_range else [])
+    return subprocess.check_output(command)
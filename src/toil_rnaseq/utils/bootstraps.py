@@ -0,0 +1,95 @@
+import glob
+import json
+import os
+import sys
+from array import array
+
+from toil_rnaseq.utils import require
+
+# Values of each bootstrap that are summarized, as named in the TSVs written by "kallisto h5dump"
+summary_values = ['est_counts', 'tpm']
+
+# Statistics of each transcript's bootstraps. Quantiles interpolate linearly between bootstraps
+summary_quantiles = [0.025, 0.25, 0.5, 0.75, 0.975]
+summary_statistics = ['mean', 'variance'] + ['q{:g}'.format(100 * x) for x in summary_quantiles]
+
+
+def quantile(values, q):
+    """
+    Quantile of sorted values, interpolating between the nearest two
+
+    >>> quantile([1.0, 2.0, 3.0, 4.0], 0.5)
+    2.5
+    >>> quantile([1.0, 2.0, 3.0, 4.0], 0.975)
+    3.925
+
+    :param list(float) values: Sorted values
+    :param float q: Quantile, between 0 and 1
+    :rtype: float
+    """
+    position = q * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def statistics(values):
+    """
+    Summary statistics of one transcript's bootstraps, in the order of `summary_statistics`
+
+    >>> ['{:g}'.format(x) for x in statistics([4.0, 1.0, 3.0, 2.0])]
+    ['2.5', '1.66667', '1.075', '1.75', '2.5', '3.25', '3.925']
+
+    :param list(float) values: Value of each bootstrap
+    :return: Mean, sample variance, and quantiles
+    :rtype: list(float)
+    """
+    values = sorted(values)
+    mean = sum(values) / len(values)
+    variance = sum((x - mean) ** 2 for x in values) / (len(values) - 1) if len(values) > 1 else 0.0
+    return [mean, variance] + [quantile(values, q) for q in summary_quantiles]
+
+
+def summarize_bootstraps(bootstrap_dir, output_dir):
+    """
+    Summarizes the bootstraps dumped from an abundance.h5 by "kallisto h5dump" (bs_abundance_<N>.tsv) as
+    little-endian float32 arrays. The summary (bootstrap_summary.f32) holds, for each value and then each statistic,
+    one float per transcript in the order of abundance.tsv. Its layout is described in bootstrap_summary.json.
+
+    :param str bootstrap_dir: Directory of bootstrap TSVs
+    :param str output_dir: Directory the summary is written to
+    :return: Paths to the summary and its description
+    :rtype: list(str)
+    """
+    paths = sorted(glob.glob(os.path.join(bootstrap_dir, 'bs_abundance_*.tsv')),
+                   key=lambda x: int(os.path.basename(x)[len('bs_abundance_'):-len('.tsv')]))
+    require(paths, 'No bootstraps found in {}'.format(bootstrap_dir))
+
+    # Bootstraps are read one after another into one array per value, so a transcript's values are strided
+    bootstraps = {x: array('f') for x in summary_values}
+    num_targets = None
+    for path in paths:
+        with open(path) as f:
+            header = next(f).rstrip('\n').split('\t')
+            indices = [header.index(x) for x in summary_values]
+            rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+        require(num_targets in [None, len(rows)], 'Bootstraps differ in length: {}'.format(path))
+        num_targets = len(rows)
+        for value, i in zip(summary_values, indices):
+            bootstraps[value].extend(float(row[i]) for row in rows)
+
+    summary_path = os.path.join(output_dir, 'bootstrap_summary.f32')
+    with open(summary_path, 'wb') as f:
+        for value in summary_values:
+            stats = [statistics(bootstraps[value][t::num_targets]) for t in xrange(num_targets)]
+            for i in xrange(len(summary_statistics)):
+                column = array('f', (x[i] for x in stats))
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                f.write(column.tostring())
+    description_path = os.path.join(output_dir, 'bootstrap_summary.json')
+    with open(description_path, 'w') as f:
+        json.dump({'bootstraps': len(paths), 'targets': num_targets, 'values': summary_values,
+                   'statistics': summary_statistics, 'dtype': '<f4', 'shape': [len(summary_values),
+                   len(summary_statistics), num_targets]}, f, indent=2)
+    return [summary_path, description_path]
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import shutil
+from urlparse import urlparse
+
+from toil_rnaseq.utils import mkdir_p
+from toil_rnaseq.utils.expando import Expando
+from toil_rnaseq.utils.s3 import upload_file
+from toil_rnaseq.utils.urls import download_url
+from toil_rnaseq.utils.urls import s3_listing
+from toil_rnaseq.utils.urls import url_etag
+from toil_rnaseq.utils.urls import url_size
+
+# Bytes read at a time when hashing inputs
+block_size = 16 * 1024 * 1024
+
+# Written last when storing an entry, so partially stored entries are never used
+manifest_name = 'manifest.json'
+
+
+def cache_location(config):
+    """
+    Location of the stage cache, passed to tools that can reuse cached outputs
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :return: Cache directory or s3:// URL and the SSE-C key used for S3, or None if caching is disabled
+    :rtype: Expando
+    """
+    if not config.stage_cache:
+        return None
+    return Expando(url=config.stage_cache.rstrip('/') + '/', ssec=config.ssec)
+
+
+def stage_key(stage, image, parameters, inputs):
+    """
+    Key of a stage's outputs. Thread counts should be left out of `parameters` as they don't change the output.
+
+    >>> key = stage_key('rsem', 'rsem:1.2.25', ['--paired-end'], ['9f86d08'])
+    >>> key == stage_key('rsem', 'rsem:1.2.25', ['--paired-end'], ['9f86d08'])
+    True
+    >>> key == stage_key('rsem', 'rsem:1.3.0', ['--paired-end'], ['9f86d08'])
+    False
+
+    :param str stage: Name of stage
+    :param str|list(str) image: Docker image(s) used by the stage
+    :param list parameters: Parameters that determine the stage's output
+    :param list(str) inputs: Content hashes (or other identity) of the stage's inputs
+    :return: Hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps([stage, image, list(parameters), list(inputs)])).hexdigest()
+
+
+def file_hash(path):
+    """
+    SHA-256 of a file's contents
+
+    :param str path: Path to file
+    :return: Hex digest, or None if `path` is None
+    :rtype: str
+    """
+    if path is None:
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def url_identity(url):
+    """
+    Identity of an input URL for `stage_key`, found before the input is downloaded: the content hash of local
+    files, and the ETag of remote files, or their size if they have no ETag
+
+    :param str url: URL of input
+    :return: Identity, or None if it could not be determined
+    :rtype: str
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 'file':
+        return file_hash(parsed_url.path) if os.path.isfile(parsed_url.path) else None
+    etag = url_etag(url)
+    if etag:
+        return 'etag:' + etag
+    size = url_size(url)
+    return 'size:{}'.format(size) if size is not None else None
+
+
+def fetch(cache, key, work_dir):
+    """
+    Copies a cached stage's outputs into a directory
+
+    :param Expando cache: Location of the cache from `cache_location`
+    :param str key: Key from `stage_key`
+    :param str work_dir: Directory to copy outputs to
+    :return: Path of each output keyed by name, or None if the stage is not cached
+    :rtype: dict(str, str)
+    """
+    entry = cache.url + key + '/'
+    if urlparse(entry).scheme == 's3':
+        if manifest_name not in s3_listing(entry):
+            return None
+        manifest = download_url(entry + manifest_name, work_dir=work_dir, s3_key_path=cache.ssec)
+    else:
+        if not os.path.exists(os.path.join(entry, manifest_name)):
+            return None
+        manifest = os.path.join(entry, manifest_name)
+    with open(manifest) as f:
+        names = json.load(f)
+    paths = {}
+    for name in names:
+        if urlparse(entry).scheme == 's3':
+            paths[name] = download_url(entry + name, work_dir=work_dir, s3_key_path=cache.ssec)
+        else:
+            paths[name] = os.path.join(work_dir, name)
+            shutil.copy(os.path.join(entry, name), paths[name])
+    return paths
+
+
+def store(cache, key, paths, work_dir):
+    """
+    Stores a stage's outputs in the cache. Outputs are stored by file name.
+
+    :param Expando cache: Location of the cache from `cache_location`
+    :param str key: Key from `stage_key`
+    :param list(str) paths: Paths to outputs
+    :param str work_dir: Directory for temporary files
+    """
+    entry = cache.url + key + '/'
+    manifest = os.path.join(work_dir, manifest_name)
+    with open(manifest, 'w') as f:
+        json.dump([os.path.basename(x) for x in paths], f)
+    if urlparse(entry).scheme == 's3':
+        for path in paths + [manifest]:
+            upload_file(path, entry + os.path.basename(path), s3_key_path=cache.ssec)
+    else:
+        mkdir_p(entry)
+        for path in paths + [manifest]:
+            shutil.copy(path, os.path.join(entry, os.path.basename(path) + '.tmp'))
+            os.rename(os.path.join(entry, os.path.basename(path) + '.tmp'), os.path.join(entry, os.path.basename(path)))
+    os.remove(manifest)
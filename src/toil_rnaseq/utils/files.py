@@ -1,18 +1,33 @@
+import fcntl
+import logging
 import os
 import shutil
+import sys
 import tarfile
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Bytes copied at a time when an output can't be linked
+copy_buffer_size = 16 * 1024 * 1024
+
+# ioctl that shares a file's data with a new file on copy-on-write filesystems (btrfs, XFS), from linux/fs.h
+FICLONE = 0x40049409
 
 
 def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
     """
-    Creates a tarball from a group of files
+    Creates a tarball from a group of files. Names ending in ".gz" or ".tgz" are gzipped, others are not.
+    Outputs of each tool are left uncompressed as they are compressed once when consolidated.
 
     :param str tar_name: Name of tarball
     :param list[str] file_paths: Absolute file paths to include in the tarball
     :param str output_dir: Output destination for tarball
     :param str prefix: Optional prefix for files in tarball
     """
-    with tarfile.open(os.path.join(output_dir, tar_name), 'w:gz') as f_out:
+    mode = 'w:gz' if tar_name.endswith(('.gz', '.tgz')) else 'w'
+    with tarfile.open(os.path.join(output_dir, tar_name), mode) as f_out:
         for file_path in file_paths:
             if not file_path.startswith('/'):
                 raise ValueError('Path provided is relative not absolute.')
@@ -20,6 +35,20 @@ def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
             f_out.add(file_path, arcname=arcname)
 
 
+@contextmanager
+def open_output(path=None):
+    """
+    Opens a file for writing, or yields stdout, which is left open, if no path is given
+
+    :param str path: Path to output file, or None for stdout
+    """
+    if not path:
+        yield sys.stdout
+        return
+    with open(path, 'w') as f:
+        yield f
+
+
 def __forall_files(file_paths, output_dir, op):
     """
     Applies a function to a set of files and an output directory.
@@ -59,6 +88,74 @@ def move_files(file_paths, output_dir):
     __forall_files(file_paths, output_dir, shutil.move)
 
 
+def deliver_file(file_path, output_dir, owned=False):
+    """
+    Places a file in a local output directory without copying its data where possible. In order: renames it if
+    the caller owns it (it isn't shared with the fileStore cache), clones it (reflink), or hardlinks it, each of
+    which only works on the same filesystem. Otherwise it is copied in large blocks. The output is created under
+    a temporary name and renamed, so it is never seen partly written.
+
+    :param str file_path: Absolute path to file
+    :param str output_dir: Output directory
+    :param bool owned: If True, the file may be moved rather than left in place
+    :return: How the file was delivered: "rename", "reflink", "hardlink", or "copy"
+    :rtype: str
+    """
+    if not file_path.startswith('/'):
+        raise ValueError('Path provided (%s) is relative not absolute.' % file_path)
+    dest = os.path.join(output_dir, os.path.basename(file_path))
+    partial = dest + '.partial'
+    start = time.time()
+    method = None
+    if owned:
+        try:
+            os.rename(file_path, dest)
+            method = 'rename'
+        except OSError:
+            pass
+    if not method:
+        for method, deliver in [('reflink', _reflink), ('hardlink', os.link), ('copy', _copy)]:
+            if os.path.lexists(partial):
+                os.remove(partial)
+            try:
+                deliver(file_path, partial)
+                break
+            except (OSError, IOError):
+                if method == 'copy':
+                    raise
+        os.rename(partial, dest)
+    log.info('Delivered {} to {} by {} in {:.1f}s'.format(os.path.basename(file_path), output_dir, method,
+                                                           time.time() - start))
+    return method
+
+
+def _reflink(src, dest):
+    """
+    Creates `dest` sharing the data of `src`. Raises IOError if the filesystem can't clone files.
+
+    :param str src: Path to file
+    :param str dest: Path to new file
+    """
+    with open(src, 'rb') as f_src:
+        try:
+            with open(dest, 'wb') as f_dest:
+                fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+        except (OSError, IOError):
+            os.remove(dest)
+            raise
+    shutil.copymode(src, dest)
+
+
+def _copy(src, dest):
+    """
+    :param str src: Path to file
+    :param str dest: Path to new file
+    """
+    with open(src, 'rb') as f_src, open(dest, 'wb') as f_dest:
+        shutil.copyfileobj(f_src, f_dest, copy_buffer_size)
+    shutil.copymode(src, dest)
+
+
 def generate_file(file_path, generate_func):
     """
     Checks file existance, generates file, and provides message
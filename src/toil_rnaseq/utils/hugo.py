@@ -0,0 +1,161 @@
+import gzip
+import mmap
+import os
+import struct
+
+from toil_rnaseq.utils import require
+from toil_rnaseq.utils.urls import download_url
+
+# Header of a mapping table: magic, width of IDs, width of names. Records follow, sorted by ID, NUL-padded
+header_format = '<8sII'
+header_size = struct.calcsize(header_format)
+table_magic = 'HUGOMAP1'
+
+# Columns of RSEM's output holding ENSEMBL IDs: gene_id for genes, transcript_id and gene_id for isoforms
+rsem_columns = {'genes': [0], 'isoforms': [0, 1]}
+
+# Tables already opened by this worker, keyed by FileStoreID
+_tables = {}
+
+
+class MappingTable(object):
+    """
+    ENSEMBL gene / transcript ID to HUGO name table, memory-mapped from the file written by `build_table`.
+    Pages are shared between every job on a node reading the same file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.id_width, self.name_width = struct.unpack_from(header_format, self.map)
+        require(magic == table_magic, '{} is not a HUGO mapping table'.format(path))
+        self.record_size = self.id_width + self.name_width
+
+    def __len__(self):
+        return (len(self.map) - header_size) // self.record_size
+
+    def id(self, i):
+        start = header_size + i * self.record_size
+        return self.map[start:start + self.id_width].rstrip('\0')
+
+    def name(self, i):
+        start = header_size + i * self.record_size + self.id_width
+        return self.map[start:start + self.name_width].rstrip('\0')
+
+    def lookup(self, ids):
+        """
+        Finds the names of many IDs at once. IDs are sorted and searched in order, so each search starts where
+        the last one ended. IDs not found with their version (ENSG00000141510.16) are looked up without it.
+
+        :param iter(str) ids: ENSEMBL IDs
+        :return: Names of the IDs that were found, keyed by ID
+        :rtype: dict(str, str)
+        """
+        ids, names, lo = set(ids), {}, 0
+        for x in sorted(ids):
+            lo = self._search(x, lo)
+            if lo < len(self) and self.id(lo) == x:
+                names[x] = self.name(lo)
+        unversioned = {x: x.rsplit('.', 1)[0] for x in ids if x not in names and '.' in x}
+        if unversioned:
+            found = self.lookup(unversioned.values())
+            names.update({x: found[y] for x, y in unversioned.iteritems() if y in found})
+        return names
+
+    def _search(self, x, lo):
+        """Index of the first ID not less than `x`, searching from `lo`"""
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.id(mid) < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def build_table(tsv_path, table_path):
+    """
+    Writes a compact, fixed-width mapping table from a tab-separated file (optionally gzipped) with an ENSEMBL
+    gene or transcript ID and its HUGO name on each line
+
+    :param str tsv_path: Path to mapping TSV
+    :param str table_path: Path to write the table to
+    :return: Number of IDs in the table
+    :rtype: int
+    """
+    with (gzip.open if tsv_path.endswith('.gz') else open)(tsv_path) as f:
+        pairs = dict(line.rstrip('\n').split('\t')[:2] for line in f if line.strip() and not line.startswith('#'))
+    require(pairs, 'No IDs found in HUGO mapping: {}'.format(tsv_path))
+    id_width, name_width = max(len(x) for x in pairs), max(len(x) for x in pairs.itervalues())
+    with open(table_path, 'wb') as f:
+        f.write(struct.pack(header_format, table_magic, id_width, name_width))
+        for x in sorted(pairs):
+            f.write(x.ljust(id_width, '\0') + pairs[x].ljust(name_width, '\0'))
+    return len(pairs)
+
+
+def import_mapping(toil, url, work_dir):
+    """
+    Builds the mapping table once, before the run, and imports it into the job store
+
+    :param Toil toil: Toil context manager
+    :param str url: URL of mapping TSV
+    :param str work_dir: Local directory the TSV and table are written to
+    :return: FileStoreID of the mapping table
+    :rtype: str
+    """
+    tsv_path = download_url(url, work_dir=work_dir)
+    table_path = os.path.join(work_dir, 'hugo.map')
+    build_table(tsv_path, table_path)
+    return toil.importFile('file://' + table_path)
+
+
+def load_table(job, table_id):
+    """
+    Opens the mapping table, reading it through the worker's file cache the first time it's used on a node
+
+    :param JobFunctionWrappingJob job: Passed automatically by Toil
+    :param str table_id: FileStoreID of mapping table
+    :rtype: MappingTable
+    """
+    if table_id not in _tables:
+        _tables[table_id] = MappingTable(job.fileStore.readGlobalFile(table_id, cache=True))
+    return _tables[table_id]
+
+
+def relabel(lines, names, columns):
+    """
+    Replaces IDs in columns of a tab-separated table with their names. IDs without a name are kept.
+
+    >>> relabel(['gene_id\\tTPM\\n', 'ENSG1.2\\t1.5\\n', 'ENSG2\\t0\\n'], {'ENSG1.2': 'TP53'}, [0])
+    ['gene_id\\tTPM\\n', 'TP53\\t1.5\\n', 'ENSG2\\t0\\n']
+
+    :param list(str) lines: Lines of table, starting with its header
+    :param dict(str, str) names: Name of each ID
+    :param list(int) columns: Columns holding IDs
+    :rtype: list(str)
+    """
+    output = lines[:1]
+    for line in lines[1:]:
+        fields = line.split('\t')
+        for i in columns:
+            fields[i] = names.get(fields[i], fields[i])
+        output.append('\t'.join(fields))
+    return output
+
+
+def map_rsem_output(table, input_path, output_path, kind):
+    """
+    Writes a copy of RSEM's gene or isoform output with ENSEMBL IDs replaced by HUGO names
+
+    :param MappingTable table: Mapping table
+    :param str input_path: Path to RSEM output
+    :param str output_path: Path to write relabeled output to
+    :param str kind: "genes" or "isoforms"
+    """
+    columns = rsem_columns[kind]
+    with open(input_path) as f:
+        lines = f.readlines()
+    names = table.lookup(line.split('\t')[i] for line in lines[1:] for i in columns)
+    with open(output_path, 'w') as f:
+        f.writelines(relabel(lines, names, columns))
@@ -0,0 +1,203 @@
+import fcntl
+import mmap
+import os
+import sys
+import tarfile
+from array import array
+from collections import OrderedDict
+
+from toil_rnaseq.utils import mkdir_p, require
+from toil_rnaseq.utils.expando import Expando
+
+# Quantification tables kept in a cohort matrix, keyed by the output directory and file they are read from
+tables = OrderedDict([(('RSEM', 'rsem_genes.results'), 'rsem-genes'),
+                      (('RSEM', 'rsem_isoforms.results'), 'rsem-isoforms'),
+                      (('Kallisto', 'abundance.tsv'), 'kallisto'),
+                      (('Hera', 'abundance.tsv'), 'hera'),
+                      (('Hera', 'abundance.gene.tsv'), 'hera-genes')])
+
+# Columns of each tool's output holding each value, in order of preference
+value_columns = OrderedDict([('tpm', ['TPM', 'tpm']),
+                             ('counts', ['expected_count', 'est_counts', 'count', 'counts'])])
+
+# Values are stored as little-endian float32, one file per value with each sample's column stored contiguously
+value_size = array('f').itemsize
+
+
+def parse_quantification(lines):
+    """
+    Reads feature IDs and values from a tool's tab-separated output. IDs are in the first column.
+
+    >>> ids, values = parse_quantification(['target_id\\tlength\\test_counts\\ttpm', 'ENST1\\t10\\t5\\t1.5'])
+    >>> ids, values['tpm'], values['counts']
+    (['ENST1'], [1.5], [5.0])
+
+    :param iter(str) lines: Lines of the output, starting with its header
+    :return: Feature IDs and the values of each feature, keyed by value name
+    :rtype: tuple(list(str), dict(str, list(float)))
+    """
+    lines = iter(lines)
+    header = next(lines).rstrip('\n').lstrip('#').split('\t')
+    indices = {}
+    for value, names in value_columns.iteritems():
+        index = next((header.index(x) for x in names if x in header), None)
+        require(index is not None, 'None of the columns {} found in header: {}'.format(names, header))
+        indices[value] = index
+    ids, values = [], {x: [] for x in indices}
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = line.rstrip('\n').split('\t')
+        ids.append(fields[0])
+        for value, index in indices.iteritems():
+            values[value].append(float(fields[index]))
+    return ids, values
+
+
+def append_sample(store, uuid, quantifications):
+    """
+    Adds a sample to the cohort matrix as one more column of each table, without rewriting existing columns.
+    A table's features are fixed by the first sample added, later samples are reordered to match them and
+    features they lack are NaN. A sample that is already in a table replaces its column in place.
+    Concurrent writers are serialized with a lock on the store.
+
+    :param str store: Directory of the cohort matrix, on a filesystem that supports flock
+    :param str uuid: Sample UUID
+    :param dict(str, str) quantifications: Contents of each tool's output, keyed by table name (see `tables`)
+    """
+    mkdir_p(store)
+    with open(os.path.join(store, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for table, contents in quantifications.iteritems():
+            ids, values = parse_quantification(contents.splitlines())
+            _append_column(os.path.join(store, table), uuid, ids, values)
+
+
+def add_tarball(store, tarball_path):
+    """
+    Adds a sample's quantifications from its consolidated output (<UUID>.tar.gz) to the cohort matrix
+
+    :param str store: Directory of the cohort matrix
+    :param str tarball_path: Path to consolidated output of a sample
+    :return: UUID of the sample and the tables it was added to
+    :rtype: tuple(str, list(str))
+    """
+    uuid, quantifications = None, {}
+    # Not read as a stream, which stops after the first gzip member
+    with tarfile.open(tarball_path, 'r:*') as tar:
+        for tarinfo in tar:
+            parts = tarinfo.name.split('/')
+            uuid = uuid or parts[0]
+            table = tables.get(tuple(parts[-2:]))
+            if table and tarinfo.isfile():
+                quantifications[table] = tar.extractfile(tarinfo).read()
+    require(quantifications, 'No quantifications found in {}'.format(tarball_path))
+    append_sample(store, uuid, quantifications)
+    return uuid, sorted(quantifications)
+
+
+def load_matrix(store, table):
+    """
+    Opens a table of the cohort matrix for reading
+
+    :param str store: Directory of the cohort matrix
+    :param str table: Name of table, see `tables`
+    :return: Table's directory, feature IDs, and the column of each sample keyed by UUID
+    :rtype: Expando
+    """
+    table_dir = os.path.join(store, table)
+    require(os.path.exists(os.path.join(table_dir, 'features.tsv')), 'No table "{}" in {}'.format(table, store))
+    samples = _read_index(os.path.join(table_dir, 'samples.tsv'))
+    return Expando(dir=table_dir, features=_read_index(os.path.join(table_dir, 'features.tsv')),
+                   samples=OrderedDict((x, i) for i, x in enumerate(samples)))
+
+
+def read_column(matrix, uuid, value='tpm'):
+    """
+    Reads one sample's values without reading the rest of the table
+
+    :param Expando matrix: Table from `load_matrix`
+    :param str uuid: Sample UUID
+    :param str value: Name of value, one of `value_columns`
+    :return: Value of each feature, in the order of the table's features
+    :rtype: array
+    """
+    require(uuid in matrix.samples, 'Sample {} is not in {}'.format(uuid, matrix.dir))
+    column_bytes = len(matrix.features) * value_size
+    with open(os.path.join(matrix.dir, value + '.f32'), 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = matrix.samples[uuid] * column_bytes
+            column = array('f', m[start:start + column_bytes])
+        finally:
+            m.close()
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def export_table(matrix, f_out, value='tpm', samples=None):
+    """
+    Writes a table as tab-separated text with a row per feature and a column per sample
+
+    :param Expando matrix: Table from `load_matrix`
+    :param file f_out: Stream to write to
+    :param str value: Name of value, one of `value_columns`
+    :param list(str) samples: UUIDs of samples to export, all samples by default
+    """
+    samples = samples or matrix.samples.keys()
+    columns = [read_column(matrix, x, value) for x in samples]
+    f_out.write('\t'.join(['feature'] + samples) + '\n')
+    for i, feature in enumerate(matrix.features):
+        f_out.write('\t'.join([feature] + ['{:g}'.format(x[i]) for x in columns]) + '\n')
+
+
+def _append_column(table_dir, uuid, ids, values):
+    """
+    Adds (or replaces) a sample's column in one table. The sample index is written last, so a column
+    that was only partly appended is dropped by the next append.
+
+    :param str table_dir: Directory of table
+    :param str uuid: Sample UUID
+    :param list(str) ids: Feature IDs of the sample
+    :param dict(str, list(float)) values: Value of each feature, keyed by value name
+    """
+    mkdir_p(table_dir)
+    features_path, samples_path = os.path.join(table_dir, 'features.tsv'), os.path.join(table_dir, 'samples.tsv')
+    if not os.path.exists(features_path):
+        with open(features_path + '.tmp', 'w') as f:
+            f.write(''.join(x + '\n' for x in ids))
+        os.rename(features_path + '.tmp', features_path)
+        open(samples_path, 'a').close()
+    features = _read_index(features_path)
+    samples = _read_index(samples_path)
+
+    if ids != features:
+        order = {x: i for i, x in enumerate(ids)}
+        values = {k: [v[order[x]] if x in order else float('nan') for x in features] for k, v in values.iteritems()}
+
+    column_bytes = len(features) * value_size
+    index = samples.index(uuid) if uuid in samples else len(samples)
+    for value in value_columns:
+        column = array('f', values[value])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        path = os.path.join(table_dir, value + '.f32')
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            f.truncate(len(samples) * column_bytes)
+            f.seek(index * column_bytes)
+            f.write(column.tostring())
+            f.flush()
+            os.fsync(f.fileno())
+    if index == len(samples):
+        with open(samples_path, 'a') as f:
+            f.write(uuid + '\n')
+
+
+def _read_index(path):
+    """
+    :param str path: Path to index with one entry per line
+    :rtype: list(str)
+    """
+    with open(path) as f:
+        return [x.rstrip('\n') for x in f]
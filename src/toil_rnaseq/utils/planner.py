@@ -0,0 +1,299 @@
+from __future__ import division
+
+import heapq
+from collections import OrderedDict, defaultdict
+
+from toil_rnaseq.utils import require
+from toil_rnaseq.utils.filesize import bytes2human
+from toil_rnaseq.utils.filesize import human2bytes
+from toil_rnaseq.utils.policy import allocate_cores
+from toil_rnaseq.utils.policy import runtime
+from toil_rnaseq.utils.preflight import input_sizes
+from toil_rnaseq.utils.resources import predict
+
+# Requirements Toil gives jobs that don't request them
+default_memory = human2bytes('2G')
+default_disk = human2bytes('2G')
+
+# Size of intermediate files relative to the file they are derived from. Compressed inputs (gzipped fastqs,
+# tarballs, BAMs) are decompressed during preprocessing, and the BAMs STAR writes are relative to the fastqs.
+ratios = {'decompressed': 4, 'transcriptome_bam': 0.5, 'aligned_bam': 0.3, 'wiggle': 0.05}
+
+
+def plan_sample(sample, config):
+    """
+    Jobs `toil_rnaseq.workflow` wires for one sample, with the requirements the workflow would request given the
+    sample's input sizes. Bookkeeping jobs (cleanup, gene mapping, consolidation) are left out, and Kallisto is
+    planned per sample when samples are quantified in batches.
+
+    :param list(str) sample: Sample information - filetype, paired/unpaired, UUID, URL, and the size of each URL
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :return: Jobs in the order they are wired, each with its name, tool, cores, memory, disk,
+        estimated wall time in seconds, and the names of the jobs it waits for
+    :rtype: list(dict)
+    """
+    config = _sample_config(sample, config)
+    config.file_type, config.paired, config.uuid = sample[:3]
+    model = config.resources
+    jobs = []
+
+    def add(name, tool, input_size, after, cores=1, memory=None, disk=None):
+        disk = predict(model, tool, 'disk', input_size) if disk is None else disk
+        jobs.append({'name': name, 'tool': tool, 'cores': cores, 'memory': memory or default_memory,
+                     'disk': disk or default_disk, 'seconds': wall_seconds(config, tool, input_size, cores),
+                     'after': after})
+        return [name]
+
+    # Preprocessing
+    sizes = input_sizes(config)
+    urls = config.url.split(',')
+    if config.file_type == 'bam':
+        inputs = add('bam', 'bam', sum(sizes), [])
+        fastq_size = sum(sizes) * ratios['decompressed']
+    elif config.file_type == 'tar':
+        inputs = add('tar', 'tar', sum(sizes), add('download', 'download', sum(sizes), []))
+        fastq_size = sum(sizes) * ratios['decompressed']
+    else:
+        downloads = [add('download-{}'.format(i), 'download', size, []) for i, size in enumerate(sizes)]
+        inputs = add('fastqs', 'fastqs', sum(sizes), [x[0] for x in downloads])
+        fastq_size = sum(size * (ratios['decompressed'] if url.endswith('gz') else 1)
+                         for url, size in zip(urls, sizes))
+    if config.cutadapt:
+        inputs = add('cutadapt', 'cutadapt', fastq_size, inputs)
+
+    # Quantification
+    batch = config.kallisto_index and config.kallisto_batch_size > 1
+    colocated = [tool for tool, enabled in [('fastqc', config.fastqc),
+                                            ('kallisto', config.kallisto_index and not batch),
+                                            ('hera', config.hera_index)] if enabled]
+    colocated = colocated if config.colocate_quantifiers and len(colocated) > 1 else []
+    if colocated:
+        add('quantifiers', 'quantifiers', fastq_size, inputs, cores=allocate_cores(config, 'quantifiers'))
+    if config.fastqc and 'fastqc' not in colocated:
+        add('fastqc', 'fastqc', fastq_size, inputs, cores=allocate_cores(config, 'fastqc'))
+    if config.kallisto_index and 'kallisto' not in colocated:
+        # A batch's disk holds two samples while the next is prefetched
+        add('kallisto', 'kallisto', fastq_size, inputs, cores=allocate_cores(config, 'kallisto'),
+            disk=predict(model, 'kallisto', 'disk', 2 * fastq_size) if batch else None)
+    if config.hera_index and 'hera' not in colocated:
+        add('hera', 'hera', fastq_size, inputs, cores=allocate_cores(config, 'hera'))
+
+    # STAR and RSEM
+    if config.star_index and config.rsem_ref:
+        colocate = config.colocate_post_alignment and any([config.bamqc, config.save_bam, config.wiggle])
+        star_tool = 'star-colocated' if colocate else 'star'
+        if config.ci_test:
+            disk, mem = human2bytes('2G'), human2bytes('2G')
+        else:
+            disk, mem = None, predict(model, star_tool, 'memory', fastq_size)
+        if config.fuse_star_rsem and disk is None:
+            disk = predict(model, star_tool, 'disk', fastq_size) + predict(model, 'rsem', 'disk')
+        cram = config.save_bam and config.save_bam_format == 'cram'
+        if cram and colocate and not config.ci_test:
+            disk = (disk or predict(model, star_tool, 'disk', fastq_size)) + predict(model, 'cram', 'disk')
+        star = add('star', star_tool, fastq_size, inputs, cores=allocate_cores(config, star_tool, mem),
+                   memory=mem, disk=disk)
+        star_job = jobs[-1]
+        aligned_size = fastq_size * ratios['aligned_bam']
+        cram_disk = predict(model, 'cram', 'disk', aligned_size) if cram else 0
+        if config.bamqc and not colocate:
+            add('bamqc', 'bamqc', aligned_size, star, cores=allocate_cores(config, 'bamqc'),
+                disk=predict(model, 'bamqc', 'disk', aligned_size) + cram_disk)
+        if config.save_bam and not config.bamqc and not colocate:
+            add('sort', 'sort', aligned_size, star, disk=predict(model, 'sort', 'disk', aligned_size) + cram_disk)
+        if config.wiggle and not colocate:
+            add('wiggle', 'wiggle', fastq_size * ratios['wiggle'], star)
+        if config.fuse_star_rsem:
+            # RSEM parses the BAM on cores of its own while STAR aligns, then runs its EM in the STAR job
+            rsem_cores = allocate_cores(config, 'rsem')
+            star_job['seconds'] += wall_seconds(config, 'rsem', fastq_size * ratios['transcriptome_bam'], rsem_cores)
+            star_job['cores'] = min(config.cores, star_job['cores'] + rsem_cores)
+        else:
+            add('rsem', 'rsem', fastq_size * ratios['transcriptome_bam'], star, cores=allocate_cores(config, 'rsem'))
+    return jobs
+
+
+def wall_seconds(config, tool, input_size, cores):
+    """
+    Estimated wall time of a tool's job. The CPU time predicted by the resource model is divided among the job's
+    cores, following the tool's scaling curve when one was measured and assuming perfect scaling otherwise.
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str tool: Name of tool, one of `toil_rnaseq.utils.resources.priors`
+    :param int input_size: Size of the tool's input in bytes
+    :param int cores: Number of cores given to the job
+    :return: Wall time in seconds
+    :rtype: float
+    """
+    cpu_seconds = predict(config.resources, tool, 'cpu_seconds', input_size) or 0
+    curve = config.scaling.get(tool.split('-')[0])
+    if curve:
+        return cpu_seconds * runtime(curve, cores) / runtime(curve, 1)
+    return cpu_seconds / cores
+
+
+def summarize_sample(jobs):
+    """
+    Totals of a sample's planned jobs
+
+    >>> jobs = [{'name': 'a', 'cores': 1, 'memory': 2, 'disk': 5, 'seconds': 3600, 'after': []},
+    ...         {'name': 'b', 'cores': 4, 'memory': 8, 'disk': 1, 'seconds': 1800, 'after': ['a']},
+    ...         {'name': 'c', 'cores': 2, 'memory': 2, 'disk': 1, 'seconds': 600, 'after': ['a']}]
+    >>> s = summarize_sample(jobs)
+    >>> s['core_hours'], s['peak_disk'], s['peak_memory'], s['critical_path_hours']
+    (3.3333333333333335, 5, 8, 1.5)
+
+    :param list(dict) jobs: Jobs from `plan_sample`
+    :return: Number of jobs, core-hours reserved, largest disk and memory request, and the wall time of the
+        longest chain of jobs, which bounds how soon the sample can finish
+    :rtype: dict
+    """
+    finish = {}
+    for job in jobs:
+        finish[job['name']] = max([finish[x] for x in job['after']] or [0]) + job['seconds']
+    return {'jobs': len(jobs),
+            'core_hours': sum(x['cores'] * x['seconds'] for x in jobs) / 3600,
+            'peak_disk': max(x['disk'] for x in jobs),
+            'peak_memory': max(x['memory'] for x in jobs),
+            'critical_path_hours': max(finish.values()) / 3600}
+
+
+def simulate(plans, num_nodes, node_cores, node_memory, node_disk):
+    """
+    Estimates the makespan of a run by scheduling every sample's jobs on identical nodes. A job is ready once
+    the jobs it waits for finish, and ready jobs start in manifest order on the first node they fit on.
+
+    >>> plans = [[{'name': 'a', 'tool': 'x', 'cores': 2, 'memory': 1, 'disk': 1, 'seconds': 10, 'after': []},
+    ...           {'name': 'b', 'tool': 'y', 'cores': 1, 'memory': 1, 'disk': 1, 'seconds': 5, 'after': ['a']}]] * 2
+    >>> simulate(plans, 1, 2, 10, 10), simulate(plans, 1, 4, 10, 10), simulate(plans, 2, 2, 10, 10)
+    (30, 15, 15)
+
+    :param list(list(dict)) plans: Jobs of each sample from `plan_sample`
+    :param int num_nodes: Number of nodes
+    :param int node_cores: Cores per node
+    :param int node_memory: Memory per node in bytes
+    :param int node_disk: Disk per node in bytes
+    :return: Makespan in seconds
+    :rtype: float
+    """
+    for plan in plans:
+        for job in plan:
+            require(job['cores'] <= node_cores and job['memory'] <= node_memory and job['disk'] <= node_disk,
+                    'Job "{}" needs {} cores, {} memory, and {} disk which does not fit on a node'.format(
+                        job['name'], job['cores'], bytes2human(job['memory']), bytes2human(job['disk'])))
+
+    # Jobs are (sample, index) pairs. Ready jobs are queued per tool so one tool's jobs waiting for a node
+    # don't hold up smaller jobs behind them
+    waiting, dependents = {}, defaultdict(list)
+    ready = OrderedDict()
+    for i, plan in enumerate(plans):
+        index = {job['name']: j for j, job in enumerate(plan)}
+        for j, job in enumerate(plan):
+            waiting[i, j] = len(job['after'])
+            for name in job['after']:
+                dependents[i, index[name]].append(j)
+            if not job['after']:
+                heapq.heappush(ready.setdefault(job['tool'], []), (i, j))
+
+    free = [[node_cores, node_memory, node_disk] for _ in xrange(num_nodes)]
+    running, now = [], 0
+
+    def start_ready():
+        blocked = set()
+        while True:
+            heads = [(queue[0], tool) for tool, queue in ready.iteritems() if queue and tool not in blocked]
+            if not heads:
+                return
+            (i, j), tool = min(heads)
+            job = plans[i][j]
+            need = [job['cores'], job['memory'], job['disk']]
+            node = next((n for n, x in enumerate(free) if all(a >= b for a, b in zip(x, need))), None)
+            if node is None:
+                blocked.add(tool)
+                continue
+            heapq.heappop(ready[tool])
+            free[node] = [a - b for a, b in zip(free[node], need)]
+            heapq.heappush(running, (now + job['seconds'], i, j, node))
+
+    start_ready()
+    while running:
+        now, i, j, node = heapq.heappop(running)
+        job = plans[i][j]
+        free[node] = [a + b for a, b in zip(free[node], [job['cores'], job['memory'], job['disk']])]
+        for k in dependents[i, j]:
+            waiting[i, k] -= 1
+            if waiting[i, k] == 0:
+                heapq.heappush(ready.setdefault(plans[i][k]['tool'], []), (i, k))
+        start_ready()
+    return now
+
+
+def plan_run(samples, config, num_nodes, node_cores, node_memory, node_disk):
+    """
+    Plans every sample and estimates the makespan of the run
+
+    :param list(list(str)) samples: Samples with sizes, in the order they will be scheduled
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param int num_nodes: Number of nodes
+    :param int node_cores: Cores per node
+    :param int node_memory: Memory per node in bytes
+    :param int node_disk: Disk per node in bytes
+    :return: Summary and jobs of each sample, and totals for the run
+    :rtype: dict
+    """
+    plans = [plan_sample(sample, config) for sample in samples]
+    summaries = []
+    for sample, plan in zip(samples, plans):
+        summary = summarize_sample(plan)
+        summary.update(uuid=sample[2], input_bytes=sum(input_sizes(_sample_config(sample, config))), plan=plan)
+        summaries.append(summary)
+    makespan = simulate(plans, num_nodes, node_cores, node_memory, node_disk)
+    total = {'samples': len(samples),
+             'jobs': sum(x['jobs'] for x in summaries),
+             'core_hours': sum(x['core_hours'] for x in summaries),
+             'peak_disk': max([x['peak_disk'] for x in summaries] or [0]),
+             'peak_memory': max([x['peak_memory'] for x in summaries] or [0]),
+             'nodes': num_nodes, 'node_cores': node_cores, 'node_memory': node_memory, 'node_disk': node_disk,
+             'makespan_hours': makespan / 3600,
+             'utilization': sum(x['core_hours'] for x in summaries) / (makespan / 3600 * num_nodes * node_cores)
+             if makespan else 0}
+    return {'samples': summaries, 'total': total}
+
+
+def format_plan(plan):
+    """
+    Formats a plan from `plan_run` as a table
+
+    :param dict plan: Plan from `plan_run`
+    :return: Table with a row per sample followed by the totals
+    :rtype: str
+    """
+    row = '{:<40} {:>10} {:>5} {:>11} {:>10} {:>10} {:>14}'
+    lines = [row.format('UUID', 'Input', 'Jobs', 'Core-hours', 'Peak disk', 'Peak mem', 'Critical path')]
+    for x in plan['samples']:
+        lines.append(row.format(x['uuid'], bytes2human(x['input_bytes']), x['jobs'], '{:.1f}'.format(x['core_hours']),
+                                bytes2human(x['peak_disk']), bytes2human(x['peak_memory']),
+                                '{:.1f}h'.format(x['critical_path_hours'])))
+    total = plan['total']
+    lines += ['',
+              'Samples: {samples}  Jobs: {jobs}  Core-hours: {core_hours:.1f}'.format(**total),
+              'Peak disk: {}  Peak memory: {}'.format(bytes2human(total['peak_disk']),
+                                                      bytes2human(total['peak_memory'])),
+              'Makespan on {} node(s) of {} cores, {} memory, {} disk: {:.1f}h ({:.0%} core utilization)'.format(
+                  total['nodes'], total['node_cores'], bytes2human(total['node_memory']),
+                  bytes2human(total['node_disk']), total['makespan_hours'], total['utilization'])]
+    return '\n'.join(lines)
+
+
+def _sample_config(sample, config):
+    """
+    Copy of config with the sample's URLs and sizes, as `input_sizes` expects
+
+    :param list(str) sample: Sample information with sizes
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :rtype: Expando
+    """
+    config = config.copy()
+    config.url = sample[3]
+    config.url_sizes = sample[4] if len(sample) > 4 else None
+    return config
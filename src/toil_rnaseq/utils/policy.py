@@ -0,0 +1,95 @@
+from __future__ import division
+
+import json
+import os
+
+from toil_rnaseq.utils.filesize import human2bytes
+from toil_rnaseq.utils.resources import predict_cores
+
+
+def load_curves(path=None):
+    """
+    Loads the scaling curves written by `toil-rnaseq benchmark`
+
+    :param str path: Path to scaling curves (JSON), or None
+    :return: Wall time in seconds of each tool, keyed by tool and thread count
+    :rtype: dict(str, dict(int, float))
+    """
+    if not path:
+        return {}
+    with open(path) as f:
+        return {tool: {int(k): v for k, v in curve.iteritems()} for tool, curve in json.load(f).iteritems()}
+
+
+def runtime(curve, cores):
+    """
+    Wall time of a tool at a thread count, interpolated between measured thread counts.
+    Beyond the measured range the closest measurement is used, assuming no further speedup.
+
+    >>> curve = {1: 100, 4: 40, 8: 30}
+    >>> runtime(curve, 2), runtime(curve, 6), runtime(curve, 16)
+    (80.0, 35.0, 30)
+
+    :param dict(int, float) curve: Wall time keyed by thread count
+    :param int cores: Number of threads
+    :return: Wall time in seconds
+    :rtype: float
+    """
+    points = sorted(curve.iteritems())
+    if cores <= points[0][0]:
+        return points[0][1]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if cores <= x1:
+            return y0 + (y1 - y0) * (cores - x0) / (x1 - x0)
+    return points[-1][1]
+
+
+def choose_cores(curve, node_cores, max_concurrent=None):
+    """
+    Number of cores per job that maximizes samples per hour on a node running as many copies of the tool as fit.
+    Ties go to more cores, which finishes each sample sooner.
+
+    >>> curve = {1: 100, 2: 50, 4: 40, 8: 35}
+    >>> choose_cores(curve, 8)
+    2
+    >>> choose_cores(curve, 8, max_concurrent=1)
+    8
+
+    :param dict(int, float) curve: Wall time keyed by thread count
+    :param int node_cores: Number of cores on the node
+    :param int max_concurrent: Most copies of the tool that fit on the node, e.g. due to memory
+    :return: Number of cores
+    :rtype: int
+    """
+    def samples_per_hour(cores):
+        copies = node_cores // cores
+        if max_concurrent is not None:
+            copies = min(copies, max(max_concurrent, 1))
+        return copies * 3600 / runtime(curve, cores)
+    return max(xrange(1, node_cores + 1), key=lambda x: (round(samples_per_hour(x), 6), x))
+
+
+def allocate_cores(config, tool, memory=None):
+    """
+    Cores to give a tool's job. Tools with a measured scaling curve use `choose_cores` for the node shape
+    (`config.cores` and `config.node_memory`), others use the resource model.
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str tool: Name of tool, one of `toil_rnaseq.utils.resources.priors`
+    :param int|str memory: Memory required by the tool's job, limiting how many fit on the node
+    :return: Number of cores
+    :rtype: int
+    """
+    curve = config.scaling.get(tool.split('-')[0])
+    if not curve:
+        return predict_cores(config.resources, tool, config.cores)
+    memory = human2bytes(memory) if isinstance(memory, basestring) else memory
+    max_concurrent = config.node_memory // memory if memory else None
+    return choose_cores(curve, config.cores, max_concurrent)
+
+
+def node_memory():
+    """
+    Physical memory of this node in bytes
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
@@ -0,0 +1,131 @@
+import os
+import tarfile
+import zlib
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from toil_rnaseq.utils.filesize import human2bytes
+from toil_rnaseq.utils.urls import s3_listing
+from toil_rnaseq.utils.urls import url_size
+
+# Number of inputs or outputs checked concurrently during pre-flight
+num_threads = 32
+
+
+def order_by_size(samples, default_size, known_sizes=None):
+    """
+    Finds the size of every sample's input(s) and orders samples largest first, so the longest
+    samples are scheduled first rather than stretching the tail of the run.
+
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param str default_size: Size assumed for inputs whose size could not be found, e.g. "20G"
+    :param dict(str, int) known_sizes: Sizes already found, keyed by URL
+    :return: Samples with sizes, largest first
+    :rtype: list(list(str))
+    """
+    samples = sample_sizes(samples, known_sizes)
+    return sorted(samples, key=lambda x: sum(_parse_sizes(x[4], default_size)), reverse=True)
+
+
+def sample_sizes(samples, known_sizes=None):
+    """
+    Finds the size of every sample's input(s) concurrently. The sizes are appended to each sample as a
+    comma-separated field, with an empty value for inputs whose size could not be found.
+
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param dict(str, int) known_sizes: Sizes already found, keyed by URL
+    :return: Samples with sizes, in the same order
+    :rtype: list(list(str))
+    """
+    known_sizes = known_sizes or {}
+    urls = [sample[3].split(',') for sample in samples]
+    pool = ThreadPool(num_threads)
+    try:
+        flat_sizes = pool.map(lambda x: known_sizes[x] if known_sizes.get(x) is not None else url_size(x),
+                              [url for sample_urls in urls for url in sample_urls])
+    finally:
+        pool.close()
+        pool.join()
+
+    sized_samples = []
+    for sample, sample_urls in zip(samples, urls):
+        sizes, flat_sizes = flat_sizes[:len(sample_urls)], flat_sizes[len(sample_urls):]
+        sized_samples.append(sample[:4] + [','.join('' if x is None else str(x) for x in sizes)])
+    return sized_samples
+
+
+def find_completed(samples, output_dir):
+    """
+    Checks the output location for each sample's consolidated output (<UUID>.tar.gz). Local outputs are
+    validated by reading the tarball concurrently, S3 outputs are found with a listing of the output directory.
+
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param str output_dir: Output directory or s3:// URL from the config
+    :return: Samples with complete outputs, samples without output, and samples with invalid output
+    :rtype: tuple(list, list, list)
+    """
+    names = [sample[2] + '.tar.gz' for sample in samples]
+    if urlparse(output_dir).scheme == 's3':
+        sizes = s3_listing(output_dir)
+        status = [None if x not in sizes else sizes[x] > 0 for x in names]
+    else:
+        paths = [os.path.join(output_dir, x) for x in names]
+        pool = ThreadPool(num_threads)
+        try:
+            status = pool.map(lambda x: _valid_tarball(x) if os.path.exists(x) else None, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    completed = [sample for sample, valid in zip(samples, status) if valid]
+    pending = [sample for sample, valid in zip(samples, status) if valid is None]
+    failed = [sample for sample, valid in zip(samples, status) if valid is False]
+    return completed, pending, failed
+
+
+def _valid_tarball(path):
+    """
+    Whether a tarball can be read to the end and has at least one member
+
+    :param str path: Path to tarball
+    :rtype: bool
+    """
+    try:
+        with tarfile.open(path) as f:
+            return len(f.getmembers()) > 0
+    except (tarfile.TarError, IOError, EOFError, zlib.error):
+        return False
+
+
+def input_sizes(config):
+    """
+    Sizes of a sample's inputs found during pre-flight, in the order of its URLs
+
+    >>> from toil_rnaseq.utils.expando import Expando
+    >>> input_sizes(Expando(url='a,b', url_sizes='100,', max_sample_size='1K', ci_test=None))
+    [100, 1024]
+    >>> input_sizes(Expando(url='a', url_sizes=None, max_sample_size='1K', ci_test=None))
+    [1024]
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :return: Size in bytes of each input, max-sample-size for inputs whose size is unknown
+    :rtype: list(int)
+    """
+    default_size = '2G' if config.ci_test else config.max_sample_size
+    num_urls = len(config.url.split(','))
+    return _parse_sizes(config.url_sizes or ',' * (num_urls - 1), default_size)
+
+
+def _parse_sizes(field, default_size):
+    """
+    Parses the comma-separated sizes added by `order_by_size`
+
+    >>> _parse_sizes('5,,7', '1K')
+    [5, 1024, 7]
+
+    :param str field: Comma-separated sizes
+    :param str default_size: Size used for empty values
+    :return: Sizes in bytes
+    :rtype: list(int)
+    """
+    return [int(x) if x else human2bytes(default_size) for x in field.split(',')]
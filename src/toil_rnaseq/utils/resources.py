@@ -0,0 +1,219 @@
+from __future__ import division
+
+import json
+import math
+from collections import defaultdict
+
+from toil_rnaseq.tools.profiling import log_prefix
+from toil_rnaseq.utils.filesize import human2bytes
+
+# Requirements used for tools that have no fitted model. These are the values the workflow has always used.
+# Disk and memory are linear in the size of the tool's input (bytes): slope * input_size + intercept
+# Cores are capped at `cap` when the node has at least `threshold` cores. A cap of None uses every core.
+# CPU seconds are only used to plan runs (`toil-rnaseq plan`) and are rough figures for 2x76bp reads
+# "cram" is added to the disk of jobs that save CRAMs: the genome FASTA, and the CRAM written next to the BAM
+priors = {
+    'download': {'disk': {'slope': 1, 'intercept': 0},
+                 'cpu_seconds': {'slope': 1e-8, 'intercept': 0}},
+    'bam': {'disk': {'slope': 5, 'intercept': 0},
+            'cpu_seconds': {'slope': 2e-7, 'intercept': 0}},
+    'bam-shard': {'disk': {'slope': 3, 'intercept': 0}},
+    'tar': {'disk': {'slope': 10, 'intercept': 0},
+            'cpu_seconds': {'slope': 2e-7, 'intercept': 0}},
+    'fastqs': {'disk': {'slope': 5, 'intercept': 0},
+               'cpu_seconds': {'slope': 2e-7, 'intercept': 0}},
+    'cutadapt': {'disk': {'slope': 2, 'intercept': 0},
+                 'cpu_seconds': {'slope': 2e-7, 'intercept': 0}},
+    'fastqc': {'disk': {'slope': 1, 'intercept': human2bytes('2G')},
+               'cores': {'cap': 2, 'threshold': 0},
+               'cpu_seconds': {'slope': 1e-7, 'intercept': 60}},
+    'kallisto': {'disk': {'slope': 1, 'intercept': human2bytes('2G')},
+                 'cores': {'cap': 16, 'threshold': 32},
+                 'cpu_seconds': {'slope': 1e-7, 'intercept': 120}},
+    'hera': {'disk': {'slope': 1, 'intercept': human2bytes('2G')},
+             'cores': {'cap': None},
+             'cpu_seconds': {'slope': 1.5e-7, 'intercept': 120}},
+    'quantifiers': {'disk': {'slope': 1, 'intercept': human2bytes('6G')},
+                    'cores': {'cap': None},
+                    'cpu_seconds': {'slope': 3.5e-7, 'intercept': 300}},
+    'star': {'disk': {'slope': 1, 'intercept': human2bytes('50G')},
+             'memory': {'slope': 0, 'intercept': human2bytes('40G')},
+             'cores': {'cap': None},
+             'cpu_seconds': {'slope': 1.6e-6, 'intercept': 600}},
+    'star-colocated': {'disk': {'slope': 3, 'intercept': human2bytes('50G')},
+                       'memory': {'slope': 0, 'intercept': human2bytes('40G')},
+                       'cores': {'cap': None},
+                       'cpu_seconds': {'slope': 2.2e-6, 'intercept': 600}},
+    'consolidate': {'cores': {'cap': 4, 'threshold': 0}},
+    'bamqc': {'disk': {'slope': 1, 'intercept': 0},
+              'cores': {'cap': 4, 'threshold': 0},
+              'cpu_seconds': {'slope': 1e-6, 'intercept': 0}},
+    'sort': {'disk': {'slope': 1, 'intercept': 0},
+             'cpu_seconds': {'slope': 1e-6, 'intercept': 0}},
+    'cram': {'disk': {'slope': 0.5, 'intercept': human2bytes('4G')}},
+    'wiggle': {'disk': {'slope': 1, 'intercept': 0},
+               'cpu_seconds': {'slope': 3e-7, 'intercept': 0}},
+    'rsem': {'disk': {'slope': 1, 'intercept': human2bytes('20G')},
+             'cores': {'cap': 16, 'threshold': 32},
+             'cpu_seconds': {'slope': 6e-6, 'intercept': 300}}}
+
+# Fitted requirements are inflated by this factor to absorb variance not explained by input size
+headroom = 1.1
+
+# Minimum number of recorded jobs needed before a tool's prior is replaced
+min_records = 3
+
+
+def load_model(path=None):
+    """
+    Loads a fitted resource model. Tools absent from the model fall back to `priors`
+
+    :param str path: Path to model file (JSON) written by `toil-rnaseq fit-resources`, or None
+    :return: Fitted model
+    :rtype: dict
+    """
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def predict(model, tool, resource, input_size=0):
+    """
+    Predicts the disk, memory, or CPU time required by a tool
+
+    >>> predict({}, 'tar', 'disk', 100)
+    1000
+    >>> predict({'tar': {'disk': {'slope': 2, 'intercept': 5}}}, 'tar', 'disk', 100)
+    205
+    >>> predict({}, 'tar', 'memory', 100) is None
+    True
+
+    :param dict model: Fitted model from `load_model`
+    :param str tool: Name of tool, one of `priors`
+    :param str resource: "disk", "memory", or "cpu_seconds"
+    :param int input_size: Size of the tool's input in bytes
+    :return: Bytes (or CPU seconds) required, or None if Toil's default should be used
+    :rtype: int
+    """
+    params = model.get(tool, {}).get(resource) or priors[tool].get(resource)
+    if params is None:
+        return None
+    return int(params['slope'] * input_size + params['intercept'])
+
+
+def predict_cores(model, tool, cores):
+    """
+    Predicts the number of cores a tool should be given
+
+    >>> predict_cores({}, 'kallisto', 8)
+    8
+    >>> predict_cores({}, 'kallisto', 32)
+    16
+    >>> predict_cores({}, 'star', 32)
+    32
+    >>> predict_cores({'star': {'cores': {'cap': 12}}}, 'star', 32)
+    12
+
+    :param dict model: Fitted model from `load_model`
+    :param str tool: Name of tool, one of `priors`
+    :param int cores: Number of cores available on the node
+    :return: Number of cores
+    :rtype: int
+    """
+    params = model.get(tool, {}).get('cores') or priors[tool].get('cores') or {'cap': None}
+    if params['cap'] is None or cores < params.get('threshold', 0):
+        return cores
+    return min(params['cap'], cores)
+
+
+def read_history(paths):
+    """
+    Reads recorded jobs from history files. Each file holds one JSON record per line, a JSON list of records
+    (profile.json), or is a workflow log whose profile lines each hold a record.
+    A record contains the "tool" name, its "input_bytes", and any of the observed "disk" and "memory" peaks (bytes),
+    "cpu_seconds" and "wall_seconds".
+
+    :param list(str) paths: Paths to history files
+    :return: Recorded jobs
+    :rtype: list(dict)
+    """
+    records = []
+    for path in paths:
+        with open(path) as f:
+            content = f.read().strip()
+        if content.startswith('['):
+            records.extend(json.loads(content))
+        elif log_prefix in content:
+            records.extend(json.loads(line.split(log_prefix, 1)[1]) for line in content.splitlines()
+                           if log_prefix in line)
+        else:
+            records.extend(json.loads(line) for line in content.splitlines() if line.strip())
+    return records
+
+
+def fit_model(records, model=None):
+    """
+    Fits each tool's disk, memory, and CPU time as a linear function of input size, shifted up so every recorded job
+    would have fit, and caps cores at the highest parallelism a tool achieved. Tools with fewer than
+    `min_records` records keep their current parameters. Records without an input size, from jobs that aren't a
+    stage of `priors`, are skipped.
+
+    >>> records = [{'tool': 'tar', 'input_bytes': x, 'disk': 3 * x + 10} for x in (10, 20, 30)]
+    >>> disk = fit_model(records)['tar']['disk']
+    >>> disk['slope'], disk['intercept']
+    (3.3, 11)
+
+    :param list(dict) records: Recorded jobs from `read_history`
+    :param dict model: Existing model to update
+    :return: Fitted model
+    :rtype: dict
+    """
+    model = dict(model or {})
+    by_tool = defaultdict(list)
+    for record in records:
+        if record.get('input_bytes') is not None:
+            by_tool[record['tool']].append(record)
+
+    for tool, tool_records in by_tool.iteritems():
+        params = dict(model.get(tool, {}))
+        for resource in ['disk', 'memory', 'cpu_seconds']:
+            points = [(x['input_bytes'], x[resource]) for x in tool_records if x.get(resource) is not None]
+            if len(points) >= min_records:
+                params[resource] = _fit_envelope(points)
+        parallelism = [x['cpu_seconds'] / x['wall_seconds'] for x in tool_records
+                       if x.get('cpu_seconds') is not None and x.get('wall_seconds')]
+        if len(parallelism) >= min_records:
+            params['cores'] = {'cap': max(1, int(math.ceil(max(parallelism))))}
+        if params:
+            model[tool] = params
+    return model
+
+
+def _fit_envelope(points):
+    """
+    Least-squares line through (input size, usage) points, raised so that it lies above every point
+
+    :param list(tuple(int, int)) points: Input size and observed usage
+    :return: Slope and intercept
+    :rtype: dict
+    """
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0
+    slope = max(slope, 0)
+    intercept = max(y - slope * x for x, y in points)
+    return {'slope': float('%.6g' % (slope * headroom)), 'intercept': int(round(max(intercept, 0) * headroom))}
+
+
+def save_model(model, path):
+    """
+    Writes a fitted resource model
+
+    :param dict model: Fitted model
+    :param str path: Output path
+    """
+    with open(path, 'w') as f:
+        json.dump(model, f, indent=2, sort_keys=True)
@@ -0,0 +1,210 @@
+import base64
+import hashlib
+import os
+import sys
+import threading
+import time
+from StringIO import StringIO
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from toil_rnaseq.utils import require, UserError
+
+# Size of each part of a multipart upload. S3 requires every part but the last to be at least 5 MB
+part_size = 50 * 1024 * 1024
+
+# Number of parts uploaded concurrently, which is also the number of parts held in memory
+upload_slots = 8
+
+# Attempts at uploading each part, waiting `retry_delay` seconds after the first failure and doubling each time
+part_attempts = 3
+retry_delay = 1
+
+
+def sse_key(master_key_path, s3_url):
+    """
+    SSE-C key of an object, derived from a master key and the object's URL the same way as s3am's
+    --sse-key-is-master, so objects can be downloaded with either
+
+    :param str master_key_path: Path to 32-byte master key
+    :param str s3_url: URL of object. Format: s3://bucket/key
+    :return: 32-byte key
+    :rtype: str
+    """
+    with open(master_key_path, 'rb') as f:
+        master_key = f.read()
+    require(len(master_key) == 32, 'SSE-C key must be 32 bytes: {}'.format(master_key_path))
+    return hashlib.sha256(master_key + s3_url).digest()
+
+
+def sse_headers(key):
+    """
+    Request headers that encrypt (or decrypt) an object with a customer-provided key
+
+    >>> sorted(sse_headers('k' * 32).items())[0]
+    ('x-amz-server-side-encryption-customer-algorithm', 'AES256')
+
+    :param str key: 32-byte key
+    :rtype: dict(str, str)
+    """
+    return {'x-amz-server-side-encryption-customer-algorithm': 'AES256',
+            'x-amz-server-side-encryption-customer-key': base64.b64encode(key),
+            'x-amz-server-side-encryption-customer-key-MD5': base64.b64encode(hashlib.md5(key).digest())}
+
+
+def upload_file(file_path, s3_url, s3_key_path=None, num_slots=upload_slots, bucket=None):
+    """
+    Uploads a local file to S3. See `upload_stream`
+
+    :param str file_path: Path to file
+    :param str s3_url: Destination. Format: s3://bucket/key
+    :param str s3_key_path: Path to 32-byte master key used for SSE-C encryption
+    :param int num_slots: Number of parts uploaded concurrently
+    :param Bucket bucket: Bucket to upload to, connected to from the URL by default
+    """
+    with open(file_path, 'rb') as f:
+        upload_stream(f, s3_url, s3_key_path=s3_key_path, num_slots=num_slots, bucket=bucket)
+
+
+def upload_stream(f, s3_url, s3_key_path=None, num_slots=upload_slots, bucket=None, abort=None):
+    """
+    Uploads what is read from a stream to S3 as it is read. Parts are read one after another and uploaded
+    concurrently, and each part is retried on its own. Streams shorter than one part are uploaded in one request.
+
+    :param file f: Stream to read from until it ends
+    :param str s3_url: Destination. Format: s3://bucket/key
+    :param str s3_key_path: Path to 32-byte master key used for SSE-C encryption, see `sse_key`
+    :param int num_slots: Number of parts uploaded concurrently
+    :param Bucket bucket: Bucket to upload to, connected to from the URL by default
+    :param threading.Event abort: If set by the time the stream ends, nothing is uploaded
+    """
+    parsed_url = urlparse(s3_url)
+    require(parsed_url.scheme == 's3', 'Format of s3_url (s3://) is incorrect: {}'.format(s3_url))
+    bucket = bucket or _connect(parsed_url.netloc)
+    key_name = parsed_url.path.lstrip('/')
+    headers = sse_headers(sse_key(s3_key_path, s3_url)) if s3_key_path else {}
+
+    data = _read_part(f)
+    if len(data) < part_size:
+        if not (abort and abort.is_set()):
+            bucket.new_key(key_name).set_contents_from_string(data, headers=headers)
+        return
+
+    upload = bucket.initiate_multipart_upload(key_name, headers=headers)
+    slots = threading.BoundedSemaphore(num_slots)
+    pool = ThreadPool(num_slots)
+    try:
+        parts, part_num = [], 1
+        while data:
+            slots.acquire()
+            parts.append(pool.apply_async(_upload_part, (upload, data, part_num, headers, slots)))
+            # Stop reading as soon as a part fails for good
+            [x.get() for x in parts if x.ready()]
+            data, part_num = _read_part(f), part_num + 1
+        pool.close()
+        pool.join()
+        [x.get() for x in parts]
+        if abort and abort.is_set():
+            upload.cancel_upload()
+        else:
+            upload.complete_upload()
+    except:
+        pool.terminate()
+        upload.cancel_upload()
+        raise
+
+
+@contextmanager
+def s3_writer(s3_url, s3_key_path=None, num_slots=upload_slots, bucket=None):
+    """
+    Writable stream that is uploaded to S3 while it is written, see `upload_stream`. The stream is a pipe,
+    so it can be passed to a subprocess. Nothing is uploaded if writing fails.
+
+    :param str s3_url: Destination. Format: s3://bucket/key
+    :param str s3_key_path: Path to 32-byte master key used for SSE-C encryption
+    :param int num_slots: Number of parts uploaded concurrently
+    :param Bucket bucket: Bucket to upload to, connected to from the URL by default
+    :return: Stream to write to
+    :rtype: file
+    """
+    read_fd, write_fd = os.pipe()
+    f_in, f_out = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+    abort, error = threading.Event(), []
+
+    def upload():
+        try:
+            upload_stream(f_in, s3_url, s3_key_path=s3_key_path, num_slots=num_slots, bucket=bucket, abort=abort)
+        except:
+            error.append(sys.exc_info())
+            # Keep reading so the writer isn't blocked on a full pipe
+            while f_in.read(1024 * 1024):
+                pass
+        finally:
+            f_in.close()
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+    try:
+        yield f_out
+    except:
+        abort.set()
+        raise
+    finally:
+        f_out.close()
+        thread.join()
+    if error:
+        raise error[0][0], error[0][1], error[0][2]
+
+
+def _upload_part(upload, data, part_num, headers, slots):
+    """
+    Uploads one part of a multipart upload, retrying failures
+
+    :param MultiPartUpload upload: Multipart upload
+    :param str data: Contents of part
+    :param int part_num: Number of part, starting at 1
+    :param dict headers: Request headers
+    :param threading.BoundedSemaphore slots: Released once the part is done
+    """
+    try:
+        for attempt in xrange(part_attempts):
+            try:
+                upload.upload_part_from_file(StringIO(data), part_num, headers=headers, size=len(data))
+                return
+            # Any error of the connection or the request is worth retrying
+            except Exception:
+                if attempt == part_attempts - 1:
+                    raise
+                time.sleep(retry_delay * 2 ** attempt)
+    finally:
+        slots.release()
+
+
+def _read_part(f):
+    """
+    Reads up to one part from a stream, which may return less than requested from each read
+
+    :param file f: Stream
+    :rtype: str
+    """
+    chunks, remaining = [], part_size
+    while remaining:
+        chunk = f.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+
+def _connect(bucket_name):
+    """
+    :param str bucket_name: Name of bucket
+    :rtype: Bucket
+    """
+    try:
+        import boto
+    except ImportError:
+        raise UserError('\n\nboto must be installed to upload outputs to S3\n\n')
+    return boto.connect_s3().get_bucket(bucket_name, validate=False)
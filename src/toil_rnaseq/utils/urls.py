@@ -1,10 +1,17 @@
+import json
 import os
 import shutil
 import subprocess
+from contextlib import contextmanager
 from urlparse import urlparse
 
-from files import copy_files
-from toil_rnaseq.utils import require
+from files import deliver_file
+from toil_rnaseq.utils import require, UserError
+from toil_rnaseq.utils.s3 import s3_writer
+from toil_rnaseq.utils.s3 import upload_file
+
+# Metadata endpoint used to find the size of files on the GDC
+gdc_api = 'https://api.gdc.cancer.gov/files/'
 
 
 def download_url(url, work_dir='.', name=None, s3_key_path=None):
@@ -39,20 +46,122 @@ def download_url_job(job, url, name=None, s3_key_path=None):
     return job.fileStore.writeGlobalFile(fpath)
 
 
-def s3am_upload(fpath, s3_dir, num_cores=1, s3_key_path=None):
+def url_size(url):
+    """
+    Finds the size of the file at a URL without downloading it: os.stat for file://, a HEAD request for
+    http:// and ftp://, object metadata for s3://, and the GDC API for gdc://
+
+    :param str url: URL of file
+    :return: Size in bytes, or None if it could not be determined
+    :rtype: int
     """
-    Uploads a file to s3 via S3AM
-    S3AM binary must be on the PATH to use this function
-    For SSE-C encryption: provide a path to a 32-byte file
+    parsed_url = urlparse(url)
+    try:
+        if parsed_url.scheme == 'file':
+            return os.stat(parsed_url.path).st_size
+        elif parsed_url.scheme == 's3':
+            return _s3_size(parsed_url.netloc, parsed_url.path.lstrip('/'))
+        elif parsed_url.scheme == 'gdc':
+            response = subprocess.check_output(['curl', '-fsL', '--retry', '5',
+                                                gdc_api + parsed_url.netloc + '?fields=file_size'])
+            return int(json.loads(response)['data']['file_size'])
+        else:
+            headers = subprocess.check_output(['curl', '-fsIL', '--retry', '5', url])
+            # Only the last response matters when redirects are followed
+            lengths = [line.split(':', 1)[1] for line in headers.splitlines()
+                       if line.lower().startswith('content-length:')]
+            return int(lengths[-1]) if lengths else None
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, TypeError):
+        return None
+
 
-    :param str fpath: Path to file to upload
-    :param str s3_dir: Ouptut S3 path. Format: s3://bucket/[directory]
-    :param int num_cores: Number of cores to use for up/download with S3AM
-    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+def url_etag(url):
     """
-    require(s3_dir.startswith('s3://'), 'Format of s3_dir (s3://) is incorrect: {}'.format(s3_dir))
-    s3_dir = os.path.join(s3_dir, os.path.basename(fpath))
-    _s3am_with_retry(num_cores, file_path=fpath, s3_url=s3_dir, mode='upload', s3_key_path=s3_key_path)
+    Finds the ETag of the file at a URL without downloading it: a HEAD request for http:// and ftp://, object
+    metadata for s3://, and the MD5 from the GDC API for gdc://. Local files have no ETag.
+
+    :param str url: URL of file
+    :return: ETag, or None if it could not be determined
+    :rtype: str
+    """
+    parsed_url = urlparse(url)
+    try:
+        if parsed_url.scheme == 'file':
+            return None
+        elif parsed_url.scheme == 's3':
+            return _s3_etag(parsed_url.netloc, parsed_url.path.lstrip('/'))
+        elif parsed_url.scheme == 'gdc':
+            response = subprocess.check_output(['curl', '-fsL', '--retry', '5',
+                                                gdc_api + parsed_url.netloc + '?fields=md5sum'])
+            return json.loads(response)['data']['md5sum']
+        else:
+            headers = subprocess.check_output(['curl', '-fsIL', '--retry', '5', url])
+            # Only the last response matters when redirects are followed
+            etags = [line.split(':', 1)[1].strip() for line in headers.splitlines()
+                     if line.lower().startswith('etag:')]
+            return etags[-1] if etags else None
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _s3_size(bucket_name, key_name):
+    """
+    Size of an S3 object, listed rather than HEAD-requested so SSE-C keys are not needed
+
+    :param str bucket_name: Name of bucket
+    :param str key_name: Name of key
+    :return: Size in bytes, or None if boto is not installed or the key does not exist
+    :rtype: int
+    """
+    try:
+        import boto
+        from boto.exception import BotoClientError, BotoServerError
+    except ImportError:
+        return None
+    try:
+        bucket = boto.connect_s3().get_bucket(bucket_name, validate=False)
+        return next((x.size for x in bucket.list(prefix=key_name) if x.name == key_name), None)
+    except (BotoClientError, BotoServerError):
+        return None
+
+
+def _s3_etag(bucket_name, key_name):
+    """
+    ETag of an S3 object, listed rather than HEAD-requested so SSE-C keys are not needed
+
+    :param str bucket_name: Name of bucket
+    :param str key_name: Name of key
+    :return: ETag, or None if boto is not installed or the key does not exist
+    :rtype: str
+    """
+    try:
+        import boto
+        from boto.exception import BotoClientError, BotoServerError
+    except ImportError:
+        return None
+    try:
+        bucket = boto.connect_s3().get_bucket(bucket_name, validate=False)
+        return next((x.etag for x in bucket.list(prefix=key_name) if x.name == key_name), None)
+    except (BotoClientError, BotoServerError):
+        return None
+
+
+def s3_listing(s3_dir):
+    """
+    Sizes of the objects directly under an S3 directory. Keys are listed in batches of up to 1,000 per request
+
+    :param str s3_dir: S3 directory. Format: s3://bucket/[directory]/
+    :return: Size in bytes keyed by object name (without the directory)
+    :rtype: dict(str, int)
+    """
+    try:
+        import boto
+    except ImportError:
+        raise UserError('\n\nboto must be installed to list outputs on S3\n\n')
+    parsed_url = urlparse(s3_dir)
+    prefix = parsed_url.path.lstrip('/')
+    bucket = boto.connect_s3().get_bucket(parsed_url.netloc, validate=False)
+    return {x.name[len(prefix):]: x.size for x in bucket.list(prefix=prefix, delimiter='/') if hasattr(x, 'size')}
 
 
 def _s3am_with_retry(num_cores, file_path, s3_url, mode='upload', s3_key_path=None):
@@ -90,18 +199,49 @@ def _s3am_with_retry(num_cores, file_path, s3_url, mode='upload', s3_key_path=No
     raise RuntimeError('S3AM failed to {} after {} retries.'.format(mode, retry_count))
 
 
-def move_or_upload(config, files, enforce_ssec=True):
+def move_or_upload(config, files, enforce_ssec=True, owned=False):
     """
-    Move or upload file based on configuration settings
+    Move or upload file based on configuration settings. Local outputs are renamed, cloned, or hardlinked
+    where possible instead of copied, see `deliver_file`
 
     :param Expando config: Dict-like object containing workflow options as attributes
     :param list(str,) files: List of files to be moved or uploaded
     :param bool enforce_ssec: If True, enforces SSEC be set in config or else fails
+    :param bool owned: If True, the files were written by the calling job and may be moved
     """
     if urlparse(config.output_dir).scheme == 's3':
         if enforce_ssec:
             require(config.ssec, 'SSEC encryption required to upload sensitive read data to S3.')
         for f in files:
-            s3am_upload(fpath=f, s3_dir=config.output_dir, s3_key_path=config.ssec)
+            upload_file(f, os.path.join(config.output_dir, os.path.basename(f)), s3_key_path=config.ssec)
     elif urlparse(config.output_dir).scheme != 's3':
-        copy_files(file_paths=files, output_dir=config.output_dir)
+        for f in files:
+            deliver_file(f, config.output_dir, owned=owned)
+
+
+@contextmanager
+def output_stream(config, name, enforce_ssec=True):
+    """
+    Writable stream to an output file. In a local output directory the file is written in place and renamed
+    once complete, on S3 it is uploaded while it is written. The stream can be passed to a subprocess.
+
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str name: Name of output file
+    :param bool enforce_ssec: If True, enforces SSEC be set in config or else fails
+    :return: Stream to write to
+    :rtype: file
+    """
+    if urlparse(config.output_dir).scheme == 's3':
+        if enforce_ssec:
+            require(config.ssec, 'SSEC encryption required to upload sensitive read data to S3.')
+        with s3_writer(os.path.join(config.output_dir, name), s3_key_path=config.ssec) as f:
+            yield f
+    else:
+        path = os.path.join(config.output_dir, name)
+        try:
+            with open(path + '.partial', 'wb') as f:
+                yield f
+        except:
+            os.remove(path + '.partial')
+            raise
+        os.rename(path + '.partial', path)
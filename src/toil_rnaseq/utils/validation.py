@@ -0,0 +1,257 @@
+from __future__ import division
+
+import json
+import os
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from toil_rnaseq.utils.preflight import num_threads
+from toil_rnaseq.utils.urls import gdc_api
+
+# Most requests made to one host per second, so checking thousands of URLs doesn't trip a server's rate limit
+host_rate = 10
+
+# Seconds a successful check is reused from the cache
+cache_max_age = 24 * 3600
+
+# Config options that hold URLs of inputs shared by every sample
+index_options = ['star-index', 'rsem-ref', 'kallisto-index', 'hera-index', 'genome-fasta', 'hugo-mapping']
+
+# curl exit codes that identify why a request failed
+curl_errors = {6: ('error', 'could not resolve host'), 7: ('error', 'could not connect to host'),
+               9: ('forbidden', 'access denied'), 28: ('error', 'timed out'), 67: ('forbidden', 'login denied'),
+               78: ('missing', 'file not found')}
+
+
+class RateLimiter(object):
+    """
+    Spaces out requests to each host. Threads wait outside the lock, so hosts don't hold each other up.
+
+    >>> limiter = RateLimiter(rate=20)
+    >>> start = time.time()
+    >>> for _ in xrange(3):
+    ...     limiter.wait('example.com')
+    >>> 0.1 <= time.time() - start < 0.5
+    True
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_request = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + self.interval
+        time.sleep(start - now)
+
+
+def validate_inputs(samples, config, cache_path=None, rate=host_rate):
+    """
+    Checks that every sample and index URL exists and can be read, concurrently. Successful checks
+    are cached so reruns don't repeat them.
+
+    :param list(list(str)) samples: Samples parsed from the manifest
+    :param Expando config: Dict-like object containing workflow options as attributes
+    :param str cache_path: Path to JSON file caching successful checks, or None
+    :param float rate: Most requests made to one host per second
+    :return: Result of each check in the order URLs appear, with the config option or sample UUID that uses it
+    :rtype: list(dict)
+    """
+    sources = [(x, config[x.replace('-', '_')]) for x in index_options if config.get(x.replace('-', '_'))]
+    sources += [(sample[2], url) for sample in samples for url in sample[3].split(',')]
+
+    cache = _load_cache(cache_path)
+    limiter = RateLimiter(rate)
+    pending = sorted(set(url for _, url in sources if url not in cache))
+    pool = ThreadPool(num_threads)
+    try:
+        results = pool.map(lambda x: check_url(x, gdc_token=config.gdc_token, limiter=limiter), pending)
+    finally:
+        pool.close()
+        pool.join()
+    checked = dict(zip(pending, results))
+    if cache_path:
+        cache.update({url: x for url, x in checked.iteritems() if x['status'] == 'ok'
+                      and urlparse(url).scheme != 'file'})
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    checked.update(cache)
+    return [dict(checked[url], source=source) for source, url in sources]
+
+
+def check_url(url, gdc_token=None, limiter=None):
+    """
+    Checks that the file at a URL exists and can be read, without downloading it
+
+    :param str url: URL of file
+    :param str gdc_token: Path to GDC token, needed for controlled-access GDC files
+    :param RateLimiter limiter: Limits the rate of requests to each host
+    :return: URL, status ("ok", "missing", "forbidden", "error", or "unchecked"), size in bytes
+        (None if unknown), detail of the failure, and the time of the check
+    :rtype: dict
+    """
+    parsed_url = urlparse(url)
+    if limiter and parsed_url.scheme != 'file':
+        limiter.wait(parsed_url.netloc if parsed_url.scheme != 'gdc' else urlparse(gdc_api).netloc)
+    if parsed_url.scheme == 'file':
+        status, size, detail = _check_file(parsed_url.path)
+    elif parsed_url.scheme == 's3':
+        status, size, detail = _check_s3(parsed_url.netloc, parsed_url.path.lstrip('/'))
+    elif parsed_url.scheme == 'gdc':
+        status, size, detail = _check_gdc(parsed_url.netloc, gdc_token)
+    elif parsed_url.scheme in ['http', 'https', 'ftp']:
+        status, size, detail = _check_remote(url)
+    else:
+        status, size, detail = 'error', None, 'unsupported scheme "{}"'.format(parsed_url.scheme)
+    return {'url': url, 'status': status, 'size': size, 'detail': detail, 'checked': time.time()}
+
+
+def format_failures(results):
+    """
+    Describes the checks that failed, one line each
+
+    :param list(dict) results: Results from `validate_inputs`
+    :rtype: str
+    """
+    return '\n'.join('\t{source}: {status} ({detail}) {url}'.format(**x) for x in results
+                     if x['status'] not in ['ok', 'unchecked'])
+
+
+def _check_file(path):
+    """
+    :param str path: Path to local file
+    :return: Status, size, and detail
+    :rtype: tuple(str, int, str)
+    """
+    if not os.path.isfile(path):
+        return 'missing', None, 'file not found'
+    if not os.access(path, os.R_OK):
+        return 'forbidden', None, 'file not readable'
+    return 'ok', os.stat(path).st_size, None
+
+
+def _check_remote(url):
+    """
+    Checks an http(s):// or ftp:// URL with a HEAD request, following redirects
+
+    :param str url: URL of file
+    :return: Status, size, and detail
+    :rtype: tuple(str, int, str)
+    """
+    p = subprocess.Popen(['curl', '-sIL', '--retry', '2', '--max-time', '60', url],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    headers, _ = p.communicate()
+    if p.returncode:
+        return _curl_failure(p.returncode)
+
+    # Only the last response matters when redirects are followed
+    lines = headers.splitlines()
+    codes = [line.split()[1] for line in lines if line.startswith('HTTP/') and len(line.split()) > 1]
+    lengths = [line.split(':', 1)[1].strip() for line in lines if line.lower().startswith('content-length:')]
+    size = int(lengths[-1]) if lengths and lengths[-1].isdigit() else None
+    code = codes[-1] if codes else None
+    if code is None or code.startswith('2'):
+        return 'ok', size, None
+    if code in ['401', '403']:
+        return 'forbidden', None, 'HTTP {}'.format(code)
+    if code in ['404', '410']:
+        return 'missing', None, 'HTTP {}'.format(code)
+    if code in ['405', '501']:
+        return 'unchecked', None, 'server does not allow HEAD requests'
+    return 'error', None, 'HTTP {}'.format(code)
+
+
+def _curl_failure(returncode):
+    """
+    :param int returncode: Exit code of curl
+    :return: Status, size, and detail
+    :rtype: tuple(str, int, str)
+    """
+    status, detail = curl_errors.get(returncode, ('error', 'curl exit code {}'.format(returncode)))
+    return status, None, detail
+
+
+def _check_s3(bucket_name, key_name):
+    """
+    Checks an S3 object by listing it, which does not need the object's SSE-C key. If the bucket
+    can't be listed the object itself is requested.
+
+    :param str bucket_name: Name of bucket
+    :param str key_name: Name of key
+    :return: Status, size, and detail
+    :rtype: tuple(str, int, str)
+    """
+    try:
+        import boto
+        from boto.exception import BotoClientError, BotoServerError
+    except ImportError:
+        return 'unchecked', None, 'boto is not installed'
+    try:
+        bucket = boto.connect_s3().get_bucket(bucket_name, validate=False)
+        try:
+            size = next((x.size for x in bucket.list(prefix=key_name) if x.name == key_name), None)
+            return ('ok', size, None) if size is not None else ('missing', None, 'key not found')
+        except BotoServerError as e:
+            if e.status != 403:
+                raise
+        key = bucket.get_key(key_name)
+        return ('ok', key.size, None) if key else ('missing', None, 'key not found')
+    except BotoServerError as e:
+        if e.status == 403:
+            return 'forbidden', None, 'access denied'
+        # Objects encrypted with SSE-C can't be requested without their key, but do exist
+        if e.status == 400:
+            return 'ok', None, None
+        return ('missing', None, 'bucket not found') if e.status == 404 else ('error', None, str(e.reason))
+    except BotoClientError as e:
+        return 'error', None, str(e)
+
+
+def _check_gdc(file_id, gdc_token=None):
+    """
+    Checks a GDC file with the GDC API. Controlled-access files require a token.
+
+    :param str file_id: GDC file UUID
+    :param str gdc_token: Path to GDC token
+    :return: Status, size, and detail
+    :rtype: tuple(str, int, str)
+    """
+    p = subprocess.Popen(['curl', '-sL', '--retry', '2', '--max-time', '60', '-w', '\n%{http_code}',
+                          gdc_api + file_id + '?fields=file_size,access'],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, _ = p.communicate()
+    if p.returncode:
+        return _curl_failure(p.returncode)
+    body, _, code = output.rpartition('\n')
+    if code in ['400', '404']:
+        return 'missing', None, 'no GDC file with this UUID'
+    try:
+        data = json.loads(body)['data']
+    except (ValueError, KeyError, TypeError):
+        return 'error', None, 'unexpected GDC API response (HTTP {})'.format(code)
+    if data.get('access') == 'controlled' and not (gdc_token and os.path.isfile(gdc_token)):
+        return 'forbidden', data.get('file_size'), 'controlled access and gdc-token is not set'
+    return 'ok', data.get('file_size'), None
+
+
+def _load_cache(cache_path):
+    """
+    Successful checks from the cache that are recent enough to reuse
+
+    :param str cache_path: Path to JSON file caching successful checks, or None
+    :return: Results keyed by URL
+    :rtype: dict(str, dict)
+    """
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        try:
+            cache = json.load(f)
+        except ValueError:
+            return {}
+    return {url: x for url, x in cache.iteritems() if time.time() - x['checked'] < cache_max_age}